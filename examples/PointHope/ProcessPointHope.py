@@ -12,6 +12,9 @@ data_folder = 'sentinel-data'
 out_dir = data_folder+'/processed/'
 gpt_exe = '/Applications/snap/bin/gpt'
 
+# The same ROI used to search for the images in DownloadPointHope.py
+poly = [(-167.3, 68.5), (-166.45, 68.5), (-166.45, 68.1), (-167.3, 68.1)]  # (lon, lat)
+
 # Get a list of the all the downloaded zip files
 zip_list =  glob.glob(data_folder + '/*.zip')
 
@@ -21,24 +24,19 @@ for zip_file in zip_list:
     # Extract the name of the zip_file
     base_name = zip_file.split('/')[-1].replace('.zip','')
 
-    proc = SentinelProcessor(zip_file, gpt_exe, out_dir)
+    # With lazy=True, the steps below are only recorded.  They are run as a
+    # single SNAP graph when proc.Run() is called, which avoids writing
+    # intermediate products to disk.  Use lazy=False to run each step as it
+    # is called.
+    proc = SentinelProcessor(zip_file, gpt_exe, out_dir, lazy=True)
 
     proc.ApplyOrbit()
-
     proc.RemoveThermalNoise()
-    proc.CleanTemp()
-
     proc.ApplyCalibration()
-    proc.CleanTemp()
-
+    proc.Subset(poly)
     proc.ApplyEllipsoidalCorrection()
-    proc.CleanTemp()
-
     proc.Reproject('3413')
-    proc.CleanTemp()
-
     proc.ConvertToDB()
-    proc.CleanTemp()
-
     proc.Write('GeoTiff')
-    proc.CleanTemp()
+
+    proc.Run()
@@ -1 +1,6 @@
 from .sentinel import *
+from .retry import *
+from .catalog import *
+from .results import *
+from .coverage import *
+from .lta import *
@@ -0,0 +1,221 @@
+"""
+A local SQLite catalog of search results from the Copernicus API.  The
+catalog remembers which time ranges of each query have already been
+searched, so repeated searches only need to ask the API for the part of the
+time range that has not been seen before.
+
+"""
+
+import json
+import re
+import sqlite3
+import threading
+
+
+class ProductCatalog:
+    """
+    Stores search result entries in a SQLite database with an index on the
+    acquisition time and an R-tree index on the bounding box of the footprint.
+
+    For every query (identified by the query string without its time range),
+    the catalog also stores the time ranges that have been completely synced
+    with the API and which products the API returned for it.  See
+    `CopernicusHub` for how the catalog is used to answer searches.
+
+    ARGUMENTS:
+        filename (string): Path to the SQLite database file.  It is created if
+            it does not exist.  Use ':memory:' for a temporary catalog.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS products (
+                                    id INTEGER PRIMARY KEY,
+                                    uuid TEXT UNIQUE,
+                                    title TEXT,
+                                    mission TEXT,
+                                    beam_mode TEXT,
+                                    product TEXT,
+                                    resolution TEXT,
+                                    level TEXT,
+                                    polarization TEXT,
+                                    abs_orbit INTEGER,
+                                    rel_orbit INTEGER,
+                                    begin_position TEXT,
+                                    end_position TEXT,
+                                    size TEXT,
+                                    footprint TEXT,
+                                    entry TEXT)''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS products_begin ON products(begin_position)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS products_end ON products(end_position)')
+
+            # Fall back to a regular table if SQLite was built without R-tree support
+            try:
+                self._db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS footprints USING rtree(id, min_lon, max_lon, min_lat, max_lat)')
+            except sqlite3.OperationalError:
+                self._db.execute('CREATE TABLE IF NOT EXISTS footprints (id INTEGER PRIMARY KEY, min_lon REAL, max_lon REAL, min_lat REAL, max_lat REAL)')
+
+            self._db.execute('''CREATE TABLE IF NOT EXISTS query_products (
+                                    query TEXT,
+                                    product_id INTEGER,
+                                    PRIMARY KEY (query, product_id))''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS synced (
+                                    query TEXT,
+                                    start TEXT,
+                                    end TEXT)''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS synced_query ON synced(query)')
+
+    def Close(self):
+        """ Closes the database connection. """
+        self._db.close()
+
+    def AddEntries(self, entries, query=None, parse_name=None):
+        """ Adds search result entries to the catalog.  Entries that are already
+            in the catalog are updated.
+
+            ARGUMENTS:
+                entries (list of dict): Entries returned by `CopernicusHub.Search`.
+                query (string, optional): The query that returned these entries.
+                parse_name (function, optional): Function used to extract
+                    information from the product titles, e.g.,
+                    `CopernicusHub.ParseName`.
+        """
+        with self._lock, self._db:
+            for entry in entries:
+                fields = dict()
+                if(parse_name is not None):
+                    try:
+                        fields = parse_name(entry['title'])
+                    except (RuntimeError, ValueError, IndexError):
+                        fields = dict()
+
+                strs = _GetEntryValues(entry, 'str')
+                dates = _GetEntryValues(entry, 'date')
+                footprint = strs.get('footprint', '')
+
+                row = (entry['id'], entry['title'],
+                       fields.get('ID'), fields.get('BeamMode'), fields.get('Product'),
+                       fields.get('Resolution'), fields.get('Level'), fields.get('Polarization'),
+                       fields.get('AbsOrbit'), fields.get('RelOrbit'),
+                       dates.get('beginposition', ''), dates.get('endposition', ''),
+                       strs.get('size'), footprint, json.dumps(entry))
+
+                self._db.execute('''INSERT INTO products (uuid, title, mission, beam_mode, product, resolution,
+                                                          level, polarization, abs_orbit, rel_orbit, begin_position,
+                                                          end_position, size, footprint, entry)
+                                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                                    ON CONFLICT(uuid) DO UPDATE SET entry=excluded.entry''', row)
+                product_id = self._db.execute('SELECT id FROM products WHERE uuid=?', (entry['id'],)).fetchone()[0]
+
+                bbox = _FootprintBounds(footprint)
+                if(bbox is not None):
+                    self._db.execute('DELETE FROM footprints WHERE id=?', (product_id,))
+                    self._db.execute('INSERT INTO footprints VALUES (?,?,?,?,?)', (product_id,) + bbox)
+
+                if(query is not None):
+                    self._db.execute('INSERT OR IGNORE INTO query_products VALUES (?,?)', (query, product_id))
+
+    def AddSynced(self, query, start, end):
+        """ Records that all products matching `query` with an end position
+            between `start` and `end` (ISO 8601 strings) are in the catalog.
+            Overlapping synced ranges are merged.
+        """
+        with self._lock, self._db:
+            rows = self._db.execute('SELECT start, end FROM synced WHERE query=? AND start<=? AND end>=?', (query, end, start)).fetchall()
+            for row_start, row_end in rows:
+                start = min(start, row_start)
+                end = max(end, row_end)
+            self._db.execute('DELETE FROM synced WHERE query=? AND start>=? AND end<=?', (query, start, end))
+            self._db.execute('INSERT INTO synced VALUES (?,?,?)', (query, start, end))
+
+    def GetMissing(self, query, start, end):
+        """ Returns a list of (start, end) time ranges between `start` and `end`
+            that have not been synced for `query`.  All times are ISO 8601 strings.
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT start, end FROM synced WHERE query=? AND start<=? AND end>=? ORDER BY start', (query, end, start)).fetchall()
+
+        missing = []
+        current = start
+        for row_start, row_end in rows:
+            if(row_start>current):
+                missing.append((current, row_start))
+            current = max(current, row_end)
+        if(current<end):
+            missing.append((current, end))
+        return missing
+
+    def Query(self, query=None, start=None, end=None, bbox=None, sort_dir='desc', rows=None):
+        """ Returns entries stored in the catalog.
+
+            ARGUMENTS:
+                query (string, optional): Only return products that the API
+                    returned for this query.
+                start, end (string, optional): Only return products with an end
+                    position in this range (ISO 8601 strings).
+                bbox (tuple, optional): (min_lon, max_lon, min_lat, max_lat).  Only
+                    return products whose footprint bounding box intersects it.
+                sort_dir (string, optional): Sort by begin position.  Either asc or desc.
+                rows (int, optional): Maximum number of entries to return.
+
+            RETURNS:
+                A list of entries in the same form as returned by `CopernicusHub.Search`.
+        """
+        assert sort_dir in ['asc','desc']
+
+        sql = 'SELECT products.entry FROM products'
+        conditions = []
+        params = []
+
+        if(query is not None):
+            sql += ' JOIN query_products ON query_products.product_id=products.id'
+            conditions.append('query_products.query=?')
+            params.append(query)
+
+        if(bbox is not None):
+            sql += ' JOIN footprints ON footprints.id=products.id'
+            conditions.append('footprints.max_lon>=? AND footprints.min_lon<=? AND footprints.max_lat>=? AND footprints.min_lat<=?')
+            params += [bbox[0], bbox[1], bbox[2], bbox[3]]
+
+        if(start is not None):
+            conditions.append('products.end_position>=?')
+            params.append(start)
+        if(end is not None):
+            conditions.append('products.end_position<=?')
+            params.append(end)
+
+        if(len(conditions)>0):
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY products.begin_position ' + sort_dir
+        if(rows is not None):
+            sql += ' LIMIT {}'.format(int(rows))
+
+        with self._lock:
+            return [json.loads(row[0]) for row in self._db.execute(sql, params)]
+
+
+def _GetEntryValues(entry, kind):
+    """ Returns a dictionary with the name/content pairs stored under the `kind`
+        key (e.g., 'str' or 'date') of a search result entry.
+    """
+    values = entry.get(kind, [])
+    if(isinstance(values, dict)):
+        values = [values]
+    return {value['name']:value['content'] for value in values}
+
+
+def _FootprintBounds(wkt):
+    """ Returns the (min_lon, max_lon, min_lat, max_lat) bounding box of a WKT
+        footprint, or None if it does not contain any coordinates.
+    """
+    coords = [float(c) for c in re.findall(r'[-+]?\d+\.?\d*(?:[eE][-+]?\d+)?', wkt)]
+    if(len(coords)<2):
+        return None
+    lons = coords[0::2]
+    lats = coords[1::2]
+    return (min(lons), max(lons), min(lats), max(lats))
+
@@ -0,0 +1,218 @@
+"""
+Tools for choosing which search results to download based on how much of a
+region of interest (ROI) their footprints cover.
+
+The `region=` option of `CopernicusHub.Search` returns every product whose
+footprint intersects the ROI, even if it only touches a corner.  The
+functions here compute the fraction of the ROI covered by each footprint
+and select the smallest set of products that covers the ROI.
+
+Coverage is computed by sampling the ROI on a regular longitude/latitude
+grid, weighting each sample by the cosine of its latitude so that the
+fractions approximate area.  Footprints crossing the antimeridian are not
+supported.
+
+"""
+
+import re
+import datetime
+import numpy as np
+
+from .catalog import _GetEntryValues
+
+
+# Maximum number of (entry, sample point) pairs processed at the same time
+_CHUNK_SIZE = 16*1024*1024
+
+
+def _ParseRings(wkt):
+    """ Returns a list of (N,2) arrays with the (lon,lat) vertices of each ring
+        in a WKT POLYGON or MULTIPOLYGON.
+    """
+    rings = []
+    for ring in re.findall(r'\(([^()]+)\)', wkt):
+        coords = np.array([float(c) for c in re.findall(r'[-+]?\d+\.?\d*(?:[eE][-+]?\d+)?', ring)])
+        if(len(coords)>=6):
+            rings.append(coords.reshape(-1,2))
+    return rings
+
+
+def _InsideRings(rings, lon, lat):
+    """ Returns a boolean array that is True for the points (lon, lat) that are
+        inside the polygon defined by `rings`.  Uses the even-odd rule, so holes
+        and the parts of multipolygons are handled.
+    """
+    inside = np.zeros(len(lon), dtype=bool)
+    for ring in rings:
+        x0, y0 = ring[:,0], ring[:,1]
+        x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+        for i in range(len(x0)):
+            crosses = (y0[i]>lat) != (y1[i]>lat)
+            if(not np.any(crosses)):
+                continue
+            x_cross = (x1[i]-x0[i]) * (lat[crosses]-y0[i]) / (y1[i]-y0[i]) + x0[i]
+            inside[crosses] ^= (lon[crosses] < x_cross)
+    return inside
+
+
+def _SampleRegion(region, resolution):
+    """ Returns the (lon, lat, weight) of grid points inside the ROI. """
+    if(len(region)<3):
+        raise RuntimeError('The region must be a polygon defined by at least 3 (lon,lat) points.')
+
+    pts = np.array(region, dtype=float)
+    lon, lat = np.meshgrid(np.linspace(pts[:,0].min(), pts[:,0].max(), resolution),
+                           np.linspace(pts[:,1].min(), pts[:,1].max(), resolution))
+    lon, lat = lon.ravel(), lat.ravel()
+
+    keep = _InsideRings([pts], lon, lat)
+    lon, lat = lon[keep], lat[keep]
+
+    # No grid point falls inside a very thin or small ROI, so use its vertices
+    if(len(lon)==0):
+        if(np.all(pts[0]==pts[-1])):
+            pts = pts[:-1]
+        lon, lat = pts[:,0], pts[:,1]
+
+    weight = np.cos(np.radians(lat))
+    if(weight.sum()<=0):
+        raise RuntimeError('Could not sample the region of interest.  Check that it is a polygon of (lon,lat) points.')
+
+    return lon, lat, weight / weight.sum()
+
+
+def _StackEdges(entries):
+    """ Returns the edges of the footprint rings of all entries as arrays
+        (x0, y0, x1, y1, owner), where owner is the index of the entry each
+        edge belongs to.  The edges are sorted by owner.
+    """
+    edges = []
+    owners = []
+    for i, entry in enumerate(entries):
+        for ring in _ParseRings(_GetEntryValues(entry, 'str').get('footprint', '')):
+            edges.append(np.hstack([ring, np.roll(ring, -1, axis=0)]))
+            owners.append(np.full(len(ring), i, dtype=np.int64))
+
+    if(len(edges)==0):
+        return np.zeros((4,0)), np.zeros(0, dtype=np.int64)
+    return np.vstack(edges).T, np.concatenate(owners)
+
+
+def CoverageMatrix(entries, region, resolution=100):
+    """ Computes which parts of the ROI are covered by each footprint.
+
+        ARGUMENTS:
+            entries (list of dict or SearchResults): Results from `CopernicusHub.Search`.
+            region (list of tuples): A list of (lon,lat) pairs defining the ROI,
+                in the same format as the `region` argument of `CopernicusHub.Search`.
+            resolution (int, optional): Number of samples along each axis of
+                the ROI bounding box.
+
+        RETURNS:
+            A tuple (covered, weight).  covered is a boolean array with one row
+            per entry and one column per sample point in the ROI.  weight holds
+            the area fraction of the ROI represented by each sample point.
+    """
+    lon, lat, weight = _SampleRegion(region, resolution)
+    (x0, y0, x1, y1), owner = _StackEdges(entries)
+
+    # The sample points lie on a grid of rows (latitudes) and columns (longitudes)
+    rows, row_index = np.unique(lat, return_inverse=True)
+    cols, col_index = np.unique(lon, return_inverse=True)
+
+    # Footprints are filled like scanlines: a point is inside if a ray from it
+    # towards +lon crosses an odd number of edges (the even-odd rule of
+    # `_InsideRings`).  The crossing of each edge with each row is computed
+    # once, and counted at the first column that lies east of it.  A reverse
+    # cumulative sum along the rows then gives the number of crossings east
+    # of every point.  The edges of a chunk of entries are processed together.
+    covered = np.zeros((len(entries), len(lon)), dtype=bool)
+    step = max(1, _CHUNK_SIZE // (len(rows)*(len(cols)+1)))
+    for first in range(0, len(entries), step):
+        num = min(step, len(entries)-first)
+        e = slice(*np.searchsorted(owner, [first, first+num]))
+
+        # Rows with min(y0,y1) <= lat < max(y0,y1) cross each edge
+        low = np.searchsorted(rows, np.minimum(y0[e], y1[e]), side='left')
+        high = np.searchsorted(rows, np.maximum(y0[e], y1[e]), side='left')
+        num_rows = high - low
+
+        edge = np.repeat(np.arange(e.start, e.stop), num_rows)
+        offsets = np.repeat(np.cumsum(num_rows) - num_rows, num_rows)
+        row = low[edge-e.start] + np.arange(len(edge)) - offsets
+
+        x_cross = (x1[edge]-x0[edge]) * (rows[row]-y0[edge]) / (y1[edge]-y0[edge]) + x0[edge]
+        col = np.searchsorted(cols, x_cross, side='left')
+
+        index = ((owner[edge]-first)*len(rows) + row)*(len(cols)+1) + col
+        counts = np.bincount(index, minlength=num*len(rows)*(len(cols)+1)).reshape(num, len(rows), len(cols)+1)
+        counts = (counts & 1).astype(np.uint8)
+
+        # Only the parity matters, so the sums may overflow
+        east = np.cumsum(counts[:,:,::-1], axis=2, dtype=np.uint8)[:,:,::-1]
+        covered[first:first+num] = (east[:, row_index, col_index+1] & 1).astype(bool)
+
+    return covered, weight
+
+
+def CoverageFraction(entries, region, resolution=100):
+    """ Returns an array with the fraction of the ROI covered by the footprint
+        of each entry.  See `CoverageMatrix` for a description of the arguments.
+    """
+    covered, weight = CoverageMatrix(entries, region, resolution)
+    return covered.astype(float) @ weight
+
+
+def SelectCovering(entries, region, target=0.95, window=datetime.timedelta(days=1), resolution=100):
+    """ Selects the smallest set of products that covers the ROI in each time
+        window.  Products are chosen greedily: the product that adds the most
+        uncovered area is chosen until the covered fraction reaches `target` or
+        no product adds any more area.
+
+        ARGUMENTS:
+            entries (list of dict or SearchResults): Results from `CopernicusHub.Search`.
+            region (list of tuples): A list of (lon,lat) pairs defining the ROI.
+            target (float, optional): Fraction of the ROI that should be covered
+                in each time window.
+            window (datetime.timedelta, optional): Length of the time windows.
+                Windows start at midnight UTC, so the default groups products by
+                day.  If None, all of the entries are treated as one window.
+            resolution (int, optional): Number of samples along each axis of
+                the ROI bounding box.
+
+        RETURNS:
+            A list of the selected entries, sorted by their begin position, that
+            can be passed to `CopernicusHub.Download`.
+    """
+    entries = list(entries)
+    if(len(entries)==0):
+        return []
+
+    covered, weight = CoverageMatrix(entries, region, resolution)
+
+    begin = np.array([_GetEntryValues(entry, 'date').get('beginposition', '')[:19] for entry in entries], dtype='datetime64[s]')
+    if(window is None):
+        groups = np.zeros(len(entries), dtype=np.int64)
+    else:
+        groups = (begin - np.datetime64('1970-01-01T00:00:00')) // np.timedelta64(int(window.total_seconds()), 's')
+
+    selected = []
+    for group in np.unique(groups):
+        candidates = np.flatnonzero(groups==group)
+        uncovered = np.ones(len(weight), dtype=bool)
+        fraction = 0.0
+
+        while(fraction<target and len(candidates)>0):
+            gains = (covered[candidates] & uncovered).astype(float) @ weight
+            best = np.argmax(gains)
+            if(gains[best]<=0):
+                break
+
+            choice = candidates[best]
+            selected.append(choice)
+            uncovered &= ~covered[choice]
+            fraction += gains[best]
+            candidates = np.delete(candidates, best)
+
+    selected = sorted(selected, key=lambda i: begin[i])
+    return [entries[i] for i in selected]
@@ -0,0 +1,198 @@
+"""
+Tools for downloading Sentinel products that have been moved to the Long Term
+Archive (LTA) of the Copernicus hub.
+
+Older products are "offline".  They can only be downloaded after a retrieval
+has been requested, and each user may only have a limited number of
+retrieval requests at a time.  `OfflineScheduler` requests retrievals within
+that quota, polls the requested products until they are online, and
+downloads every product as soon as it is available.
+
+"""
+
+import time
+import concurrent.futures
+
+
+class OfflineScheduler:
+    """
+    Downloads a mix of online and offline (LTA) products.
+
+    Online products are downloaded right away, in parallel.  For offline
+    products, retrievals are requested while staying within the user's quota.
+    Requested products are polled with a growing interval and downloaded as
+    soon as they come online, which frees a slot for the next retrieval.
+
+    ARGUMENTS:
+        hub (CopernicusHub): The hub used to check, request and download products.
+        folder (string): Path to folder where downloaded files should be placed.
+        max_requests (int, optional): Number of retrieval requests that may be
+            pending at the same time (the user's offline quota).
+        poll_interval (float, optional): Seconds to wait before first checking
+            if a requested product is online.  The interval doubles after each
+            check, up to `max_poll_interval`.
+        max_poll_interval (float, optional): Longest interval between checks
+            in seconds.
+        quota_wait (float, optional): Seconds to wait before requesting another
+            retrieval after the hub reports that the quota has been exceeded.
+        max_wait (float, optional): Seconds after the first retrieval request
+            of a product after which it is reported as failed if it is still
+            offline (or its retrieval is still refused), which frees its slot
+            in the quota.  If None, products are polled until they come online.
+        max_check_errors (int, optional): Number of consecutive failed online
+            checks after which a requested product is reported as failed.
+        max_workers (int, optional): Number of products downloaded at the same
+            time.  This is limited by the number of concurrent downloads allowed
+            by the hub.
+        **download_options: Additional arguments for the downloads, e.g.,
+            `segments` or `verify`.  See `CopernicusHub.Download`.
+
+    EXAMPLE:
+        matches = hub.Search(rows=None, type='GRD', start_date=..., end_date=...)
+        scheduler = OfflineScheduler(hub, 'sentinel-data')
+        filenames, errors = scheduler.Run(matches)
+    """
+
+    def __init__(self, hub, folder,
+                 max_requests=1,
+                 poll_interval=300.0,
+                 max_poll_interval=3600.0,
+                 quota_wait=1800.0,
+                 max_wait=24*3600.0,
+                 max_check_errors=5,
+                 max_workers=2,
+                 **download_options):
+
+        self.hub = hub
+        self.folder = folder
+        self.max_requests = max_requests
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.quota_wait = quota_wait
+        self.max_wait = max_wait
+        self.max_check_errors = max_check_errors
+        self.max_workers = max(1, min(max_workers, hub.max_downloads))
+        self.download_options = download_options
+        if('segments' in download_options):
+            self.download_options['segments'] = hub.LimitSegments(download_options['segments'], self.max_workers)
+
+    def Run(self, search_result):
+        """ Downloads all of the products, requesting retrievals for the offline
+            ones.  Returns when every product has been downloaded or has failed.
+
+            ARGUMENTS:
+                search_result (string, dict, list, SearchResults): The products to
+                    download.  See `CopernicusHub.Download`.
+
+            RETURNS:
+                A tuple (filenames, errors).  filenames has one entry for each
+                product, in the same order as the input, which is None if the
+                download failed.  errors is a dictionary mapping the url of each
+                failed product to an error message.
+        """
+        urls = self.hub.GetUrls(search_result)
+
+        filenames = [None]*len(urls)
+        errors = dict()
+
+        offline = []     # Offline products that have not been requested yet
+        first_request = dict() # index -> time of the first retrieval request
+        requested = dict() # index -> [time of next check, current poll interval, time of request, failed checks]
+        downloads = dict() # future -> index
+        quota_until = 0.0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+
+            def start_download(i):
+                future = pool.submit(self.hub.DownloadProduct, self.folder, urls[i], **self.download_options)
+                downloads[future] = i
+
+            # Start downloading the online products right away
+            for i, url in enumerate(urls):
+                try:
+                    if(self.hub.IsOnline(url)):
+                        start_download(i)
+                    else:
+                        offline.append(i)
+                except Exception as e:
+                    errors[url] = str(e)
+
+            print('{} products are online and {} are offline.'.format(len(downloads), len(offline)))
+
+            while(len(offline)>0 or len(requested)>0 or len(downloads)>0):
+                now = time.time()
+
+                # Request retrievals while there is room in the quota
+                while(len(offline)>0 and len(requested)<self.max_requests and now>=quota_until):
+                    i = offline[0]
+                    first_request.setdefault(i, now)
+                    try:
+                        accepted = self.hub.RequestRetrieval(urls[i])
+                    except Exception as e:
+                        errors[urls[i]] = str(e)
+                        offline.pop(0)
+                        continue
+
+                    if(accepted):
+                        print('Requested retrieval of {}'.format(urls[i]))
+                        offline.pop(0)
+                        requested[i] = [now+self.poll_interval, self.poll_interval, first_request[i], 0]
+                    elif(self.max_wait is not None and now-first_request[i]>=self.max_wait):
+                        errors[urls[i]] = 'The retrieval request was refused for {:0.0f}s.'.format(now-first_request[i])
+                        print('Giving up on {}.'.format(urls[i]))
+                        offline.pop(0)
+                    else:
+                        print('Offline quota exceeded.  Waiting {:0.0f}s before the next retrieval request.'.format(self.quota_wait))
+                        quota_until = now + self.quota_wait
+
+                # Check if any of the requested products are online yet
+                for i, (next_check, interval, request_time, failed_checks) in list(requested.items()):
+                    if(now<next_check):
+                        continue
+
+                    try:
+                        online = self.hub.IsOnline(urls[i])
+                        failed_checks = 0
+                    except Exception as e:
+                        failed_checks += 1
+                        if(failed_checks>=self.max_check_errors):
+                            errors[urls[i]] = 'Could not check if the product is online after {} attempts: {}'.format(failed_checks, e)
+                            del requested[i]
+                            continue
+                        print('Could not check {} ({}).  Trying again later.'.format(urls[i], e))
+                        online = False
+
+                    if(online):
+                        print('{} is online.'.format(urls[i]))
+                        del requested[i]
+                        start_download(i)
+                    elif(self.max_wait is not None and now-request_time>=self.max_wait):
+                        errors[urls[i]] = 'The product was still offline {:0.0f}s after its retrieval was requested.'.format(now-request_time)
+                        print('Giving up on {}.'.format(urls[i]))
+                        del requested[i]
+                    else:
+                        interval = min(2*interval, self.max_poll_interval)
+                        if(self.max_wait is not None):
+                            interval = min(interval, max(0.0, request_time+self.max_wait-now))
+                        requested[i] = [now+interval, interval, request_time, failed_checks]
+
+                # Collect the finished downloads
+                for future in [f for f in downloads if f.done()]:
+                    i = downloads.pop(future)
+                    try:
+                        filenames[i] = future.result()
+                    except Exception as e:
+                        errors[urls[i]] = str(e)
+
+                # Wait until a download finishes or it is time to check or request again
+                events = [r[0] for r in requested.values()]
+                if(len(offline)>0 and len(requested)<self.max_requests):
+                    events.append(quota_until)
+                timeout = max(0.1, min(events) - time.time()) if len(events)>0 else None
+
+                if(len(downloads)>0):
+                    concurrent.futures.wait(list(downloads), timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                elif(timeout is not None):
+                    time.sleep(timeout)
+
+        return filenames, errors
@@ -0,0 +1,204 @@
+"""
+A column-oriented container for Sentinel-1 search results.  Information
+parsed from the product names is stored in NumPy arrays so that large result
+sets can be filtered and sorted without looping over the entries in python.
+
+"""
+
+import re
+import numpy as np
+
+
+# Sentinel-1 product names have the form
+#   MMM_BB_TTTR_LFPP_YYYYMMDDTHHMMSS_YYYYMMDDTHHMMSS_OOOOOO_DDDDDD_CCCC
+# See https://sentinels.copernicus.eu/web/sentinel/user-guides/sentinel-1-sar/naming-conventions
+# Each line that is not a Sentinel-1 name still matches, with empty groups.
+_NAME_PATTERN = re.compile(r'^(?:(S1[A-D])_([A-Z0-9]{2})_([A-Z]{3})([A-Z_])_(\d)([A-Z])([A-Z]{2})_'
+                           r'(\d{8}T\d{6})_(\d{8}T\d{6})_(\d{6})_([0-9A-F]{6})_([0-9A-F]{4}))?.*$', re.MULTILINE)
+
+# Columns stored as integer codes into a list of categories
+_CATEGORICAL = ['mission', 'beam_mode', 'product', 'resolution', 'product_class', 'polarization']
+
+# Offsets used to compute the relative orbit from the absolute orbit
+_ORBIT_OFFSETS = {'S1A':73, 'S1B':27}
+
+
+def _Categorize(values):
+    """ Converts a list of strings to (codes, categories) where
+        categories[codes] == values.
+    """
+    categories, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+    return codes.astype(np.int16).ravel(), categories
+
+
+def _ToDatetime(stamps):
+    """ Converts a list of YYYYMMDDTHHMMSS strings to a datetime64 array.  Empty
+        strings become NaT.
+    """
+    iso = [s[0:4]+'-'+s[4:6]+'-'+s[6:8]+'T'+s[9:11]+':'+s[11:13]+':'+s[13:15] if s else 'NaT' for s in stamps]
+    return np.array(iso, dtype='datetime64[s]')
+
+
+def _ParseTitles(titles):
+    """ Parses a list of Sentinel-1 product names with a single regular
+        expression search over all of the names.
+
+        RETURNS:
+            A tuple (columns, categories) of dictionaries.  columns contains
+            one NumPy array per field, and categories contains the category
+            names of the categorical columns.
+    """
+    if(len(titles)==0):
+        matches = []
+    else:
+        matches = _NAME_PATTERN.findall('\n'.join([t.split('.')[0] for t in titles]))
+    fields = list(zip(*matches)) if len(matches)>0 else [()]*12
+
+    columns = dict()
+    categories = dict()
+    columns['title'] = np.array(titles, dtype=str)
+
+    for name, values in zip(['mission', 'beam_mode', 'product', 'resolution'], fields[0:4]):
+        columns[name], categories[name] = _Categorize(values)
+
+    columns['level'] = np.array([int(v) if v else -1 for v in fields[4]], dtype=np.int8)
+    columns['product_class'], categories['product_class'] = _Categorize(fields[5])
+    columns['polarization'], categories['polarization'] = _Categorize(fields[6])
+
+    columns['start_time'] = _ToDatetime(fields[7])
+    columns['end_time'] = _ToDatetime(fields[8])
+
+    columns['abs_orbit'] = np.array([int(v) if v else -1 for v in fields[9]], dtype=np.int32)
+    columns['datatake'] = np.array(fields[10], dtype=str)
+    columns['unique_id'] = np.array(fields[11], dtype=str)
+
+    # Relative orbit number (see https://forum.step.esa.int/t/sentinel-1-relative-orbit-from-filename/7042/2)
+    rel_orbit = np.full(len(titles), -1, dtype=np.int16)
+    mission = categories['mission'][columns['mission']] if len(titles)>0 else np.array([], dtype=str)
+    for name, offset in _ORBIT_OFFSETS.items():
+        mask = (mission==name)
+        rel_orbit[mask] = 1 + (columns['abs_orbit'][mask]-offset) % 175
+    columns['rel_orbit'] = rel_orbit
+
+    return columns, categories
+
+
+class SearchResults:
+    """
+    Stores the entries returned by `CopernicusHub.Search` together with the
+    information in their product names (see `CopernicusHub.ParseName`).  The
+    parsed fields are stored column-wise in NumPy arrays and can be accessed
+    as attributes, e.g., `results.rel_orbit` or `results.start_time`.
+
+    Indexing with an integer returns the original entry.  Indexing with a
+    slice, an array of indices, or a boolean mask returns a new SearchResults
+    object, so results can be filtered like NumPy arrays:
+
+        results = SearchResults(hub.Search(rows=None, type='GRD'))
+        hh = results[(results.polarization=='DH') & (results.rel_orbit==12)]
+        hub.Download('data', hh)
+
+    Available columns:
+        title, mission, beam_mode, product, resolution, level, product_class,
+        polarization, start_time, end_time, abs_orbit, rel_orbit, datatake,
+        unique_id
+
+    ARGUMENTS:
+        entries (list of dict): Entries returned by `CopernicusHub.Search`.
+    """
+
+    COLUMNS = ['title', 'mission', 'beam_mode', 'product', 'resolution', 'level',
+               'product_class', 'polarization', 'start_time', 'end_time',
+               'abs_orbit', 'rel_orbit', 'datatake', 'unique_id']
+
+    def __init__(self, entries):
+        self._entries = np.empty(len(entries), dtype=object)
+        self._entries[:] = list(entries)
+        self._columns, self._categories = _ParseTitles([entry['title'] for entry in self._entries])
+
+    @classmethod
+    def _FromColumns(cls, entries, columns, categories):
+        """ Creates a SearchResults object from already parsed columns. """
+        results = cls.__new__(cls)
+        results._entries = entries
+        results._columns = columns
+        results._categories = categories
+        return results
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __getattr__(self, name):
+        if(name.startswith('_') or name not in self._columns):
+            raise AttributeError(name)
+
+        if(name in _CATEGORICAL):
+            return self._categories[name][self._columns[name]]
+        return self._columns[name]
+
+    def __getitem__(self, index):
+        if(isinstance(index, (int, np.integer))):
+            return self._entries[index]
+
+        columns = {name:values[index] for name, values in self._columns.items()}
+        return SearchResults._FromColumns(self._entries[index], columns, self._categories)
+
+    def __repr__(self):
+        return 'SearchResults({} products)'.format(len(self))
+
+    def Filter(self, **kwargs):
+        """ Returns the results where every given column has the given value or
+            one of a list of values, e.g.,
+                results.Filter(beam_mode='EW', rel_orbit=[12, 99])
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for name, values in kwargs.items():
+            if(name not in self._columns):
+                raise KeyError('Unknown column "{}".  Valid columns are {}'.format(name, self.COLUMNS))
+
+            values = np.atleast_1d(values)
+            if(name in _CATEGORICAL):
+                codes = np.flatnonzero(np.isin(self._categories[name], values))
+                mask &= np.isin(self._columns[name], codes)
+            else:
+                mask &= np.isin(self._columns[name], values)
+
+        return self[mask]
+
+    def Sort(self, column='start_time', descending=False):
+        """ Returns the results sorted by a column.  The sort is stable. """
+        values = getattr(self, column)
+        order = np.argsort(values, kind='stable')
+        if(descending):
+            order = order[::-1]
+        return self[order]
+
+    def GetInfo(self, index):
+        """ Returns a dictionary with the information parsed from the name of one
+            product, with the same keys as `CopernicusHub.ParseName`.  The
+            dictionary is only created when this function is called.
+        """
+        cols = self._columns
+        cats = self._categories
+
+        out = dict()
+        out['ID'] = str(cats['mission'][cols['mission'][index]])
+        out['BeamMode'] = str(cats['beam_mode'][cols['beam_mode'][index]])
+        out['Product'] = str(cats['product'][cols['product'][index]])
+        if(out['Product']=='GRD'):
+            out['Resolution'] = str(cats['resolution'][cols['resolution'][index]])
+        out['Level'] = str(cols['level'][index])
+        out['Polarization'] = str(cats['polarization'][cols['polarization'][index]])
+        out['StartTime'] = cols['start_time'][index].astype(object)
+        out['EndTime'] = cols['end_time'][index].astype(object)
+        out['AbsOrbit'] = int(cols['abs_orbit'][index])
+        if(out['ID'] in _ORBIT_OFFSETS):
+            out['RelOrbit'] = int(cols['rel_orbit'][index])
+        return out
+
+    def ToList(self):
+        """ Returns a list of the entries, e.g., to pass to `CopernicusHub.Download`. """
+        return list(self._entries)
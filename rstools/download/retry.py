@@ -0,0 +1,98 @@
+"""
+Retry and backoff policy for the HTTP requests sent by the download tools.
+
+"""
+
+import email.utils
+import random
+import time
+
+
+class RetryPolicy:
+    """
+    Describes when and how long to wait before a failed HTTP request is tried
+    again.  The delay grows exponentially with the number of attempts and is
+    randomized ("jitter") so that concurrent workers do not all retry at the
+    same moment.
+
+    ARGUMENTS:
+        max_retries (int, optional): Maximum number of times a request is
+            retried before giving up.
+        backoff_factor (float, optional): Delay in seconds before the first
+            retry.  The delay doubles with every subsequent attempt.
+        max_backoff (float, optional): Upper limit on the delay in seconds.
+        jitter (float, optional): Fraction of the delay that is randomized.
+            With jitter=0.5, the delay is drawn from [0.5*d, d].
+        retry_statuses (tuple of int, optional): HTTP status codes that are
+            retried.  By default, "Too Many Requests" and server errors.
+        respect_retry_after (bool, optional): Whether to wait for the time
+            given in the "Retry-After" header when the server provides one.
+        timeout (float or tuple, optional): Connect and read timeout in seconds
+            passed to each request.  Timeouts are retried like connection
+            errors.
+    """
+
+    def __init__(self,
+                 max_retries=5,
+                 backoff_factor=2.0,
+                 max_backoff=300.0,
+                 jitter=0.5,
+                 retry_statuses=(429, 500, 502, 503, 504),
+                 respect_retry_after=True,
+                 timeout=(30, 300)):
+
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+        self.respect_retry_after = respect_retry_after
+        self.timeout = timeout
+
+    def CanRetry(self, attempt):
+        """ Returns True if another attempt is allowed after attempt number
+            `attempt` (starting at 0) failed.
+        """
+        return attempt < self.max_retries
+
+    def RetryStatus(self, status_code):
+        """ Returns True if a response with this HTTP status code should be retried.
+        """
+        return status_code in self.retry_statuses
+
+    def GetDelay(self, attempt, response=None):
+        """ Returns the number of seconds to wait after attempt number `attempt`
+            (starting at 0) failed.
+
+            ARGUMENTS:
+                attempt (int): The number of the attempt that failed.
+                response (requests.Response, optional): The failed response.  If it
+                    contains a "Retry-After" header, that delay is used instead.
+        """
+        if(self.respect_retry_after and response is not None):
+            retry_after = self._ParseRetryAfter(response.headers.get('retry-after'))
+            if(retry_after is not None):
+                return min(retry_after, self.max_backoff)
+
+        delay = min(self.backoff_factor * 2.0**attempt, self.max_backoff)
+        return delay * (1.0 - self.jitter*random.random())
+
+    def _ParseRetryAfter(self, value):
+        """ Converts the value of a "Retry-After" header, which is either a
+            number of seconds or an HTTP date, to a delay in seconds.
+        """
+        if(value is None):
+            return None
+
+        value = value.strip()
+        if(value.isdigit()):
+            return float(value)
+
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if(date is None):
+            return None
+
+        return max(0.0, date.timestamp() - time.time())
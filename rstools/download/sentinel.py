@@ -3,13 +3,139 @@ Tools for downloading Sentinel-1 SAR data using the [Copernicus Open Access API.
 
 """
 
+import math
+import glob
+import itertools
+import collections
+import hashlib
 import numbers
 import requests
+import urllib3
 import datetime
 import time
 from tqdm import tqdm
 import os
 import re
+import json
+import zlib
+import struct
+import threading
+import concurrent.futures
+
+from .retry import RetryPolicy
+from .catalog import ProductCatalog
+from .results import SearchResults
+from .zipindex import _TAIL_SIZE, _LOCAL_HEADER_SIZE, _ParseZipDirectory, _SafeRoot, _MatchMember
+
+
+# Reads taking longer than this (in seconds) are counted as stalls
+_STALL_SECONDS = 5.0
+
+# Minimum time (in seconds) between updates of the download progress bar
+_PROGRESS_INTERVAL = 0.5
+
+# Number of bytes requested from the socket in each read
+_READ_SIZE = 1024*1024
+
+# Maximum number of search results the API returns per request
+_MAX_PAGE_SIZE = 100
+
+
+class _IncompleteDownload(IOError):
+    """ Raised when a transfer ends before the whole file has been received.
+        The partial file is kept so that the download can be resumed.
+    """
+    pass
+
+
+class _RetryableStatus(_IncompleteDownload):
+    """ Raised when a download request receives a status code that the retry
+        policy retries (e.g., 429 or 503).  The closed response is kept so
+        that its status and Retry-After header can be used and reported.
+    """
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.retry_after = response.headers.get('retry-after')
+        super().__init__('Received error code {} from API.'.format(response.status_code))
+
+
+class _RemoteChanged(_IncompleteDownload):
+    """ Raised when a range request shows that the remote file is no longer
+        the one the partial file was started from.  The partial file is
+        discarded and the download is restarted from the beginning.
+    """
+    pass
+
+
+def _FormatTime(time):
+    """ Converts a datetime or date to the ISO 8601 format used by the API. """
+    if(type(time) is datetime.date):
+        return time.strftime('%Y-%m-%dT00:00:00.000Z')
+    return time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def _ParseTime(time_str):
+    """ Converts an ISO 8601 string returned by the API to a datetime. """
+    return datetime.datetime.strptime(time_str[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def _HashFile(filename, algorithm='md5', size=None, block_size=8*1024*1024):
+    """ Returns a hashlib object updated with the first `size` bytes of a file
+        (or the whole file if size is None).
+    """
+    hasher = hashlib.new(algorithm)
+    remaining = size
+    with open(filename, 'rb') as f:
+        while(remaining is None or remaining>0):
+            data = f.read(block_size if remaining is None else min(block_size, remaining))
+            if(not data):
+                break
+            hasher.update(data)
+            if(remaining is not None):
+                remaining -= len(data)
+    return hasher
+
+
+class DownloadStats:
+    """
+    Throughput statistics for the download of one product.  See the
+    `stats_callback` argument of `CopernicusHub.Download`.
+
+    ATTRIBUTES:
+        url (string): The download URL.
+        filename (string): Name of the downloaded file.
+        bytes (int): Number of bytes received, including bytes received in
+            failed attempts that were kept in the partial file.
+        seconds (float): Wall time spent downloading, including retries.
+        ttfb (float): Time to first byte in seconds, measured from the first
+            request of the first attempt.
+        stalls (int): Number of socket reads that took longer than 5 seconds.
+        attempts (int): Number of attempts needed.
+        mbps (float): Average throughput in megabytes per second.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.filename = None
+        self.bytes = 0
+        self.seconds = 0.0
+        self.ttfb = None
+        self.stalls = 0
+        self.attempts = 0
+        self.request_time = None
+        self.lock = threading.Lock()
+
+    @property
+    def mbps(self):
+        if(self.seconds<=0):
+            return 0.0
+        return self.bytes / 1e6 / self.seconds
+
+    def __repr__(self):
+        ttfb = 'n/a' if self.ttfb is None else '{:0.2f}s'.format(self.ttfb)
+        return 'DownloadStats({}: {:0.1f}MB in {:0.1f}s, {:0.2f}MB/s, ttfb {}, {} stalls, {} attempts)'.format(
+                    self.filename, self.bytes/1e6, self.seconds, self.mbps, ttfb, self.stalls, self.attempts)
 
 
 class CopernicusHub:
@@ -22,17 +148,124 @@ class CopernicusHub:
         password (string): Your Copernicus password.  Note that you should not
             store this in your code.  Instead, use the standard python
             getpass() function to enter the password.
+        platform (string, optional): The platform to search for.
+        max_downloads (int, optional): The maximum number of concurrent
+            downloads allowed by the hub for a single user.  The Copernicus
+            open access hub allows 2.
+        pool_size (int, optional): The maximum number of connections kept
+            open to the hub.  Connections are reused between requests.
+        retry_policy (RetryPolicy, optional): Controls how failed requests are
+            retried.  If None, the default `RetryPolicy()` is used.
+        catalog (string or ProductCatalog, optional): A local catalog (or the
+            filename of one) used to answer repeated searches.  When a catalog
+            is used, `Search` only asks the API for the part of the requested
+            time range that has not been searched before with the same
+            keywords, and answers the rest from the catalog.
+        sync_delay (datetime.timedelta, optional): Products appear in the API
+            some time after they are acquired.  Time ranges more recent than
+            this are never marked as synced in the catalog, so they are
+            searched again next time.
+        buffer_size (int, optional): Size in bytes of the buffer that downloaded
+            data is collected in before it is written to disk.  Each download
+            connection allocates one buffer and reuses it.
     """
 
-    def __init__(self, username, password, platform='Sentinel-1'):
+    def __init__(self, username, password, platform='Sentinel-1', max_downloads=2, pool_size=10, retry_policy=None,
+                 catalog=None, sync_delay=datetime.timedelta(days=1), buffer_size=8*1024*1024):
         self._user = username
         self._pass = password
         self._url_search = 'https://scihub.copernicus.eu/dhus/search'
         self._url_data = 'https://scihub.copernicus.eu/dhus/odata/v1'
         self._platform  = platform
+        self._max_downloads = max_downloads
+        self._buffer_size = buffer_size
+
+        # Statistics of the downloads, indexed by url
+        self.download_stats = dict()
+
+        if(retry_policy is None):
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+
+        # All requests share one session so that connections are kept alive
+        self._session = requests.Session()
+        self._session.auth = (self._user, self._pass)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+        if(isinstance(catalog, str)):
+            catalog = ProductCatalog(catalog)
+        self.catalog = catalog
+        self._sync_delay = sync_delay
+
+        # When any request receives "Too Many Requests" (HTTP 429), all threads
+        # wait until this time before sending another request.
+        self._backoff_lock = threading.Lock()
+        self._backoff_until = 0.0
+
+    def _WaitForBackoff(self):
+        """ Blocks until the shared backoff period set by `_TooManyRequests` has passed.
+        """
+        while True:
+            with self._backoff_lock:
+                delay = self._backoff_until - time.time()
+            if(delay<=0):
+                return
+            time.sleep(delay)
+
+    def _TooManyRequests(self, delay):
+        """ Called when a request receives HTTP 429.  Pauses all requests from
+            this hub for `delay` seconds.
+        """
+        with self._backoff_lock:
+            self._backoff_until = max(self._backoff_until, time.time() + delay)
 
+    def _Request(self, url, retry=True, **kwargs):
+        """ Sends a GET request through the pooled session and retries it
+            according to the retry policy.  Connection errors, timeouts and the
+            status codes listed in the policy are retried.  The last response
+            is returned, whatever its status code.
 
-    def ParseName(self,name):
+            ARGUMENTS:
+                url (string): The url to request.
+                retry (bool): Whether to retry the request.  Downloads are
+                    retried (and resumed) by `_download_from_url` instead, so
+                    they send a single request.
+                **kwargs: Additional arguments passed to `requests.Session.get`.
+        """
+        kwargs.setdefault('timeout', self.retry_policy.timeout)
+
+        attempt = 0
+        while True:
+            self._WaitForBackoff()
+
+            try:
+                r = self._session.get(url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if(not retry or not self.retry_policy.CanRetry(attempt)):
+                    raise
+                delay = self.retry_policy.GetDelay(attempt)
+                print('Request failed ({}).  Waiting {:0.0f}s and trying again'.format(e, delay))
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            if(not retry or not self.retry_policy.RetryStatus(r.status_code) or not self.retry_policy.CanRetry(attempt)):
+                return r
+
+            delay = self.retry_policy.GetDelay(attempt, r)
+            r.close()
+            print('Received error code {} from API.  Waiting {:0.0f}s and trying again'.format(r.status_code, delay))
+            if(r.status_code==429):
+                self._TooManyRequests(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+
+    @staticmethod
+    def ParseName(name):
         """
         Parses information from a Sentinel filename (e.g., S1A_IW_GRDH_1SDV_20200629T174145_20200629T174210_033235_03D9B9_D763)
         Returns a dictionary with information.  Currently only supports Sentinel-1 names.
@@ -66,13 +299,30 @@ class CopernicusHub:
             out['RelOrbit'] = 1+(out['AbsOrbit']-27) % 175
         return out
 
-    def Search(self, rows=10, sort_dir='desc', **kwargs):
+    def Search(self, rows=10, sort_dir='desc', shards=None, shard_width=None, max_workers=4, **kwargs):
         """ Search for Sentinel-1 data in a particular region and a particular
            time period.
 
            ARGUMENTS:
-            rows (int, optional): Maximum number of results to return
+            rows (int, optional): Maximum number of results to return.  If None,
+                all matching results are returned.  More than 100 results are
+                requested in several pages.
             sort_dir (string,optional): How to sort the results.  Either asc or desc
+            shards (int or 'auto', optional): If provided, the time period is
+                split into this many intervals that are searched concurrently.
+                With 'auto', the number of intervals is chosen from the total
+                number of matching products so that each interval fits in
+                about one page of results.  If `rows` is given, the search stops
+                once the intervals searched so far hold the first `rows`
+                products.  The time period is split on the end position of
+                the products (which `start_date` and `end_date` apply to), so
+                sharded results are sorted by end position instead of begin
+                position.
+            shard_width (datetime.timedelta, optional): Alternatively, the
+                length of each of the concurrently searched time intervals.
+            max_workers (int, optional): Maximum number of intervals searched
+                at the same time.  When a catalog is used, the parts of the time
+                range that are not in the catalog are searched this way.
 
             **kwargs: Additional keywords for search.  Typical keys include:
                     - start_date (datetime.date)
@@ -94,26 +344,218 @@ class CopernicusHub:
                     - "polarisationmode" (e.g., 'HH', 'VV', 'HV', 'VH', 'HH HV', 'VV VH')
 
           RETURNS:
+            A list of dictionaries, one for each product, as returned by the API.
+            At most `rows` products are returned.  Use `SearchIter` to get all
+            of the products matching the query.
+        """
+        assert sort_dir in ['asc','desc']
 
+        if(shards is not None and shards!='auto' and (not isinstance(shards, numbers.Integral) or shards<1)):
+            raise ValueError('shards must be "auto" or an integer of at least 1, not {}.'.format(shards))
+        if(shard_width is not None and shard_width.total_seconds()<=0):
+            raise ValueError('shard_width must be a positive time interval, not {}.'.format(shard_width))
+
+        if(self.catalog is not None):
+            return self._CatalogSearch(rows, sort_dir, shards, shard_width, max_workers, kwargs)
+
+        if(shards is not None or shard_width is not None):
+            return self._ShardedSearch(sort_dir, shards, shard_width, max_workers, kwargs, rows)
+
+        # The API returns at most one page per request
+        if(rows is None or rows>_MAX_PAGE_SIZE):
+            return list(itertools.islice(self.SearchIter(sort_dir=sort_dir, **kwargs), rows))
+
+        qString = self._GetQueryString(kwargs)
+
+        entries, total = self._SearchPage(qString, 0, rows, sort_dir)
+        return entries
+
+    def _CatalogSearch(self, rows, sort_dir, shards, shard_width, max_workers, opts):
+        """ Answers a search using the local catalog.  Only the parts of the
+            time range that have not been synced for this query are requested
+            from the API.  The entries found there are added to the catalog
+            before the catalog is queried.
         """
-        max_tries = 5
+        opts = dict(opts)
+        start = opts.pop('start_date', None)
+        end = opts.pop('end_date', None)
+
+        # The query without its time range identifies the search in the catalog
+        query = self._GetQueryString(opts)
+
+        if(start is None):
+            start = datetime.datetime(2014,4,3) # Launch of Sentinel-1A
+        now = datetime.datetime.utcnow()
+        if(end is None):
+            end = now
+        start_str = _FormatTime(start)
+        end_str = _FormatTime(end)
+
+        # Only time ranges that the API should be done with are marked as synced
+        synced_end = _FormatTime(min(_ParseTime(end_str), now - self._sync_delay))
+
+        for gap_start, gap_end in self.catalog.GetMissing(query, start_str, end_str):
+            gap_opts = dict(opts)
+            gap_opts['start_date'] = _ParseTime(gap_start)
+            gap_opts['end_date'] = _ParseTime(gap_end)
+
+            if(shards is not None or shard_width is not None):
+                entries = self._ShardedSearch(sort_dir, shards, shard_width, max_workers, gap_opts)
+            else:
+                entries = list(self.SearchIter(sort_dir=sort_dir, **gap_opts))
+            self.catalog.AddEntries(entries, query, self.ParseName)
+
+            if(gap_start<synced_end):
+                self.catalog.AddSynced(query, gap_start, min(gap_end, synced_end))
+
+        bbox = None
+        if('region' in opts):
+            region = opts['region']
+            if isinstance(region[0], numbers.Number):
+                bbox = (region[0], region[0], region[1], region[1])
+            else:
+                bbox = (min([p[0] for p in region]), max([p[0] for p in region]),
+                        min([p[1] for p in region]), max([p[1] for p in region]))
+
+        return self.catalog.Query(query, start_str, end_str, bbox, sort_dir, rows)
+
+    def _ShardedSearch(self, sort_dir, shards, shard_width, max_workers, opts, rows=None):
+        """ Splits the time period of a search into several intervals, searches
+            all of the intervals concurrently, and merges the results.  Products
+            found in more than one interval are only returned once.
+
+            The intervals are ranges of end position, since that is what the
+            time period of a query applies to (see `_GetQueryString`).  The
+            results of each interval are requested and merged in the order of
+            their end position, so that the intervals do not overlap in the
+            sort order.  If `rows` is given, at most `rows` products are read
+            from each interval, and intervals are merged in the order given by
+            `sort_dir`.  No new interval is started once the merged intervals
+            contain `rows` products, since later intervals cannot contain any
+            of the first `rows` products.
 
+            RETURNS:
+                A list with the matching entries (at most `rows`) sorted by
+                their end position in the order given by `sort_dir`.
+        """
+        start = opts.get('start_date')
+        if(start is None):
+            start = datetime.datetime(2014,4,3) # Launch of Sentinel-1A
+        end = opts.get('end_date')
+        if(end is None):
+            end = datetime.datetime.utcnow()
+
+        # Work with datetimes, even if dates were provided
+        start = datetime.datetime(start.year, start.month, start.day, *start.timetuple()[3:6])
+        end = datetime.datetime(end.year, end.month, end.day, *end.timetuple()[3:6])
+
+        if(shard_width is None):
+            if(shards=='auto'):
+                page_size = _MAX_PAGE_SIZE
+                entries, total = self._SearchPage(self._GetQueryString(opts), 0, 1, sort_dir)
+                shards = min(max(1, int(math.ceil(total / page_size))), 64)
+            shard_width = (end-start) / shards
+
+        # Round the interval length up to whole seconds
+        shard_width = datetime.timedelta(seconds=max(1, math.ceil(shard_width.total_seconds())))
+
+        windows = []
+        window_start = start
+        while(window_start<end):
+            windows.append((window_start, min(window_start+shard_width, end)))
+            window_start += shard_width
+
+        # Search the windows in the order of the results
+        if(sort_dir=='desc'):
+            windows = windows[::-1]
+
+        def search_window(window):
+            window_opts = dict(opts)
+            window_opts['start_date'], window_opts['end_date'] = window
+            results = SearchIterator(self, self._GetQueryString(window_opts), _MAX_PAGE_SIZE, sort_dir, 'endposition')
+            return list(itertools.islice(results, rows))
+
+        # Remove products that appear in more than one window (e.g., on the boundary)
+        merged = dict()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # Only start a window when a worker is free, so the search can stop early
+            pending = collections.deque()
+            windows = iter(windows)
+            for window in itertools.islice(windows, max_workers):
+                pending.append(pool.submit(search_window, window))
+
+            while(len(pending)>0):
+                for entry in pending.popleft().result():
+                    merged[entry['id']] = entry
+
+                if(rows is not None and len(merged)>=rows):
+                    for future in pending:
+                        future.cancel()
+                    break
+
+                for window in itertools.islice(windows, 1):
+                    pending.append(pool.submit(search_window, window))
+
+        entries = sorted(merged.values(), key=lambda entry: self._GetEntryDate(entry, 'endposition'), reverse=(sort_dir=='desc'))
+        return entries if rows is None else entries[:rows]
+
+    def _GetEntryDate(self, entry, name):
+        """ Returns the string value of a date field (e.g., beginposition) in a
+            search result entry.  The API uses ISO 8601 strings, so the returned
+            values sort chronologically.
+        """
+        dates = entry.get('date', [])
+        if(isinstance(dates, dict)):
+            dates = [dates]
+        for date in dates:
+            if(date['name']==name):
+                return date['content']
+        return ''
+
+    def SearchIter(self, page_size=100, sort_dir='desc', **kwargs):
+        """ Iterates over all of the products matching a search, one page of
+            results at a time.  While the entries of one page are being used,
+            the next page is requested in the background.
+
+            ARGUMENTS:
+                page_size (int, optional): Number of results requested from the
+                    API at a time.  The API allows at most 100, so larger
+                    values are reduced to 100.
+                sort_dir (string,optional): How to sort the results.  Either asc or desc
+                **kwargs: Search keywords.  See `Search`.
+
+            RETURNS:
+                A `SearchIterator` that yields the entries one at a time.  The
+                total number of matching products is stored in its `total`
+                attribute.
+
+            EXAMPLE:
+                results = hub.SearchIter(type='GRD', region=poly)
+                print('Found {} products'.format(results.total))
+                for entry in results:
+                    print(entry['title'])
+        """
         assert sort_dir in ['asc','desc']
         qString = self._GetQueryString(kwargs)
 
-        query = {'q':qString, 'rows':rows, 'orderby':'beginposition '+sort_dir, 'format':'json'}
+        page_size = max(1, min(page_size, _MAX_PAGE_SIZE))
+        return SearchIterator(self, qString, page_size, sort_dir)
 
-        for num_tries in range(max_tries):
-            r = requests.get(self._url_search,auth=(self._user,self._pass),params=query)
-            if(r.status_code==200):
-                break
-            elif(r.status_code==429):
-                print('In Search Attempt {}:\n  Received "Too Many Attempts" from API.  Waiting 2s and trying again'.format(num_tries))
-                time.sleep(2)
-            else:
-                with open('api_error.html','wb') as f:
-                    f.write(r.content)
-                raise RuntimeError("Received error code {} from API.".format(r.status_code))
+    def _SearchPage(self, qString, start, rows, sort_dir, sort_by='beginposition'):
+        """ Requests a single page of search results from the API, sorted by
+            the date field `sort_by` (beginposition or endposition).
+
+            RETURNS:
+                A tuple (entries, total) containing a list of the entries on this
+                page and the total number of products matching the query.
+        """
+        query = {'q':qString, 'start':start, 'rows':rows, 'orderby':sort_by+' '+sort_dir, 'format':'json'}
+
+        r = self._Request(self._url_search, params=query)
+        if(r.status_code!=200):
+            with open('api_error.html','wb') as f:
+                f.write(r.content)
+            raise RuntimeError("Received error code {} from API.".format(r.status_code))
 
         d = r.json()
 
@@ -123,91 +565,838 @@ class CopernicusHub:
         if 'error' in d['feed'].keys():
             raise RuntimeError("Received error from code {} API:\n  {}".format(d['feed']['error']['code'], d['feed']['error']['message']))
 
+        total = int(d['feed'].get('opensearch:totalResults', 0))
+
         # Extract the available imagery
         if('entry' not in d['feed']):
-            return []
-        else:
-            return d['feed']['entry']
+            return [], total
+
+        # The API returns a single dictionary instead of a list if there is only one entry
+        entries = d['feed']['entry']
+        if(isinstance(entries, dict)):
+            entries = [entries]
+
+        return entries, total
 
 
-    def Download(self, folder, search_result):
+    def Download(self, folder, search_result, max_workers=1, return_errors=False, segments=1, verify=True, stats_callback=None, members=None):
         """ Downloads one or more results from the search.
 
             ARGUMENTS:
                 folder (string) : Path to folder where downloaded files should be placed.
-                search_result (string, dict, list of strings, list of dicts) : One or more
+                search_result (string, dict, list of strings, list of dicts, SearchResults) : One or more
                     outputs from the Search function.  If a string or list of strings, the
                     strings must be URLs to the copernicus open data API, e.g., https://scihub.copernicus.eu/dhus/odata/v1/Products('2b7dfd40-a838-423d-8c2e-d2daa7c0bc09')/$value
                     If dict or list of dicts, the search_result argument must be of the
                     form returned by the Search function.  i.e., there must a
                     list of urls stored under the 'link' key in the dictionary.
                     The download URL is search_result[i]['link'][0]['href'].
+                max_workers (int, optional) : Number of products to download at
+                    the same time.  This is limited by the number of concurrent
+                    downloads allowed by the hub (see `max_downloads` in the
+                    constructor).
+                return_errors (bool, optional) : If False, an exception is raised
+                    after all downloads have finished if any of them failed.  If
+                    True, the errors are returned instead.
+                segments (int, optional) : Number of connections used to download
+                    each product.  See `_download_from_url`.  Every segment
+                    counts towards the concurrent downloads allowed by the hub,
+                    so this is reduced if max_workers*segments would exceed
+                    that limit (see `LimitSegments`).
+                verify (bool, optional) : Whether to compare the checksum of each
+                    downloaded file with the checksum provided by the API.  Files
+                    that do not match are downloaded again.
+                stats_callback (function, optional) : Called with a `DownloadStats`
+                    object after each file has been downloaded.  The statistics
+                    are also stored in the `download_stats` dictionary of the
+                    hub, indexed by url.
+                members (list of strings, optional) : Only extract these files
+                    from each product zip instead of downloading the whole zip.
+                    Paths are relative to the SAFE folder.  Patterns ending with
+                    a slash select a whole folder, other patterns are matched
+                    with `fnmatch`.  For example,
+                        ['measurement/*-hh-*.tiff', 'annotation/']
+                    keeps the HH imagery with its annotation and calibration
+                    files.  The manifest.safe file is always extracted.  The
+                    result is a trimmed SAFE folder that SNAP can read.  This
+                    requires a server that supports range requests.
 
             RETURNS:
-                A list of strings containing the filenames of all the downloaded files.
-
+                If return_errors is False, a list of strings containing the
+                filenames of all the downloaded files (or the extracted SAFE
+                folders if `members` is given), in the same order as the
+                inputs.
+
+                If return_errors is True, a tuple (filenames, errors).  filenames
+                has one entry for each input, which is None if the download
+                failed.  errors is a dictionary mapping the url of each failed
+                download to an error message.
         """
 
         # Get all of the urls we need to download
-        urls=None
+        urls = self.GetUrls(search_result)
+
+        num_workers = max(1, min(max_workers, self._max_downloads, len(urls)))
+        segments = self.LimitSegments(segments, num_workers)
+
+        # With more than one worker, show a single progress bar for all downloads
+        progress = None
+        if(num_workers>1):
+            progress = tqdm(total=0, unit='iB', unit_scale=True)
+            progress.lock = threading.Lock()
+
+        filenames = [None]*len(urls)
+        errors = dict()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as pool:
+            futures = {pool.submit(self._download_from_url, folder, url, progress, segments, verify, stats_callback, members):i for i, url in enumerate(urls)}
+
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                try:
+                    filenames[i] = future.result()
+                except Exception as e:
+                    errors[urls[i]] = str(e)
+
+        if(progress is not None):
+            progress.close()
+
+        if(return_errors):
+            return filenames, errors
+
+        if(len(errors)>0):
+            msg = '\n'.join(['  {}:\n    {}'.format(url, err) for url, err in errors.items()])
+            raise RuntimeError('Failed to download {} of {} files:\n'.format(len(errors), len(urls)) + msg)
+
+        return [f for f in filenames if f is not None]
+
+    def DownloadProduct(self, folder, url, segments=1, verify=True, stats_callback=None, members=None, progress=None):
+        """ Downloads a single product and waits until it is complete.  This is
+            used by tools that schedule their own downloads (e.g.,
+            `OfflineScheduler` and `DownloadPipeline`), one product per thread.
+
+            ARGUMENTS:
+                folder (string) : Path to folder where the file should be placed.
+                url (string) : The download url of the product.  See `GetUrls`.
+                segments, verify, stats_callback, members : See `Download`.
+                progress (tqdm, optional) : A progress bar shared by several
+                    downloads.  If None, a progress bar is shown for this product.
+
+            RETURNS:
+                The name of the downloaded file (or of the extracted SAFE folder
+                if `members` is given).  Raises a RuntimeError if the download
+                failed.
+        """
+        return self._download_from_url(folder, url, progress, segments, verify, stats_callback, members)
+
+    def LimitSegments(self, segments, num_workers):
+        """ Returns the number of segments each of `num_workers` concurrent
+            downloads can use without opening more connections than the hub
+            allows (see `max_downloads`).  Prints a note if `segments` had to
+            be reduced.
+
+            ARGUMENTS:
+                segments (int) : The requested number of segments per download.
+                num_workers (int) : The number of products downloaded at the
+                    same time.
+
+            RETURNS:
+                The number of segments to use, which is at least one.
+        """
+        limit = max(1, self._max_downloads // max(1, num_workers))
+        if(segments>limit):
+            print('Using {} segments per download instead of {} to stay within the {} concurrent downloads allowed by the hub.'.format(limit, segments, self._max_downloads))
+            return limit
+        return max(1, segments)
+
+    @property
+    def max_downloads(self):
+        """ The number of concurrent downloads allowed by the hub. """
+        return self._max_downloads
+
+    def GetUrls(self, search_result):
+        """ Returns a list with the download url of each product in
+            `search_result`.  See `Download` for the accepted types.
+        """
+        if(isinstance(search_result, SearchResults)):
+            search_result = search_result.ToList()
+
         if(isinstance(search_result, list)):
-            if(isinstance(search_result[0],str)):
-                urls = search_result
+            if(len(search_result)==0):
+                return []
+            elif(isinstance(search_result[0],str)):
+                return search_result
             else:
-                urls = [res['link'][0]['href'] for res in search_result]
+                return [res['link'][0]['href'] for res in search_result]
         else:
             if(isinstance(search_result,str)):
-                urls = [search_result]
+                return [search_result]
             else:
-                urls = [search_result['link'][0]['href']]
+                return [search_result['link'][0]['href']]
+
+    def _GetProductInfo(self, url):
+        """ Returns the OData properties of a product (e.g., Checksum or Online)
+            as a dictionary, or None if they could not be retrieved.
+
+            ARGUMENTS:
+                url (string): The download URL of the product.
+        """
+        product_url = url.split('/$value')[0]
+        r = self._Request(product_url, params={'$format':'json'})
+        if(r.status_code!=200):
+            return None
+
+        try:
+            return r.json()['d']
+        except (ValueError, KeyError):
+            return None
+
+    def IsOnline(self, url):
+        """ Returns True if a product can be downloaded immediately, or False if
+            it is stored in the Long Term Archive (LTA) and has to be retrieved
+            first.  See `RequestRetrieval`.
+
+            ARGUMENTS:
+                url (string): The download URL of the product.
+        """
+        info = self._GetProductInfo(url)
+        if(info is None or 'Online' not in info):
+            raise RuntimeError('Could not determine if the product {} is online.'.format(url))
+        return bool(info['Online'])
+
+    def RequestRetrieval(self, url):
+        """ Asks the hub to restore an offline product from the Long Term
+            Archive.  The product becomes available for download some time
+            later (typically within a day).  See `OfflineScheduler` for a tool
+            that requests and downloads many offline products.
+
+            ARGUMENTS:
+                url (string): The download URL of the product.
+
+            RETURNS:
+                True if the request was accepted, or False if the user's quota
+                of retrieval requests has been exceeded.
+        """
+        # A rejected request is not retried, since the quota only frees up
+        # when an earlier retrieval completes.  Retrying would also pause the
+        # other requests of the hub after a 429.
+        r = self._Request(url, retry=False, stream=True)
+        r.close()
+
+        # The hub answers 202 (Accepted) for offline products, and 200 if the
+        # product is already online.
+        if(r.status_code in [200, 202]):
+            return True
+        if(r.status_code in [403, 429]):
+            return False
+        raise RuntimeError('Received error code {} from API when requesting retrieval of {}.'.format(r.status_code, url))
+
+    def GetChecksum(self, url):
+        """ Returns the checksum of a product provided by the OData API.
 
-        filenames = []
-        for url in urls:
-            res = self._download_from_url(folder,url)
-            if(res is not None):
-                filenames.append( res )
+            ARGUMENTS:
+                url (string): The download URL of the product, e.g.,
+                    https://scihub.copernicus.eu/dhus/odata/v1/Products('2b7dfd40-a838-423d-8c2e-d2daa7c0bc09')/$value
 
-        return filenames
+            RETURNS:
+                A tuple (algorithm, value), e.g., ('md5', '6a1b...'), or None if
+                the API does not provide a checksum for this product.
+        """
+        info = self._GetProductInfo(url)
+        try:
+            checksum = info['Checksum']
+            return checksum['Algorithm'].lower(), checksum['Value'].lower()
+        except (KeyError, TypeError):
+            return None
+
+    def VerifyArchive(self, folder, pattern='*.zip', max_workers=4):
+        """ Checks the products that have already been downloaded to a folder by
+            comparing their checksums with the checksums provided by the API.
+            The files are hashed in parallel.
 
+            ARGUMENTS:
+                folder (string): Folder containing the downloaded products.
+                pattern (string, optional): Glob pattern of the files to check.
+                max_workers (int, optional): Number of files hashed at the same time.
 
-    def _download_from_url(self,folder, url):
+            RETURNS:
+                A dictionary mapping each filename to True if the checksum
+                matches, False if it does not, or None if the API does not
+                provide a checksum for the product.
         """
-        Downloads the sentinel zip file from a url to a folder.
+        filenames = sorted(glob.glob(os.path.join(folder, pattern)))
+
+        def verify(filename):
+            name = os.path.basename(filename).split('.')[0]
+            r = self._Request(self._url_data + '/Products', params={'$filter':"Name eq '{}'".format(name), '$format':'json'})
+            if(r.status_code!=200):
+                return None
+            try:
+                checksum = r.json()['d']['results'][0]['Checksum']
+            except (ValueError, KeyError, IndexError, TypeError):
+                return None
+
+            hasher = _HashFile(filename, checksum['Algorithm'].lower())
+            return hasher.hexdigest()==checksum['Value'].lower()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(verify, filenames))
+
+        for filename, result in zip(filenames, results):
+            status = 'OK' if result else ('UNKNOWN' if result is None else 'CORRUPT')
+            print('{:8s} {}'.format(status, filename))
+
+        return {os.path.basename(f):res for f, res in zip(filenames, results)}
+
+    def _download_from_url(self,folder, url, progress=None, segments=1, verify=True, stats_callback=None, members=None):
         """
+        Downloads the sentinel zip file from a url to a folder.  If `progress`
+        is a tqdm progress bar, it is updated instead of creating a new progress
+        bar for this file.  This is used to show the combined progress of
+        concurrent downloads.
+
+        If `segments` is larger than one and the server supports range
+        requests, the file is split into that many byte ranges that are
+        downloaded over separate connections and written directly into their
+        place in a preallocated file.  Otherwise a single connection is used.
+        Note that each segment counts towards the number of concurrent
+        downloads allowed by the hub, so callers running several downloads at
+        once should limit `segments` with `LimitSegments`.  A partial file
+        left by a segmented download is resumed over at most `segments`
+        connections.
+
+        Data is written to `<filename>.part` and the file is renamed once it is
+        complete.  If a transfer fails, it is retried with an exponentially
+        growing delay and resumes from where the partial file left off.
+
+        If `verify` is True, the checksum of the file is computed while the
+        data is written and compared with the checksum provided by the API.
+        If they do not match, the partial file is discarded and the product is
+        downloaded again.  Segmented downloads are not written in order, so
+        they are hashed after the download has finished.
+
+        If `members` is a list of patterns, only the matching files are
+        extracted from the zip file into a SAFE folder (see `_extract_attempt`).
+        Each file is checked against the CRC stored in the zip instead of the
+        checksum of the whole product.
+
+        Throughput statistics are stored in `download_stats[url]` and passed to
+        `stats_callback` if it is provided.
+        """
+        stats = DownloadStats(url)
+        self.download_stats[url] = stats
+        start_time = time.time()
+
+        checksum = None
+        if(verify and members is None):
+            checksum = self.GetChecksum(url)
+            if(checksum is None):
+                print('The API did not provide a checksum for {}.  The download will not be verified.'.format(url))
+
+        attempt = 0
+        while True:
+            try:
+                stats.attempts += 1
+                if(members is None):
+                    stats.filename = self._download_attempt(folder, url, progress, segments, checksum, stats)
+                else:
+                    stats.filename = self._extract_attempt(folder, url, members, progress, stats)
+                stats.seconds = time.time() - start_time
+                if(stats_callback is not None):
+                    stats_callback(stats)
+                return stats.filename
+
+            except (_IncompleteDownload, requests.exceptions.RequestException) as e:
+                response = e.response if isinstance(e, _RetryableStatus) else None
+                if(not self.retry_policy.CanRetry(attempt)):
+                    if(response is not None):
+                        raise RuntimeError('Failed to download {} after {} attempts.  The last response was HTTP {} (Retry-After: {}).'.format(
+                                           url, attempt+1, e.status_code, e.retry_after if e.retry_after is not None else 'not given'))
+                    raise RuntimeError('Failed to download {} after {} attempts:\n  {}'.format(url, attempt+1, e))
+
+                delay = self.retry_policy.GetDelay(attempt, response)
+                print('Download attempt {} failed ({}).  Waiting {:0.0f}s and resuming.'.format(attempt+1, e, delay))
+                if(response is not None and response.status_code==429):
+                    self._TooManyRequests(delay)
+                else:
+                    time.sleep(delay)
+                attempt += 1
 
+    def _get_download(self, url, headers=None):
+        """ Sends a single streaming GET request for a product.  Status codes
+            that the retry policy retries raise `_RetryableStatus`, so that the
+            download is retried by `_download_from_url` only.
+        """
+        r = self._Request(url, retry=False, stream=True, headers=headers)
+        if(self.retry_policy.RetryStatus(r.status_code) or r.status_code>=500):
+            r.close()
+            raise _RetryableStatus(r)
+        return r
+
+    def _download_attempt(self, folder, url, progress, segments, checksum=None, stats=None):
+        """ Makes a single attempt at downloading a product, continuing an
+            existing partial download when the remote file has not changed.
+
+            The state of a partial download is stored next to the partial file
+            in `<filename>.part.json`.  It contains the ETag and size of the
+            remote file and a list of [next byte, last byte] ranges that still
+            need to be downloaded.  A partial file is only resumed if the server
+            sends an ETag and the ETag and size still match.  If a range request
+            shows that the remote file has changed since, the partial file is
+            discarded and `_RemoteChanged` is raised so that the next attempt
+            starts from the beginning.
+
+            If `checksum` is an (algorithm, value) tuple, the downloaded file is
+            checked against it.  If `stats` is a `DownloadStats` object, it is
+            updated as data is received.
+        """
+        if(stats is not None and stats.ttfb is None):
+            stats.request_time = time.time()
 
-        r = requests.get(url, stream=True, auth=(self._user,self._pass))
+        r = self._get_download(url)
         if('content-disposition' not in r.headers):
             msg = ''
             if('<message xml:lang="en">' in str(r.content)):
                 msg = str(r.content).split('<message xml:lang="en">')[1].split('</message>')[0]
 
-            raise RuntimeError('Failed to download file.  This is most likely because user offline quota has been exceeded.  Wait an hour and try again.\n\n'+msg )
+            hint = ''
+            if(r.status_code in [202, 403]):
+                hint = '  The product may be offline or the offline retrieval quota may have been exceeded.'
+            raise RuntimeError('Failed to download file.  The API answered with HTTP {} instead of the product.{}\n\n{}'.format(r.status_code, hint, msg))
 
         filename = r.headers['content-disposition'].split('=')[1][1:-1]
-
+        part_name = folder+'/'+filename + '.part'
+        info_name = part_name + '.json'
 
         total_size_in_bytes= int(r.headers.get('content-length', 0))
-        print('Downloading {}'.format(filename))
+        etag = r.headers.get('etag')
+        accepts_ranges = (r.headers.get('accept-ranges','')=='bytes') and (total_size_in_bytes>0)
+
+        # Check if there is a partial download of the same remote file.  Without
+        # an ETag there is no way to tell, so the download starts from scratch.
+        ranges = None
+        if(accepts_ranges and etag is not None and os.path.exists(part_name) and os.path.exists(info_name)):
+            with open(info_name) as f:
+                info = json.load(f)
+            if((info['etag']==etag) and (info['size']==total_size_in_bytes)):
+                ranges = info.get('ranges')
+
+        # Start from scratch
+        if(ranges is None):
+            ranges = [[0, total_size_in_bytes-1]]
+            with open(part_name, 'wb') as f:
+                pass
+
+        # Split whatever is left of a single stream download into segments
+        if(segments>1 and accepts_ranges and len(ranges)==1):
+            ranges = self._SplitRange(ranges[0][0], total_size_in_bytes, segments)
+
+        remaining = sum([end+1-start for start, end in ranges])
+        existing = total_size_in_bytes - remaining
+        if(existing>0):
+            print('Resuming {} at {:0.1f}MB'.format(filename, existing/1e6))
+        else:
+            print('Downloading {}'.format(filename))
 
-        block_size = 1024 #1 Kibibyte
-        progress_bar = tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True)
+        if(progress is None):
+            progress_bar = tqdm(total=total_size_in_bytes, initial=existing, unit='iB', unit_scale=True)
+            progress_bar.lock = threading.Lock()
+        else:
+            progress_bar = progress
+            with progress.lock:
+                progress.total += remaining
+                progress.refresh()
+
+        hasher = None
+        discard = False
+        try:
+            if(len(ranges)>1):
+                r.close()
+
+                # Preallocate the whole file so each segment can write in place
+                with open(part_name, 'r+b') as f:
+                    if(hasattr(os, 'posix_fallocate')):
+                        os.posix_fallocate(f.fileno(), 0, total_size_in_bytes)
+                    else:
+                        f.truncate(total_size_in_bytes)
+
+                # The missing ranges of a partial file written over several
+                # connections may outnumber the segments we are allowed to use.
+                with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(ranges), segments))) as pool:
+                    futures = [pool.submit(self._download_range, url, etag, part_name, rng, total_size_in_bytes, progress_bar, None, stats) for rng in ranges]
+                    errors = [future.exception() for future in futures]
+
+                errors = [e for e in errors if e is not None]
+                errors.sort(key=lambda e: not isinstance(e, _RemoteChanged))
+                if(len(errors)>0):
+                    raise errors[0]
+
+            elif(remaining>0 or total_size_in_bytes==0):
+                # Hash the data as it is written.  When resuming, the part of
+                # the file that already exists has to be hashed first.
+                if(checksum is not None):
+                    hasher = _HashFile(part_name, checksum[0], existing)
+
+                if(existing>0):
+                    r.close()
+                    r = None
+                    self._download_range(url, etag, part_name, ranges[0], total_size_in_bytes, progress_bar, hasher, stats)
+                else:
+                    self._write_stream(r, part_name, 0, ranges[0], progress_bar, hasher, stats)
 
-        with open(folder+'/'+filename + '.part', 'wb') as file:
-            for data in r.iter_content(block_size):
-                progress_bar.update(len(data))
-                file.write(data)
-        progress_bar.close()
+        except _RemoteChanged:
+            # The data written so far belongs to another version of the file
+            discard = True
+            raise
 
-        if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
-            print("ERROR, something went wrong and only part of the file was downloaded.")
-        else:
-            os.rename(folder+'/'+filename + '.part', folder+'/'+filename)
+        finally:
+            if(r is not None):
+                r.close()
+
+            if(discard):
+                os.remove(part_name)
+                if(os.path.exists(info_name)):
+                    os.remove(info_name)
+            else:
+                with open(info_name, 'w') as f:
+                    json.dump({'etag':etag, 'size':total_size_in_bytes, 'ranges':ranges}, f)
+
+            remaining = sum([end+1-start for start, end in ranges])
+            if(progress is None):
+                progress_bar.close()
+            elif(remaining>0):
+                # Remove the bytes that were not received from the combined total
+                with progress.lock:
+                    progress.total -= remaining
+                    progress.refresh()
+
+        if total_size_in_bytes != 0 and remaining != 0:
+            raise _IncompleteDownload("{} of {} bytes of {} are still missing.".format(remaining, total_size_in_bytes, filename))
+
+        if(checksum is not None):
+            if(hasher is None):
+                hasher = _HashFile(part_name, checksum[0])
+
+            if(hasher.hexdigest()!=checksum[1]):
+                os.remove(part_name)
+                os.remove(info_name)
+                raise _IncompleteDownload('The {} checksum of {} does not match the API.  The file was discarded.'.format(checksum[0], filename))
+
+        os.rename(part_name, folder+'/'+filename)
+        os.remove(info_name)
 
         print(' ')
 
         return filename
 
+    def _extract_attempt(self, folder, url, members, progress, stats=None):
+        """ Makes a single attempt at extracting the files matching `members`
+            from a product zip file.  The central directory at the end of the
+            zip is read with a range request, and only the bytes of the
+            selected files are downloaded.  Selected files that are next to
+            each other in the zip are fetched with a single request.
+
+            Files are decompressed while they are received and written to
+            `<folder>/<SAFE name>/`.  Files that were completely extracted in
+            a previous attempt are skipped.
+
+            RETURNS:
+                The name of the SAFE folder, relative to `folder`.
+        """
+        if(stats is not None and stats.ttfb is None):
+            stats.request_time = time.time()
+
+        # Read the end of the zip file, which contains the central directory
+        r = self._get_download(url, {'Range':'bytes=-{}'.format(_TAIL_SIZE)})
+        try:
+            if((r.status_code!=206) or ('content-disposition' not in r.headers)):
+                raise RuntimeError('The server did not accept a range request for {}.  Download the whole product instead.'.format(url))
+
+            filename = r.headers['content-disposition'].split('=')[1][1:-1]
+            etag = r.headers.get('etag')
+            total_size = int(r.headers['content-range'].split('/')[1])
+            tail = r.content
+        finally:
+            r.close()
+
+        entries = _ParseZipDirectory(tail, total_size-len(tail), lambda start, end: self._read_range(url, etag, start, end, total_size))
+
+        # Extract into the SAFE folder stored in the zip, or a folder named
+        # after the zip if it has no top level folder
+        root = _SafeRoot(entries)
+        safe_name = root[:-1] if root else filename.split('.')[0]
+        patterns = list(members) + ['manifest.safe']
+
+        selected = []
+        for entry in entries:
+            name = entry['name'][len(root):]
+            if(name=='' or name.endswith('/') or not _MatchMember(name, patterns)):
+                continue
+            if(name.startswith('/') or '..' in name.split('/')):
+                raise RuntimeError('Refusing to extract {} from {} outside of the SAFE folder.'.format(name, filename))
+
+            entry['path'] = os.path.join(folder, safe_name, *name.split('/'))
+            selected.append(entry)
+
+        if(len(selected)==0):
+            raise RuntimeError('None of the files in {} match {}.'.format(filename, members))
+
+        # Skip files that were already extracted
+        todo = [e for e in selected if not (os.path.exists(e['path']) and os.path.getsize(e['path'])==e['size'])]
+
+        # Group files that are next to each other in the zip so they can be
+        # downloaded with one request
+        runs = []
+        for entry in todo:
+            if(len(runs)>0 and runs[-1][-1]['end']==entry['offset']):
+                runs[-1].append(entry)
+            else:
+                runs.append([entry])
+
+        remaining = sum([e['end']-e['offset'] for e in todo])
+        print('Extracting {} of {} files ({:0.1f} of {:0.1f}MB) from {}'.format(len(selected), len(entries),
+              sum([e['comp_size'] for e in selected])/1e6, total_size/1e6, filename))
+
+        if(progress is None):
+            progress_bar = tqdm(total=remaining, unit='iB', unit_scale=True)
+            progress_bar.lock = threading.Lock()
+        else:
+            progress_bar = progress
+            with progress.lock:
+                progress.total += remaining
+                progress.refresh()
+
+        received = [0]
+        try:
+            for run in runs:
+                self._extract_run(url, etag, total_size, run, progress_bar, received, stats)
+        finally:
+            if(progress is None):
+                progress_bar.close()
+            elif(received[0]<remaining):
+                with progress.lock:
+                    progress.total -= remaining - received[0]
+                    progress.refresh()
+
+        print(' ')
+
+        return safe_name
+
+    def _read_range(self, url, etag, start, end, total):
+        """ Returns the bytes from `start` to `end` (inclusive) of a remote file.
+        """
+        headers = {'Range':'bytes={}-{}'.format(start, end)}
+        if(etag is not None):
+            headers['If-Range'] = etag
+
+        r = self._get_download(url, headers)
+        try:
+            if((r.status_code!=206) or (r.headers.get('content-range')!='bytes {}-{}/{}'.format(start, end, total))):
+                raise RuntimeError('The remote file changed or the server did not return the requested range.')
+            return r.content
+        finally:
+            r.close()
+
+    def _extract_run(self, url, etag, total, run, progress_bar, received, stats=None):
+        """ Downloads a group of consecutive zip members with a single range
+            request and writes each decompressed member to its `path`.  The
+            CRC of each member is checked before it is renamed into place.
+            `received[0]` is increased by the number of bytes received.
+        """
+        headers = {'Range':'bytes={}-{}'.format(run[0]['offset'], run[-1]['end']-1)}
+        if(etag is not None):
+            headers['If-Range'] = etag
+
+        r = self._get_download(url, headers)
+        try:
+            expected = 'bytes {}-{}/{}'.format(run[0]['offset'], run[-1]['end']-1, total)
+            if((r.status_code!=206) or (r.headers.get('content-range')!=expected)):
+                raise RuntimeError('The remote file changed or the server did not return the requested range.')
+            r.raw.decode_content = True
+
+            last_update = time.time()
+            pending = 0
+
+            def read(num):
+                """ Reads exactly `num` bytes from the response. """
+                nonlocal pending, last_update
+                chunks = []
+                while(num>0):
+                    read_start = time.time()
+                    try:
+                        data = r.raw.read(min(num, _READ_SIZE))
+                    except (urllib3.exceptions.HTTPError, OSError) as e:
+                        raise _IncompleteDownload(str(e))
+                    if(not data):
+                        raise _IncompleteDownload('The connection closed before the whole range was received.')
+                    now = time.time()
+
+                    if(stats is not None):
+                        with stats.lock:
+                            if(stats.ttfb is None):
+                                stats.ttfb = now - stats.request_time
+                            if(now-read_start>_STALL_SECONDS):
+                                stats.stalls += 1
+                            stats.bytes += len(data)
+
+                    chunks.append(data)
+                    num -= len(data)
+                    received[0] += len(data)
+                    pending += len(data)
+                    if(now-last_update>_PROGRESS_INTERVAL):
+                        with progress_bar.lock:
+                            progress_bar.update(pending)
+                        pending = 0
+                        last_update = now
+                return b''.join(chunks)
+
+            try:
+                for entry in run:
+                    header = read(_LOCAL_HEADER_SIZE)
+                    if(header[0:4]!=b'PK\x03\x04'):
+                        raise RuntimeError('Invalid local file header for {}.'.format(entry['name']))
+                    name_len, extra_len = struct.unpack('<HH', header[26:30])
+                    read(name_len + extra_len)
+
+                    if(entry['method']==8):
+                        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    elif(entry['method']==0):
+                        decompressor = None
+                    else:
+                        raise RuntimeError('{} uses an unsupported compression method ({}).'.format(entry['name'], entry['method']))
+
+                    os.makedirs(os.path.dirname(entry['path']), exist_ok=True)
+                    part_name = entry['path'] + '.part'
+                    crc = 0
+                    with open(part_name, 'wb') as f:
+                        left = entry['comp_size']
+                        while(left>0):
+                            data = read(min(left, self._buffer_size))
+                            left -= len(data)
+                            if(decompressor is not None):
+                                data = decompressor.decompress(data)
+                            crc = zlib.crc32(data, crc)
+                            f.write(data)
+
+                        if(decompressor is not None):
+                            data = decompressor.flush()
+                            crc = zlib.crc32(data, crc)
+                            f.write(data)
+
+                    if(crc!=entry['crc']):
+                        os.remove(part_name)
+                        raise _IncompleteDownload('The CRC of {} does not match the zip file.  The file was discarded.'.format(entry['name']))
+                    os.replace(part_name, entry['path'])
+
+                    # Skip the data descriptor, if there is one
+                    header_end = entry['offset'] + _LOCAL_HEADER_SIZE + name_len + extra_len + entry['comp_size']
+                    read(entry['end'] - header_end)
+            finally:
+                if(pending>0):
+                    with progress_bar.lock:
+                        progress_bar.update(pending)
+        finally:
+            r.close()
+
+    def _SplitRange(self, start, total, num):
+        """ Splits the bytes from `start` to the end of a file of size `total`
+            into `num` [first byte, last byte] ranges of nearly equal size.
+        """
+        num = max(1, min(num, total-start))
+        bounds = [start + ((total-start)*i)//num for i in range(num+1)]
+        return [[bounds[i], bounds[i+1]-1] for i in range(num)]
+
+    def _download_range(self, url, etag, part_name, rng, total, progress_bar, hasher=None, stats=None):
+        """ Downloads the bytes in the range `rng` ([next byte, last byte]) of a
+            file using an HTTP Range request and writes them at the same
+            position in `part_name`.  `rng` is updated as data is written.
+        """
+        if(rng[0]>rng[1]):
+            return
+
+        headers = {'Range':'bytes={}-{}'.format(rng[0], rng[1])}
+        if(etag is not None):
+            headers['If-Range'] = etag
+
+        r = self._get_download(url, headers)
+        try:
+            # Make sure the server is sending the requested part of the same file
+            expected = 'bytes {}-{}/{}'.format(rng[0], rng[1], total)
+            if((r.status_code!=206) or (r.headers.get('content-range')!=expected) or (r.headers.get('etag')!=etag)):
+                raise _RemoteChanged('The remote file changed or the server did not return the requested range.  Restarting the download of {}.'.format(os.path.basename(part_name)[:-5]))
+
+            self._write_stream(r, part_name, rng[0], rng, progress_bar, hasher, stats)
+        finally:
+            r.close()
+
+    def _write_stream(self, r, part_name, offset, rng, progress_bar, hasher=None, stats=None):
+        """ Writes the body of the response `r` into `part_name` starting at
+            byte `offset`.  The first entry of `rng` is advanced as data is
+            written so that an interrupted transfer can be resumed.  If `hasher`
+            is a hashlib object, it is updated with the data.
+
+            Data is read from the socket directly into a preallocated buffer
+            and written to disk each time the buffer is full, so no memory is
+            allocated for each chunk.  The progress bar is updated at most every
+            0.5 seconds.
+        """
+        r.raw.decode_content = True
+
+        buf = bytearray(self._buffer_size)
+        view = memoryview(buf)
+        filled = 0
+        pending = 0
+        last_update = time.time()
+
+        def flush():
+            """ Writes the buffered data to disk. """
+            written = 0
+            while(written<filled):
+                written += file.write(view[written:filled])
+            if(hasher is not None):
+                hasher.update(view[:filled])
+            rng[0] += filled
+
+        with open(part_name, 'r+b', buffering=0) as file:
+            file.seek(offset)
+            try:
+                while True:
+                    read_start = time.time()
+                    try:
+                        num = r.raw.readinto(view[filled:filled+_READ_SIZE])
+                    except (urllib3.exceptions.HTTPError, OSError) as e:
+                        raise _IncompleteDownload(str(e))
+                    now = time.time()
+
+                    if(stats is not None):
+                        with stats.lock:
+                            if(num and stats.ttfb is None):
+                                stats.ttfb = now - stats.request_time
+                            if(now-read_start>_STALL_SECONDS):
+                                stats.stalls += 1
+                            stats.bytes += num
+
+                    filled += num
+                    pending += num
+                    if(filled==len(buf) or num==0):
+                        flush()
+                        filled = 0
+
+                    if(pending>0 and (now-last_update>_PROGRESS_INTERVAL or num==0)):
+                        with progress_bar.lock:
+                            progress_bar.update(pending)
+                        pending = 0
+                        last_update = now
+
+                    if(num==0):
+                        break
+            finally:
+                # Keep whatever was received before an error
+                if(filled>0):
+                    flush()
+                if(pending>0):
+                    with progress_bar.lock:
+                        progress_bar.update(pending)
+
 
     def _GetQueryString(self, opts):
         """ Processes optional arguments passed to the "Search" function to
@@ -229,16 +1418,10 @@ class CopernicusHub:
 
             if 'end_date' in opts:
                 if opts['end_date'] is not None:
-                    if(type(opts['end_date']) is datetime.date):
-                        end_str = opts['end_date'].strftime('%Y-%m-%dT00:00:00.000Z')
-                    else:
-                        end_str = opts['end_date'].isoformat() + '0Z'
+                    end_str = _FormatTime(opts['end_date'])
 
             if 'start_date' in opts:
-                if(type(opts['start_date']) is datetime.date):
-                    start_str = opts['start_date'].strftime('%Y-%m-%dT00:00:00.000Z')
-                else:
-                    start_str = opts['start_date'].isoformat() + '0Z'
+                start_str = _FormatTime(opts['start_date'])
 
             qString += ' AND endposition:[%s TO %s]'%(start_str, end_str)
 
@@ -253,7 +1436,7 @@ class CopernicusHub:
 
             # Otherwise it's a list of points defining a polygon...
             else:
-                pts = opts['region']
+                pts = list(opts['region'])
                 # Make sure the last point is the same as the first
                 if((pts[-1][0] != pts[0][0]) or (pts[-1][1] != pts[0][1])):
                     pts.append(pts[0])
@@ -274,6 +1457,63 @@ class CopernicusHub:
         return qString
 
 
+class SearchIterator:
+    """
+    Iterates over the results of a search that may span many pages of the
+    API.  Created by `CopernicusHub.SearchIter`.  The first page is requested
+    when the iterator is created, so the total number of matching products
+    is available immediately in the `total` attribute.  Each following page is
+    requested in a background thread while the current page is being used.
+    """
+
+    def __init__(self, hub, qString, page_size, sort_dir, sort_by='beginposition'):
+        self._hub = hub
+        self._query = qString
+        self._page_size = page_size
+        self._sort_dir = sort_dir
+        self._sort_by = sort_by
+
+        self._page, self.total = hub._SearchPage(qString, 0, page_size, sort_dir, sort_by)
+        self._start = len(self._page)
+        self._index = 0
+
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._next_page = None
+        self._Prefetch()
+
+    def _Prefetch(self):
+        """ Starts requesting the page after the current one, if there is one. """
+        if(len(self._page)>0 and self._start<self.total):
+            self._next_page = self._pool.submit(self._hub._SearchPage, self._query, self._start, self._page_size, self._sort_dir, self._sort_by)
+        else:
+            self._next_page = None
+            self._pool.shutdown(wait=False)
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return self.total
+
+    def __next__(self):
+        if(self._index>=len(self._page)):
+            if(self._next_page is None):
+                raise StopIteration
+
+            # The total can change if products are added while we iterate
+            self._page, self.total = self._next_page.result()
+            self._start += len(self._page)
+            self._index = 0
+            self._Prefetch()
+
+            if(len(self._page)==0):
+                raise StopIteration
+
+        entry = self._page[self._index]
+        self._index += 1
+        return entry
+
+
 if __name__=='__main__':
     import getpass
 
@@ -0,0 +1,148 @@
+"""
+Helpers for reading the central directory of a remote zip file, so that
+individual members can be fetched with HTTP range requests instead of
+downloading the whole archive.  See the `members` argument of
+`CopernicusHub.Download`.
+
+"""
+
+import fnmatch
+import struct
+
+
+# Number of bytes read from the end of a zip file to find the central
+# directory.  This covers the end of central directory record with the
+# longest possible comment and the Zip64 locator.
+_TAIL_SIZE = 128*1024
+
+# Size of the fixed part of a local file header
+_LOCAL_HEADER_SIZE = 30
+
+_EOCD_SIG = b'PK\x05\x06'
+_ZIP64_LOCATOR_SIG = b'PK\x06\x07'
+_ZIP64_EOCD_SIG = b'PK\x06\x06'
+_CENTRAL_SIG = b'PK\x01\x02'
+
+
+def _ParseZipDirectory(tail, tail_start, read_range):
+    """ Parses the central directory of a zip file.
+
+        ARGUMENTS:
+            tail (bytes): The last bytes of the zip file.
+            tail_start (int): Position of the first byte of `tail` in the file.
+            read_range (function): Called with (first byte, last byte) to read
+                parts of the file that are not in `tail`.
+
+        RETURNS:
+            A list of dictionaries, one per member, sorted by their position in
+            the file, with the keys name, method, crc, comp_size, size, offset
+            and end.  `end` is the position of the first byte after the member,
+            including its local header and data descriptor.
+    """
+    eocd = tail.rfind(_EOCD_SIG)
+    if(eocd<0):
+        raise RuntimeError('Could not find the central directory of the zip file.')
+
+    _, _, _, _, num_entries, cd_size, cd_offset, _ = struct.unpack('<IHHHHIIH', tail[eocd:eocd+22])
+
+    # Large archives store the sizes in the Zip64 end of central directory record
+    if(num_entries==0xFFFF or cd_size==0xFFFFFFFF or cd_offset==0xFFFFFFFF):
+        locator = eocd - 20
+        if(locator<0 or tail[locator:locator+4]!=_ZIP64_LOCATOR_SIG):
+            raise RuntimeError('Could not find the Zip64 end of central directory locator.')
+        _, _, record_offset, _ = struct.unpack('<IIQI', tail[locator:locator+20])
+
+        record = _GetBytes(tail, tail_start, read_range, record_offset, 56)
+        if(record[0:4]!=_ZIP64_EOCD_SIG):
+            raise RuntimeError('Invalid Zip64 end of central directory record.')
+        _, _, _, _, _, _, _, num_entries, cd_size, cd_offset = struct.unpack('<IQHHIIQQQQ', record)
+
+    directory = _GetBytes(tail, tail_start, read_range, cd_offset, cd_size)
+
+    members = []
+    pos = 0
+    for i in range(num_entries):
+        if(directory[pos:pos+4]!=_CENTRAL_SIG):
+            raise RuntimeError('Invalid entry in the central directory of the zip file.')
+
+        (_, _, _, flags, method, _, _, crc, comp_size, size,
+         name_len, extra_len, comment_len, _, _, _, offset) = struct.unpack('<IHHHHHHIIIHHHHHII', directory[pos:pos+46])
+
+        name = directory[pos+46:pos+46+name_len]
+        name = name.decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = directory[pos+46+name_len:pos+46+name_len+extra_len]
+
+        # Values that do not fit in 32 bits are stored in the Zip64 extra field
+        if(0xFFFFFFFF in [comp_size, size, offset]):
+            size, comp_size, offset = _ReadZip64Extra(extra, size, comp_size, offset)
+
+        members.append({'name':name, 'method':method, 'crc':crc, 'comp_size':comp_size,
+                        'size':size, 'offset':offset})
+        pos += 46 + name_len + extra_len + comment_len
+
+    # Each member ends where the next one (or the central directory) begins
+    members = sorted(members, key=lambda m: m['offset'])
+    for member, following in zip(members, members[1:] + [{'offset':cd_offset}]):
+        member['end'] = following['offset']
+
+    return members
+
+
+def _ReadZip64Extra(extra, size, comp_size, offset):
+    """ Reads the 64 bit sizes and offset from the Zip64 extra field of a
+        central directory entry.  Only the values that are 0xFFFFFFFF in the
+        entry itself are stored in the field.
+    """
+    pos = 0
+    while(pos+4<=len(extra)):
+        field_id, field_len = struct.unpack('<HH', extra[pos:pos+4])
+        if(field_id==0x0001):
+            data = extra[pos+4:pos+4+field_len]
+            values = list(struct.unpack('<{}Q'.format(len(data)//8), data[:8*(len(data)//8)]))
+            if(size==0xFFFFFFFF):
+                size = values.pop(0)
+            if(comp_size==0xFFFFFFFF):
+                comp_size = values.pop(0)
+            if(offset==0xFFFFFFFF):
+                offset = values.pop(0)
+            break
+        pos += 4 + field_len
+
+    return size, comp_size, offset
+
+
+def _GetBytes(tail, tail_start, read_range, start, length):
+    """ Returns `length` bytes starting at `start`, using `tail` if it already
+        contains them.
+    """
+    if(start>=tail_start):
+        return tail[start-tail_start:start-tail_start+length]
+    return read_range(start, start+length-1)
+
+
+def _SafeRoot(members):
+    """ Returns the top level folder shared by all members (e.g.,
+        'S1A_..._1234.SAFE/'), or an empty string if there is none.
+    """
+    names = [m['name'] for m in members]
+    if(len(names)==0 or '/' not in names[0]):
+        return ''
+
+    root = names[0].split('/')[0] + '/'
+    if(all([name.startswith(root) for name in names])):
+        return root
+    return ''
+
+
+def _MatchMember(name, patterns):
+    """ Returns True if the path `name` matches one of the patterns.  Patterns
+        that end with a slash select everything in that folder.  Other patterns
+        are matched with `fnmatch`, e.g., 'measurement/*-hh-*.tiff'.
+    """
+    for pattern in patterns:
+        if(pattern.endswith('/')):
+            if(name.startswith(pattern)):
+                return True
+        elif(fnmatch.fnmatch(name, pattern)):
+            return True
+    return False
@@ -1 +1,8 @@
 from .sentinel import *
+from .batch import *
+from .pipeline import *
+from .cache import *
+from .trace import *
+from .native import *
+from .dimap import *
+from .mosaic import *
@@ -0,0 +1,219 @@
+"""
+Tools for processing many Sentinel-1 scenes at once with `SentinelProcessor`.
+
+"""
+
+import os
+import glob
+import time
+import traceback
+import concurrent.futures
+
+from .sentinel import SentinelProcessor
+from .trace import SummarizeTrace
+
+
+def _SystemMemory():
+    """ Returns the total physical memory of this machine in GB, or None if it
+        cannot be determined.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES') / 1024.0**3
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _ProcessScene(input_file, recipe, processor_args):
+    """ Runs all the steps in a recipe on a single scene.  This is the function
+        executed by each worker in the process pool.
+
+        RETURNS:
+            The name of the final output produced by SNAP.
+    """
+    proc = SentinelProcessor(input_file, **processor_args)
+
+    for step in recipe:
+        if(isinstance(step, str)):
+            name, kwargs = step, {}
+        else:
+            name, kwargs = step
+
+        getattr(proc, name)(**kwargs)
+        if(not proc.lazy):
+            proc.CleanTemp()
+
+    proc.Run()
+    proc.CleanTemp()
+
+    if(proc.newest_output is None or len(glob.glob(proc.newest_output + '*'))==0):
+        raise RuntimeError('gpt did not produce an output for {}'.format(input_file))
+
+    return proc.newest_output
+
+
+class BatchProcessor:
+    """ Processes many Sentinel-1 scenes concurrently by running a separate
+        `SentinelProcessor` for each scene in a process pool.
+
+        The number of scenes processed at the same time is chosen so that the
+        estimated memory used by all of the concurrent gpt processes stays
+        within a RAM budget.  The available cores are split evenly between the
+        workers using the gpt `-q` option, and the gpt tile cache (`-c`) of each
+        worker is limited to a fraction of its memory share.
+
+        ARGUMENTS:
+            gpt_path (str) : Path to the `gpt` executable distributed with SNAP.
+            out_dir (str) : Folder where the processed outputs are written.
+            ram_budget (float) : Total memory in GB that all workers may use
+                together.  Defaults to 75% of the physical memory.
+            scene_memory (float) : Estimated memory in GB needed to process a
+                single scene.  EW GRD scenes typically need 4-8GB.
+            max_workers (int) : Upper bound on the number of concurrent scenes.
+                Defaults to the number of cores.
+            cache_fraction (float) : Fraction of each worker's memory share used
+                for the gpt tile cache.
+            lazy (bool) : Whether each scene is processed as a single gpt graph.
+                See `SentinelProcessor`.
+            step_cache_dir (str) : Folder of a `StepCache` shared by all of the
+                workers.  See `SentinelProcessor`.
+            step_cache_size (float) : Maximum size of the step cache in GB.
+            trace_file (str) : JSON-lines file shared by all of the workers, to
+                which the resource use of every gpt call is appended.  A summary
+                per operator and per scene is printed after each batch.
+    """
+
+    def __init__(self,
+                 gpt_path='/Applications/snap/bin/gpt',
+                 out_dir=None,
+                 ram_budget=None,
+                 scene_memory=6.0,
+                 max_workers=None,
+                 cache_fraction=0.5,
+                 lazy=True,
+                 step_cache_dir=None,
+                 step_cache_size=50.0,
+                 trace_file=None):
+
+        self.gpt_exe = gpt_path
+        self.out_dir = out_dir
+        self.lazy = lazy
+        self.step_cache_dir = step_cache_dir
+        self.step_cache_size = step_cache_size
+        self.trace_file = trace_file
+
+        if(ram_budget is None):
+            total = _SystemMemory()
+            ram_budget = 0.75*total if total is not None else scene_memory
+
+        self.ram_budget = ram_budget
+        self.scene_memory = scene_memory
+        self.cache_fraction = cache_fraction
+
+        if(max_workers is None):
+            max_workers = os.cpu_count() or 1
+        self.max_workers = max_workers
+
+    def GetWorkerSettings(self, num_scenes):
+        """ Computes the number of concurrent workers and the gpt options used
+            by each worker.
+
+            ARGUMENTS:
+                num_scenes (int) : Number of scenes that will be processed.
+
+            RETURNS:
+                A tuple (num_workers, gpt_threads, gpt_cache) where gpt_cache is
+                a string that can be passed to the gpt `-c` option.
+        """
+        num_workers = int(self.ram_budget // self.scene_memory)
+        num_workers = max(1, min(num_workers, self.max_workers, num_scenes))
+
+        gpt_threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+        share = min(self.scene_memory, self.ram_budget / num_workers)
+        gpt_cache = '{}M'.format(max(256, int(1024*self.cache_fraction*share)))
+
+        return num_workers, gpt_threads, gpt_cache
+
+    def GetProcessorArgs(self, gpt_threads, gpt_cache):
+        """ Returns the arguments used to create the `SentinelProcessor` of each
+            scene, given the gpt settings from `GetWorkerSettings`.
+        """
+        return {'gpt_path':self.gpt_exe,
+                'out_dir':self.out_dir,
+                'lazy':self.lazy,
+                'gpt_threads':gpt_threads,
+                'gpt_cache':gpt_cache,
+                'step_cache_dir':self.step_cache_dir,
+                'step_cache_size':self.step_cache_size,
+                'trace_file':self.trace_file}
+
+    def Process(self, input_files, recipe):
+        """ Processes a list of scenes.
+
+            ARGUMENTS:
+                input_files (list of str) : The Sentinel-1 products to process.
+                    A file that is listed more than once is only processed
+                    once, since its copies would write the same outputs.
+                recipe (list) : The processing steps applied to every scene, in
+                    order.  Each entry is either the name of a `SentinelProcessor`
+                    method or a tuple (name, kwargs), e.g.,
+                        ['ApplyOrbit',
+                         ('RemoveThermalNoise', {'polarization':'HH'}),
+                         'ApplyCalibration',
+                         ('Reproject', {'epsg':'3413'}),
+                         ('Write', {'file_format':'GeoTiff'})]
+
+            RETURNS:
+                A tuple (outputs, failures).  `outputs` is a dictionary mapping
+                each successfully processed input file to the name of its final
+                output.  `failures` is a dictionary mapping each input file that
+                could not be processed to the error message.  A failure in one
+                scene does not stop the rest of the batch.
+        """
+        # Remove duplicates, keeping the order of the inputs
+        input_files = list(dict.fromkeys(input_files))
+        if(len(input_files)==0):
+            return dict(), dict()
+
+        start = time.time()
+        num_workers, gpt_threads, gpt_cache = self.GetWorkerSettings(len(input_files))
+        print('Processing {} scenes with {} workers ({} gpt threads, {} tile cache each)'.format(len(input_files), num_workers, gpt_threads, gpt_cache))
+
+        processor_args = self.GetProcessorArgs(gpt_threads, gpt_cache)
+
+        results = dict()
+        failures = dict()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+            futures = {pool.submit(_ProcessScene, input_file, recipe, processor_args):input_file for input_file in input_files}
+
+            for future in concurrent.futures.as_completed(futures):
+                input_file = futures[future]
+                try:
+                    results[input_file] = future.result()
+                    print('Finished ', input_file)
+                except Exception:
+                    failures[input_file] = traceback.format_exc()
+                    print('FAILED ', input_file)
+
+        self.PrintSummary(start)
+
+        # Return the outputs in the same order as the inputs
+        outputs = {f:results[f] for f in input_files if f in results}
+        failures = {f:failures[f] for f in input_files if f in failures}
+        return outputs, failures
+
+    def PrintSummary(self, since=None):
+        """ Prints the time and resources used by each operator and each scene
+            in the trace file.  Does nothing if there is no trace file.
+
+            ARGUMENTS:
+                since (float) : Only summarize the steps that started at or after
+                    this time (e.g., from `time.time()`).  `Process` uses the
+                    start of the batch, so earlier runs appended to the same
+                    trace file are left out.  If None, all records are used.
+        """
+        if(self.trace_file is None or not os.path.exists(self.trace_file)):
+            return
+
+        print('\n' + SummarizeTrace(self.trace_file, 'operators', since))
+        print('\n' + SummarizeTrace(self.trace_file, 'scene', since))
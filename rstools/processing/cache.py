@@ -0,0 +1,183 @@
+"""
+A persistent cache of the BEAM-DIMAP products produced by each processing
+step, so that re-running a chain of steps only runs the steps that changed.
+
+"""
+
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+
+
+class StepCache:
+    """ Stores the outputs of `SentinelProcessor` steps in a folder, indexed by
+        a key that combines the identity of the step's input with the gpt
+        operator and its parameters.  Because the key of each step's input is
+        the key of the previous step, a product is only reused if the whole
+        chain of steps that produced it is the same.
+
+        Each cached product is stored in its own folder, `<cache_dir>/<key>/`,
+        with its original name so that the BEAM-DIMAP header still points to
+        its data folder.  When the total size of the cache exceeds
+        `max_size`, the least recently used products are removed.
+
+        The cache can be shared by several processes (e.g., the workers of a
+        `BatchProcessor`).  Products are added with an atomic rename, so a
+        product is never visible before it is complete.  Products used within
+        the last `min_age` seconds are never removed, since another process may
+        still be reading them, so the cache can temporarily be larger than
+        `max_size`.  Users of a product should call `Get` again right before
+        reading it to mark it as used.
+
+        ARGUMENTS:
+            cache_dir (str) : Folder where the cached products are stored.
+            max_size (float) : Maximum size of the cache in GB.  If None, the
+                size is not limited.
+            min_age (float) : Time in seconds since the last use before a
+                product can be removed.  This should be longer than the
+                slowest step that reads a cached product.
+    """
+
+    def __init__(self, cache_dir, max_size=50.0, min_age=3600.0):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.min_age = min_age
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def InputKey(input_file):
+        """ Returns a key identifying a raw input product by its name and size.
+            For folders (e.g., SAFE), the names and sizes of all the files are
+            used, so a trimmed SAFE folder has a different key than a full one.
+        """
+        input_file = input_file.rstrip('/')
+        identity = [os.path.basename(input_file)]
+        if(os.path.isdir(input_file)):
+            for root, dirs, files in os.walk(input_file):
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    identity.append([os.path.relpath(path, input_file), os.path.getsize(path)])
+            identity[1:] = sorted(identity[1:])
+        elif(os.path.exists(input_file)):
+            identity.append(os.path.getsize(input_file))
+
+        return hashlib.sha256(json.dumps(identity).encode()).hexdigest()
+
+    @staticmethod
+    def Key(input_key, operator, parameters):
+        """ Returns the key of the product created by applying `operator` with
+            `parameters` to the product identified by `input_key`.
+        """
+        identity = [input_key, operator, sorted([[k, str(v)] for k, v in parameters.items()])]
+        return hashlib.sha256(json.dumps(identity).encode()).hexdigest()
+
+    def Get(self, key):
+        """ Returns the name (without the .dim extension) of the cached product
+            with this key, or None if it is not in the cache.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        headers = glob.glob(os.path.join(entry, '*.dim'))
+        if(len(headers)==0):
+            return None
+
+        # Mark the product as recently used
+        try:
+            os.utime(entry)
+        except OSError:
+            return None
+        return headers[0][:-len('.dim')]
+
+    def Put(self, key, product):
+        """ Moves a BEAM-DIMAP product (given without the .dim extension) into
+            the cache and removes old products if the cache is too large.
+
+            RETURNS:
+                The name of the product in the cache.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        tmp_entry = entry + '.tmp{}'.format(os.getpid())
+        name = os.path.basename(product)
+
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+        if(os.path.exists(product + '.data')):
+            shutil.move(product + '.data', os.path.join(tmp_entry, name + '.data'))
+        shutil.move(product + '.dim', os.path.join(tmp_entry, name + '.dim'))
+
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Another process cached the same product first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            cached = self.Get(key)
+            if(cached is not None):
+                return cached
+            raise
+
+        self.Trim(keep=[key])
+        return os.path.join(entry, name)
+
+    def Size(self):
+        """ Returns the total size of the cached products in GB. """
+        return sum([size for _, _, size in self._Entries()]) / 1024.0**3
+
+    def Trim(self, keep=[]):
+        """ Removes the least recently used products until the cache is smaller
+            than `max_size`.  Products whose key is in `keep` and products used
+            within the last `min_age` seconds are not removed.
+        """
+        if(self.max_size is None):
+            return
+
+        entries = sorted(self._Entries(), key=lambda e: e[1])
+        total = sum([size for _, _, size in entries])
+        limit = self.max_size * 1024.0**3
+
+        for key, _, size in entries:
+            if(total<=limit):
+                break
+            if(key in keep):
+                continue
+
+            # Check the last use again, since another process may have started
+            # using the product after the list was made.  Renaming it first
+            # hides it from `Get` before any of its files are removed.
+            entry = os.path.join(self.cache_dir, key)
+            tmp_entry = entry + '.tmp{}'.format(os.getpid())
+            try:
+                if(os.path.getmtime(entry)>time.time()-self.min_age):
+                    continue
+                os.rename(entry, tmp_entry)
+            except OSError:
+                continue
+
+            print('Removing cached product ', key)
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            total -= size
+
+    def _Entries(self):
+        """ Returns a list of (key, last use time, size in bytes) tuples for all
+            of the cached products.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            if(not os.path.isdir(entry) or '.tmp' in key):
+                continue
+
+            size = 0
+            for root, dirs, files in os.walk(entry):
+                for name in files:
+                    try:
+                        size += os.path.getsize(os.path.join(root, name))
+                    except OSError:
+                        pass
+            try:
+                used = os.path.getmtime(entry)
+            except OSError:
+                used = time.time()
+            entries.append((key, used, size))
+        return entries
@@ -0,0 +1,232 @@
+"""
+Reads the bands of BEAM-DIMAP products (the .dim header and the ENVI .img
+files in the .data folder) written by SNAP as memory mapped NumPy arrays, so
+that the pixels of intermediate and output products can be used from Python
+without converting them with `gpt` first.
+
+"""
+
+import os
+import re
+import collections
+import xml.etree.ElementTree as ET
+import numpy as np
+
+from .native import InterpolateLUT
+
+
+# NumPy types of the ENVI `data type` codes
+_ENVI_TYPES = {1:'u1', 2:'i2', 3:'i4', 4:'f4', 5:'f8', 6:'c8', 9:'c16',
+               12:'u2', 13:'u4', 14:'i8', 15:'u8'}
+
+
+def ReadEnviHeader(hdr_file):
+    """ Parses an ENVI header (.hdr) file.
+
+        RETURNS:
+            A dictionary mapping the (lower case) keys of the header to their
+            values as strings.  Values in braces are returned without them.
+    """
+    with open(hdr_file) as f:
+        text = f.read()
+
+    if(not text.lstrip().startswith('ENVI')):
+        raise ValueError('{} is not an ENVI header.'.format(hdr_file))
+
+    header = dict()
+    for match in re.finditer(r'^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)', text, re.MULTILINE):
+        value = match.group(2).strip()
+        if(value.startswith('{')):
+            value = ' '.join(value[1:-1].split())
+        header[match.group(1).lower()] = value
+    return header
+
+
+def ReadEnviBand(img_file, mode='r'):
+    """ Memory maps a single band ENVI image (e.g., a band of a BEAM-DIMAP
+        product).  The type, byte order and shape are read from the .hdr file
+        next to the image.
+
+        ARGUMENTS:
+            img_file (str) : The .img file.
+            mode (str) : 'r' for read only access or 'r+' to modify the file.
+
+        RETURNS:
+            A `numpy.memmap` of shape (lines, samples).
+    """
+    header = ReadEnviHeader(os.path.splitext(img_file)[0] + '.hdr')
+
+    if(int(header.get('bands', 1))!=1):
+        raise ValueError('{} has more than one band.'.format(img_file))
+
+    dtype = np.dtype(_ENVI_TYPES[int(header['data type'])])
+    dtype = dtype.newbyteorder('>' if header.get('byte order', '0')=='1' else '<')
+
+    shape = (int(header['lines']), int(header['samples']))
+    return np.memmap(img_file, dtype=dtype, mode=mode, offset=int(header.get('header offset', 0)), shape=shape)
+
+
+def _Text(node, tag, default=None):
+    """ Returns the stripped text of the first `tag` under `node`. """
+    child = node.find(tag)
+    if(child is None or child.text is None):
+        return default
+    return child.text.strip()
+
+
+class DimapProduct:
+    """ Gives access to the bands of a BEAM-DIMAP product as memory mapped
+        arrays.  The arrays are views of the .img files, so reading a window
+        (e.g., `product['Sigma0_HH'][1000:2000, 500:1500]`) only reads that
+        part of the file.
+
+        The arrays contain the values stored in the file.  Bands written with
+        a scaling (e.g., integer bands) have to be scaled by the caller with
+        the factors in `scaling`.  Virtual bands, which are defined by an
+        expression and have no data file, are not included.
+
+        ARGUMENTS:
+            filename (str) : The .dim file, with or without the extension.
+            mode (str) : 'r' for read only access or 'r+' to modify the bands.
+
+        ATTRIBUTES:
+            name (str) : The name of the product without the .dim extension.
+            width, height (int) : The size of the bands in pixels.
+            bands (OrderedDict) : Maps each band name to its `numpy.memmap`.
+            units (dict) : The physical unit of each band (e.g., 'intensity').
+            nodata (dict) : The no-data value of each band, or None.
+            scaling (dict) : The (factor, offset) of each band.
+            crs (str) : WKT of the map coordinate system, or None.
+            transform (tuple) : Affine transform (a, b, c, d, e, f) from pixel
+                (col, row) to map coordinates, x = a*col + b*row + c and
+                y = d*col + e*row + f, in the same order as `affine.Affine`.
+                None if the product is not map projected (e.g., before
+                terrain correction); use `LatLon` instead.
+            tie_point_grids (dict) : Maps the name of each tie point grid (e.g.,
+                'latitude') to a dictionary with its memory mapped `data` and
+                the `offset_x`, `offset_y`, `step_x` and `step_y` of the grid
+                in pixels.
+
+        EXAMPLE:
+            product = DimapProduct('tmp/S1A_..._CAL.dim')
+            hh = product['Sigma0_HH']
+            block = np.array(hh[:1024])
+    """
+
+    def __init__(self, filename, mode='r'):
+        if(filename.endswith('.dim')):
+            filename = filename[:-len('.dim')]
+        self.name = filename
+
+        root = ET.parse(filename + '.dim').getroot()
+        folder = os.path.dirname(os.path.abspath(filename + '.dim'))
+
+        dims = root.find('Raster_Dimensions')
+        self.width = int(_Text(dims, 'NCOLS'))
+        self.height = int(_Text(dims, 'NROWS'))
+
+        # Map coordinates of map projected products
+        self.crs = None
+        self.transform = None
+        wkt = root.find('Coordinate_Reference_System/WKT')
+        matrix = root.find('Geoposition/IMAGE_TO_MODEL_TRANSFORM')
+        if(wkt is not None and matrix is not None and matrix.text):
+            self.crs = wkt.text.strip()
+            # Stored in the order of java.awt.geom.AffineTransform.getMatrix
+            m00, m10, m01, m11, m02, m12 = [float(v) for v in matrix.text.split(',')]
+            self.transform = (m00, m01, m02, m10, m11, m12)
+
+        # Data files of the bands and tie point grids, indexed by their index
+        band_files = dict()
+        for node in root.findall('Data_Access/Data_File'):
+            band_files[int(_Text(node, 'BAND_INDEX'))] = node.find('DATA_FILE_PATH').get('href')
+        grid_files = dict()
+        for node in root.findall('Data_Access/Tie_Point_Grid_File'):
+            grid_files[int(_Text(node, 'TIE_POINT_GRID_INDEX'))] = node.find('TIE_POINT_GRID_FILE_PATH').get('href')
+
+        self.bands = collections.OrderedDict()
+        self.units = dict()
+        self.nodata = dict()
+        self.scaling = dict()
+        for info in root.findall('Image_Interpretation/Spectral_Band_Info'):
+            index = int(_Text(info, 'BAND_INDEX'))
+            if(index not in band_files):
+                continue
+
+            name = _Text(info, 'BAND_NAME')
+            self.bands[name] = ReadEnviBand(self._ImageFile(folder, band_files[index]), mode)
+            self.units[name] = _Text(info, 'PHYSICAL_UNIT')
+            self.scaling[name] = (float(_Text(info, 'SCALING_FACTOR', 1.0)), float(_Text(info, 'SCALING_OFFSET', 0.0)))
+            self.nodata[name] = None
+            if(_Text(info, 'NO_DATA_VALUE_USED', 'false').lower()=='true'):
+                self.nodata[name] = float(_Text(info, 'NO_DATA_VALUE'))
+
+        self.tie_point_grids = dict()
+        for info in root.findall('Tie_Point_Grids/Tie_Point_Grid_Info'):
+            index = int(_Text(info, 'TIE_POINT_GRID_INDEX'))
+            if(index not in grid_files):
+                continue
+
+            self.tie_point_grids[_Text(info, 'TIE_POINT_GRID_NAME')] = {
+                'data':ReadEnviBand(self._ImageFile(folder, grid_files[index])),
+                'offset_x':float(_Text(info, 'OFFSET_X')),
+                'offset_y':float(_Text(info, 'OFFSET_Y')),
+                'step_x':float(_Text(info, 'STEP_X')),
+                'step_y':float(_Text(info, 'STEP_Y'))}
+
+    @staticmethod
+    def _ImageFile(folder, href):
+        """ Returns the .img file of a data file reference, which points to
+            the .hdr file relative to the .dim file.
+        """
+        return os.path.join(folder, os.path.splitext(href)[0] + '.img')
+
+    def __getitem__(self, name):
+        return self.bands[name]
+
+    def __contains__(self, name):
+        return name in self.bands
+
+    def BandNames(self):
+        """ Returns the names of the bands that have data files. """
+        return list(self.bands.keys())
+
+    def TiePointGrid(self, name, rows, cols):
+        """ Interpolates a tie point grid (e.g., 'incident_angle') onto a block
+            of pixels.
+
+            ARGUMENTS:
+                name (str) : The name of the tie point grid.
+                rows (array) : Image rows of the block.
+                cols (array) : Image columns of the block.
+
+            RETURNS:
+                A float32 array of shape (len(rows), len(cols)).
+        """
+        grid = self.tie_point_grids[name]
+        values = np.asarray(grid['data'], dtype=np.float64)
+
+        # Tie points are given in pixel coordinates, where the centre of
+        # pixel (0,0) is at (0.5,0.5)
+        lines = grid['offset_y'] + grid['step_y']*np.arange(values.shape[0]) - 0.5
+        pixels = grid['offset_x'] + grid['step_x']*np.arange(values.shape[1]) - 0.5
+        pixels = np.tile(pixels, (values.shape[0], 1))
+
+        # Avoid interpolating across the antimeridian
+        if(name=='longitude'):
+            values = np.degrees(np.unwrap(np.radians(values), axis=1))
+            result = InterpolateLUT(lines, pixels, values, rows, cols)
+            return ((result + 180.0) % 360.0 - 180.0).astype(np.float32)
+
+        return InterpolateLUT(lines, pixels, values, rows, cols)
+
+    def LatLon(self, rows, cols):
+        """ Returns the latitude and longitude of a block of pixels of a product
+            in SAR geometry, interpolated from its tie point grids.
+
+            RETURNS:
+                A tuple (lat, lon) of arrays of shape (len(rows), len(cols)).
+        """
+        if('latitude' not in self.tie_point_grids or 'longitude' not in self.tie_point_grids):
+            raise ValueError('{} does not have latitude and longitude tie point grids.'.format(self.name))
+        return self.TiePointGrid('latitude', rows, cols), self.TiePointGrid('longitude', rows, cols)
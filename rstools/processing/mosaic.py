@@ -0,0 +1,397 @@
+"""
+Composites processed scenes (e.g., the GeoTIFFs written by
+`SentinelProcessor.Write`) into daily mosaics on a fixed grid.  The mosaics
+of consecutive days share the grid, so they also form a time series.
+
+"""
+
+import os
+import json
+import shutil
+import calendar
+import datetime
+import collections
+import concurrent.futures
+import numpy as np
+
+try:
+    import rasterio
+    from rasterio.windows import Window
+    from rasterio.windows import transform as window_transform
+    from rasterio.transform import Affine
+    from rasterio.warp import reproject, transform_bounds, Resampling
+except ImportError:
+    rasterio = None
+
+from ..download.sentinel import CopernicusHub
+from .native import _CheckRasterio, _OpenSources, _Blocks
+
+
+def _SceneBounds(filename, dst_crs):
+    """ Returns the number of bands of a scene and its (left, bottom, right,
+        top) bounds in the coordinate system of the mosaic.
+    """
+    srcs = _OpenSources(filename)
+    try:
+        count = sum([src.count for src in srcs])
+        src = srcs[0]
+        gcps, gcp_crs = src.gcps
+        if(len(gcps)>0):
+            xs = [g.x for g in gcps]
+            ys = [g.y for g in gcps]
+            bounds = transform_bounds(gcp_crs, dst_crs, min(xs), min(ys), max(xs), max(ys))
+        else:
+            bounds = transform_bounds(src.crs, dst_crs, *src.bounds)
+    finally:
+        for src in srcs:
+            src.close()
+    return count, bounds
+
+
+def _WriteJson(filename, value):
+    """ Writes a JSON file with an atomic rename, so that it is never partly
+        written.
+    """
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(value, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def _TileScenes(record_file, data, state, rows, cols):
+    """ Returns the names of the scenes that were already added to a tile.  If
+        an update of the tile was interrupted after its journal was written,
+        the update is finished first.
+    """
+    journal = os.path.splitext(record_file)[0] + '.npz'
+    if(os.path.exists(journal)):
+        with np.load(journal) as saved:
+            data[:, rows, cols] = saved['tile']
+            state[rows, cols] = saved['state']
+            scenes = [str(name) for name in saved['scenes']]
+        data.flush()
+        state.flush()
+        _WriteJson(record_file, scenes)
+        os.remove(journal)
+        return scenes
+
+    if(os.path.exists(record_file)):
+        with open(record_file) as f:
+            return json.load(f)
+    return []
+
+
+def _CompositeTile(data_file, state_file, record_file, method, scenes, dst_crs, dst_transform, window, resampling):
+    """ Adds scenes to one tile of a mosaic.  The tile is read from the memory
+        mapped mosaic, updated with one scene at a time, and written back.
+        This is the function executed by each worker.  Tiles do not overlap,
+        so the workers can write to the same files.
+
+        The scenes added to the tile are recorded in `record_file` and skipped
+        if they are added again.  The new tile is first written to a journal,
+        so that an interrupted update is finished by the next call instead of
+        adding the scenes twice (e.g., to a running mean).
+    """
+    data = np.load(data_file, mmap_mode='r+')
+    state = np.load(state_file, mmap_mode='r+')
+    col_off, row_off, width, height = window
+    rows = slice(row_off, row_off+height)
+    cols = slice(col_off, col_off+width)
+
+    done = _TileScenes(record_file, data, state, rows, cols)
+    scenes = [(filename, start) for filename, start in scenes if os.path.basename(filename) not in done]
+    if(len(scenes)==0):
+        return
+
+    tile = np.array(data[:, rows, cols])
+    tile_state = np.array(state[rows, cols])
+    tile_transform = window_transform(Window(col_off, row_off, width, height), Affine(*dst_transform))
+
+    scene = np.empty(tile.shape, dtype=np.float32)
+    for filename, start in scenes:
+        scene.fill(np.nan)
+        srcs = _OpenSources(filename)
+        try:
+            band = 0
+            for src in srcs:
+                src_nodata = src.nodata if src.nodata is not None else np.nan
+                reproject(rasterio.band(src, list(range(1, src.count+1))), scene[band:band+src.count],
+                          src_nodata=src_nodata,
+                          dst_transform=tile_transform,
+                          dst_crs=dst_crs,
+                          dst_nodata=np.nan,
+                          resampling=Resampling[resampling],
+                          num_threads=1)
+                band += src.count
+        finally:
+            for src in srcs:
+                src.close()
+
+        valid = np.all(~np.isnan(scene), axis=0)
+        if(method=='recent'):
+            # Keep the newest scene, even if scenes are not added in time order
+            valid &= (start >= tile_state)
+            tile[:, valid] = scene[:, valid]
+            tile_state[valid] = start
+        else:
+            # Running mean, so that the mosaic is always usable
+            tile_state[valid] += 1
+            first = valid & (tile_state==1)
+            tile[:, first] = scene[:, first]
+            update = valid & (tile_state>1)
+            tile[:, update] += (scene[:, update] - tile[:, update]) / tile_state[update]
+
+    done = done + [os.path.basename(filename) for filename, _ in scenes]
+    journal = os.path.splitext(record_file)[0] + '.npz'
+    with open(journal + '.tmp', 'wb') as f:
+        np.savez(f, tile=tile, state=tile_state, scenes=np.array(done))
+    os.replace(journal + '.tmp', journal)
+
+    data[:, rows, cols] = tile
+    state[rows, cols] = tile_state
+    data.flush()
+    state.flush()
+    _WriteJson(record_file, done)
+    os.remove(journal)
+
+
+class DailyMosaic:
+    """ Builds daily mosaics of processed scenes on a fixed grid.
+
+        Scenes are grouped by the day of their start time, which is parsed from
+        their names (see `CopernicusHub.ParseName`), so the files must keep the
+        Sentinel-1 product name, e.g., 'S1A_EW_GRDM_1SDH_..._Processed.tif'.
+        Each scene is reprojected onto the grid of the mosaic and composited
+        with either the most recent valid pixel or the mean of all valid pixels.
+
+        The mosaic of each day is stored in memory mapped .npy files in
+        `out_dir`, and its grid is split into tiles that are composited in
+        parallel by a pool of processes.  Each worker adds the scenes to its
+        tile one at a time, so memory use does not depend on the number of
+        scenes.  The scenes that were added are recorded, so calling `Add`
+        again with new scenes updates the existing mosaics incrementally.  The
+        scenes of each tile are recorded together with its update, so an
+        interrupted `Add` can be repeated without adding a scene twice.
+
+        ARGUMENTS:
+            out_dir (str) : Folder where the mosaics are stored.
+            bounds (tuple) : (left, bottom, right, top) of the grid in the
+                coordinate system of the mosaic.
+            resolution (float) : Pixel size of the grid, e.g., 200 for 200m.
+            epsg (str) : EPSG code of the coordinate system of the mosaic.
+            method (str) : 'recent' to keep the most recent valid pixel, or
+                'mean' to average all valid pixels.
+            tile_size (int) : Width and height of the tiles in pixels.
+            max_workers (int) : Number of processes.  Defaults to the number of cores.
+            resampling (str) : A GDAL resampling method, e.g., 'nearest' or 'bilinear'.
+            prefix (str) : Prefix of the names of the mosaic files.
+
+        EXAMPLE:
+            mosaic = DailyMosaic('mosaics', bounds=(-2.4e6, -1.0e6, 0.5e6, 2.0e6), resolution=200)
+            days = mosaic.Add(glob.glob('processed/*_Processed.tif'))
+            for day in days:
+                mosaic.Export(day)
+    """
+
+    def __init__(self, out_dir, bounds, resolution, epsg='3413', method='recent', tile_size=2048,
+                 max_workers=None, resampling='bilinear', prefix='mosaic'):
+
+        if(method not in ['recent', 'mean']):
+            raise ValueError('Unknown compositing method "{}".  Use "recent" or "mean".'.format(method))
+
+        self.out_dir = out_dir
+        self.crs = 'EPSG:{}'.format(epsg)
+        self.method = method
+        self.tile_size = tile_size
+        self.max_workers = max_workers
+        self.resampling = resampling
+        self.prefix = prefix
+
+        left, bottom, right, top = bounds
+        self.width = int(round((right-left)/resolution))
+        self.height = int(round((top-bottom)/resolution))
+        self.transform = (resolution, 0.0, left, 0.0, -resolution, top)
+
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _Name(self, day):
+        """ Returns the name of the files of a day's mosaic without extension. """
+        return os.path.join(self.out_dir, '{}_{}'.format(self.prefix, day.strftime('%Y%m%d')))
+
+    @staticmethod
+    def GroupByDay(files):
+        """ Groups scenes by the (UTC) day of their start time.
+
+            RETURNS:
+                An OrderedDict mapping each `datetime.date` to a list of
+                (filename, start time) tuples sorted by start time.  The days
+                are sorted.
+        """
+        groups = dict()
+        for filename in files:
+            start = CopernicusHub.ParseName(os.path.basename(filename))['StartTime']
+            groups.setdefault(start.date(), []).append((filename, start))
+
+        return collections.OrderedDict([(day, sorted(groups[day], key=lambda s: s[1])) for day in sorted(groups)])
+
+    def Days(self):
+        """ Returns the sorted list of days that have a mosaic. """
+        days = []
+        for name in os.listdir(self.out_dir):
+            if(name.startswith(self.prefix + '_') and name.endswith('.json')):
+                days.append(datetime.datetime.strptime(name[len(self.prefix)+1:-len('.json')], '%Y%m%d').date())
+        return sorted(days)
+
+    def _Open(self, day, count):
+        """ Returns the description of a day's mosaic, creating the mosaic files
+            if they do not exist yet.
+        """
+        name = self._Name(day)
+        if(os.path.exists(name + '.json')):
+            with open(name + '.json') as f:
+                info = json.load(f)
+
+            if(info['crs']!=self.crs or tuple(info['transform'])!=self.transform or info['method']!=self.method
+               or info['width']!=self.width or info['height']!=self.height or info['tile_size']!=self.tile_size):
+                raise ValueError('The mosaic {} was created with a different grid, method or tile size.'.format(name))
+            return info
+
+        # Records of the scenes added to each tile
+        shutil.rmtree(name + '_tiles', ignore_errors=True)
+        os.makedirs(name + '_tiles')
+
+        data = np.lib.format.open_memmap(name + '.npy', mode='w+', dtype=np.float32, shape=(count, self.height, self.width))
+        data[:] = np.nan
+        del data
+
+        # Start time of the newest scene of each pixel, or number of scenes averaged
+        if(self.method=='recent'):
+            state = np.lib.format.open_memmap(name + '_state.npy', mode='w+', dtype=np.float64, shape=(self.height, self.width))
+            state[:] = -np.inf
+        else:
+            state = np.lib.format.open_memmap(name + '_state.npy', mode='w+', dtype=np.float32, shape=(self.height, self.width))
+            state[:] = 0
+        del state
+
+        # The description is written last, so that the files are created again
+        # if this is interrupted
+        info = {'crs':self.crs, 'transform':self.transform, 'width':self.width, 'height':self.height,
+                'tile_size':self.tile_size, 'method':self.method, 'count':count, 'scenes':[]}
+        _WriteJson(name + '.json', info)
+        return info
+
+    def Add(self, files):
+        """ Adds scenes to the mosaics of their days.  Scenes that were already
+            added to a mosaic are skipped.
+
+            ARGUMENTS:
+                files (list of str) : Processed scenes, as GeoTIFFs or
+                    BEAM-DIMAP products (.dim), which all have the same bands.
+
+            RETURNS:
+                The list of days whose mosaic was updated.
+        """
+        _CheckRasterio()
+
+        updated = []
+        for day, scenes in self.GroupByDay(files).items():
+            info = None
+            new_scenes = []
+            for filename, start in scenes:
+                count, bounds = _SceneBounds(filename, self.crs)
+                if(info is None):
+                    info = self._Open(day, count)
+                if(os.path.basename(filename) in info['scenes']):
+                    continue
+                if(count!=info['count']):
+                    raise ValueError('{} has {} bands, but the mosaic has {}.'.format(filename, count, info['count']))
+                new_scenes.append((filename, calendar.timegm(start.timetuple()), bounds))
+
+            if(len(new_scenes)==0):
+                continue
+
+            # Only composite the tiles that overlap each scene
+            res = self.transform[0]
+            left, top = self.transform[2], self.transform[5]
+            tasks = []
+            for row in range(0, self.height, self.tile_size):
+                for col in range(0, self.width, self.tile_size):
+                    window = (col, row, min(self.tile_size, self.width-col), min(self.tile_size, self.height-row))
+                    tile_bounds = (left + col*res, top - (row+window[3])*res, left + (col+window[2])*res, top - row*res)
+                    overlapping = [(f, t) for f, t, b in new_scenes
+                                   if b[0]<tile_bounds[2] and b[2]>tile_bounds[0] and b[1]<tile_bounds[3] and b[3]>tile_bounds[1]]
+                    if(len(overlapping)>0):
+                        tasks.append((window, overlapping))
+
+            print('Adding {} scenes to the mosaic of {} ({} tiles)'.format(len(new_scenes), day.isoformat(), len(tasks)))
+
+            name = self._Name(day)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = [pool.submit(_CompositeTile, name + '.npy', name + '_state.npy',
+                                       os.path.join(name + '_tiles', '{}_{}.json'.format(window[1], window[0])),
+                                       self.method, overlapping, self.crs, self.transform, window, self.resampling)
+                           for window, overlapping in tasks]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+
+            info['scenes'] += [os.path.basename(f) for f, _, _ in new_scenes]
+            _WriteJson(name + '.json', info)
+            updated.append(day)
+
+        return updated
+
+    def Read(self, day):
+        """ Returns the mosaic of a day as a read only memory mapped array of
+            shape (bands, rows, cols), with NaN where no scene has data.
+        """
+        return np.load(self._Name(day) + '.npy', mmap_mode='r')
+
+    def Stack(self, days=None):
+        """ Returns the mosaics of several days, which share the same grid, as a
+            time series.
+
+            ARGUMENTS:
+                days (list of datetime.date) : The days to include.  Defaults to
+                    all days with a mosaic.
+
+            RETURNS:
+                A tuple (days, mosaics) where mosaics is a list of memory mapped
+                arrays (see `Read`).
+        """
+        if(days is None):
+            days = self.Days()
+        return days, [self.Read(day) for day in days]
+
+    def Export(self, day, output=None, compress='deflate', block_rows=1024):
+        """ Writes the mosaic of a day to a tiled GeoTIFF.  Use `WriteCOG` on
+            the result to create a Cloud Optimized GeoTIFF.
+
+            RETURNS:
+                The name of the output file.  Defaults to the name of the mosaic
+                with a .tif extension.
+        """
+        _CheckRasterio()
+        if(output is None):
+            output = self._Name(day) + '.tif'
+
+        data = self.Read(day)
+        profile = {'driver':'GTiff',
+                   'width':self.width,
+                   'height':self.height,
+                   'count':data.shape[0],
+                   'dtype':'float32',
+                   'crs':self.crs,
+                   'transform':Affine(*self.transform),
+                   'nodata':np.nan,
+                   'tiled':True,
+                   'blockxsize':512,
+                   'blockysize':512,
+                   'BIGTIFF':'IF_SAFER'}
+        if(compress is not None):
+            profile['compress'] = compress
+            profile['predictor'] = 3
+
+        with rasterio.open(output, 'w', **profile) as dst:
+            for row, num in _Blocks(self.height, block_rows):
+                dst.write(np.asarray(data[:, row:row+num]), window=Window(0, row, self.width, num))
+
+        return output
@@ -0,0 +1,894 @@
+"""
+Native implementations of simple processing steps for Sentinel-1 GRD
+products.  Radiometric calibration of a GRD product only needs the
+measurement GeoTIFFs and the calibration look up tables (LUTs) in the SAFE
+annotation, so it can be computed with NumPy without starting SNAP or writing
+BEAM-DIMAP intermediates.  See the `backend` argument of
+`SentinelProcessor.ApplyCalibration` and `SentinelProcessor.ConvertToDB`.
+
+Images are processed in blocks of rows so that memory use does not depend on
+the size of the scene.  Reprojection splits the output grid into tiles that
+are warped in parallel, and speckle filtering processes blocks of rows (with
+enough overlap for the filter window) in parallel.  Final products can be
+written as Cloud Optimized GeoTIFFs with `WriteCOG`.
+
+"""
+
+import os
+import re
+import glob
+import math
+import zipfile
+import concurrent.futures
+import xml.etree.ElementTree as ET
+import numpy as np
+
+try:
+    import rasterio
+    from rasterio.windows import Window
+    from rasterio.windows import transform as window_transform
+    from rasterio.transform import Affine
+    from rasterio.control import GroundControlPoint
+    from rasterio.warp import reproject, calculate_default_transform, Resampling
+    from rasterio.shutil import copy as copy_raster
+except ImportError:
+    rasterio = None
+
+
+# Calibration LUTs stored in the calibration annotation of each polarization
+_LUTS = {'sigma':'sigmaNought', 'beta':'betaNought', 'gamma':'gamma', 'dn':'dn'}
+
+# Band names used by SNAP for each LUT
+_BAND_NAMES = {'sigma':'Sigma0', 'beta':'Beta0', 'gamma':'Gamma0', 'dn':'DN'}
+
+_MEASUREMENT_PATTERN = re.compile(r'measurement/s1[a-d]-[^/]*-([hv]{2})-[^/]*\.tiff?$', re.IGNORECASE)
+_CALIBRATION_PATTERN = re.compile(r'annotation/calibration/calibration-s1[a-d]-[^/]*-([hv]{2})-[^/]*\.xml$', re.IGNORECASE)
+
+
+def _CheckRasterio():
+    if(rasterio is None):
+        raise ImportError('The native backend requires rasterio.  Install it with "conda install -c conda-forge rasterio".')
+
+
+def _FindProductFiles(product, polarizations=None):
+    """ Finds the measurement GeoTIFF and calibration annotation of each
+        polarization in a SAFE folder or zip file.
+
+        RETURNS:
+            A list of (polarization, tiff, calibration) tuples, where tiff is a
+            path that can be opened with rasterio and calibration is the content
+            of the calibration XML file.
+    """
+    product = product.rstrip('/')
+    if(product.endswith('.zip')):
+        with zipfile.ZipFile(product) as z:
+            names = z.namelist()
+            calibrations = {m.group(1).upper():z.read(n) for n in names for m in [_CALIBRATION_PATTERN.search(n)] if m}
+        tiffs = {m.group(1).upper():'zip://{}!{}'.format(os.path.abspath(product), n) for n in names for m in [_MEASUREMENT_PATTERN.search(n)] if m}
+    else:
+        names = []
+        for root, dirs, files in os.walk(product):
+            names += [os.path.join(root, f).replace(os.sep, '/') for f in files]
+        tiffs = {m.group(1).upper():n for n in names for m in [_MEASUREMENT_PATTERN.search(n)] if m}
+        calibrations = dict()
+        for n in names:
+            m = _CALIBRATION_PATTERN.search(n)
+            if(m):
+                with open(n, 'rb') as f:
+                    calibrations[m.group(1).upper()] = f.read()
+
+    if(polarizations is None):
+        polarizations = sorted(tiffs.keys())
+    elif(isinstance(polarizations, str)):
+        polarizations = [polarizations]
+
+    files = []
+    for pol in polarizations:
+        pol = pol.upper()
+        if(pol not in tiffs or pol not in calibrations):
+            raise RuntimeError('Could not find the {} measurement and calibration files in {}.'.format(pol, product))
+        files.append((pol, tiffs[pol], calibrations[pol]))
+
+    if(len(files)==0):
+        raise RuntimeError('Could not find any measurement files in {}.'.format(product))
+    return files
+
+
+def ReadCalibrationLUT(calibration, lut='sigma'):
+    """ Reads a calibration LUT from a Sentinel-1 calibration annotation.
+
+        ARGUMENTS:
+            calibration (str or bytes) : Path to a calibration-*.xml file or its content.
+            lut (str) : One of 'sigma', 'beta', 'gamma' or 'dn'.
+
+        RETURNS:
+            A tuple (lines, pixels, values).  lines is a 1D array with the image
+            line of each calibration vector.  pixels and values are 2D arrays
+            with one row per vector containing the image pixels where the LUT
+            is given and the LUT values.
+    """
+    if(isinstance(calibration, str) and not calibration.lstrip().startswith('<')):
+        root = ET.parse(calibration).getroot()
+    else:
+        root = ET.fromstring(calibration)
+
+    lines = []
+    pixels = []
+    values = []
+    for vector in root.iter('calibrationVector'):
+        lines.append(int(vector.find('line').text))
+        pixels.append(np.array(vector.find('pixel').text.split(), dtype=np.float64))
+        values.append(np.array(vector.find(_LUTS[lut]).text.split(), dtype=np.float64))
+
+    if(len(lines)==0):
+        raise RuntimeError('The calibration annotation does not contain any calibration vectors.')
+
+    # The vectors usually have the same pixels.  If they do not, interpolate
+    # all of them onto the pixels of the first vector.
+    if(any([len(p)!=len(pixels[0]) or np.any(p!=pixels[0]) for p in pixels])):
+        values = [np.interp(pixels[0], p, v) for p, v in zip(pixels, values)]
+        pixels = [pixels[0]]*len(values)
+
+    return np.array(lines, dtype=np.float64), np.array(pixels), np.array(values)
+
+
+def InterpolateLUT(lines, pixels, values, rows, cols):
+    """ Bilinear interpolation of a calibration LUT onto a block of pixels.
+
+        ARGUMENTS:
+            lines, pixels, values : The LUT returned by `ReadCalibrationLUT`.
+            rows (array) : Image rows of the block.
+            cols (array) : Image columns of the block.
+
+        RETURNS:
+            A float32 array of shape (len(rows), len(cols)).
+    """
+    rows = np.asarray(rows, dtype=np.float64)
+    cols = np.asarray(cols, dtype=np.float64)
+
+    # Interpolate along the pixels of the two vectors surrounding each row
+    upper = np.clip(np.searchsorted(lines, rows, side='right'), 1, len(lines)-1)
+    lower = upper - 1
+    if(len(lines)==1):
+        upper = lower = np.zeros(len(rows), dtype=int)
+
+    needed = np.unique(np.concatenate([lower, upper]))
+    along = np.empty((len(lines), len(cols)), dtype=np.float64)
+    for i in needed:
+        along[i] = np.interp(cols, pixels[i], values[i])
+
+    # ... and then between the vectors
+    span = lines[upper] - lines[lower]
+    weight = np.divide(rows - lines[lower], span, out=np.zeros(len(rows)), where=span>0)
+    weight = np.clip(weight, 0.0, 1.0)[:,None]
+
+    return ((1.0-weight)*along[lower] + weight*along[upper]).astype(np.float32)
+
+
+def _Blocks(height, block_rows):
+    """ Yields the (first row, number of rows) of each block of an image. """
+    for row in range(0, height, block_rows):
+        yield row, min(block_rows, height-row)
+
+
+def _CalibrateBlock(dn, lut, db):
+    """ Computes calibrated backscatter from the digital numbers of a block.
+        Pixels with a digital number of 0 (no data) are set to NaN.
+    """
+    dn = dn.astype(np.float32)
+    out = dn*dn / (lut*lut)
+    out[dn==0] = np.nan
+    if(db):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out = 10.0*np.log10(out)
+    return out
+
+
+def _OutputProfile(src, count, compress):
+    """ Creates the rasterio profile of a float32 output with the same size
+        and georeferencing as `src`.  GRD measurements are georeferenced with
+        GCPs, which are copied to the output.
+    """
+    profile = {'driver':'GTiff',
+               'width':src.width,
+               'height':src.height,
+               'count':count,
+               'dtype':'float32',
+               'nodata':np.nan,
+               'tiled':True,
+               'blockxsize':512,
+               'blockysize':512,
+               'BIGTIFF':'IF_SAFER'}
+    if(compress is not None):
+        profile['compress'] = compress
+        profile['predictor'] = 3
+    if(src.crs is not None and not src.transform.is_identity):
+        profile['crs'] = src.crs
+        profile['transform'] = src.transform
+    return profile
+
+
+def CalibrateGRD(product, output=None, polarizations=None, lut='sigma', db=False, block_rows=1024, compress='deflate'):
+    """ Radiometrically calibrates a Sentinel-1 GRD product without SNAP.
+
+        The calibration LUT of each polarization is interpolated bilinearly
+        onto each block of the image and the backscatter is computed as
+        DN^2 / LUT^2 (optionally in dB).
+
+        ARGUMENTS:
+            product (str) : A GRD product, as a SAFE folder or zip file.
+            output (str) : Name of the GeoTIFF to write, with one band per
+                polarization.  If None, the result is returned as an array.
+            polarizations (str or list) : Polarizations to process, e.g., 'HH'.
+                Defaults to all of the polarizations in the product.
+            lut (str) : 'sigma', 'beta' or 'gamma'.
+            db (bool) : Whether to convert the result to decibels.
+            block_rows (int) : Number of image rows processed at a time.
+            compress (str) : GeoTIFF compression, or None.
+
+        RETURNS:
+            The name of the output file, or a float32 array of shape
+            (polarizations, rows, cols) if `output` is None.
+    """
+    _CheckRasterio()
+    files = _FindProductFiles(product, polarizations)
+
+    srcs = [rasterio.open(tiff) for _, tiff, _ in files]
+    try:
+        height, width = srcs[0].height, srcs[0].width
+        cols = np.arange(width)
+
+        dst = None
+        result = None
+        if(output is None):
+            result = np.empty((len(files), height, width), dtype=np.float32)
+        else:
+            dst = rasterio.open(output, 'w', **_OutputProfile(srcs[0], len(files), compress))
+            gcps, gcp_crs = srcs[0].gcps
+            if(len(gcps)>0):
+                dst.gcps = (gcps, gcp_crs)
+            for band, (pol, _, _) in enumerate(files):
+                dst.set_band_description(band+1, '{}_{}{}'.format(_BAND_NAMES[lut], pol, '_db' if db else ''))
+
+        try:
+            for band, (src, (pol, _, calibration)) in enumerate(zip(srcs, files)):
+                lines, pixels, values = ReadCalibrationLUT(calibration, lut)
+
+                for row, num in _Blocks(height, block_rows):
+                    window = Window(0, row, width, num)
+                    dn = src.read(1, window=window)
+                    block = _CalibrateBlock(dn, InterpolateLUT(lines, pixels, values, np.arange(row, row+num), cols), db)
+
+                    if(dst is not None):
+                        dst.write(block, band+1, window=window)
+                    else:
+                        result[band, row:row+num] = block
+        finally:
+            if(dst is not None):
+                dst.close()
+    finally:
+        for src in srcs:
+            src.close()
+
+    return output if output is not None else result
+
+
+def LinearToDB(input_file, output=None, block_rows=1024, compress='deflate'):
+    """ Converts a GeoTIFF of linear backscatter (e.g., written by
+        `CalibrateGRD`) to decibels, one block of rows at a time.
+
+        RETURNS:
+            The name of the output file, or a float32 array of shape
+            (bands, rows, cols) if `output` is None.
+    """
+    _CheckRasterio()
+
+    with rasterio.open(input_file) as src:
+        dst = None
+        result = None
+        if(output is None):
+            result = np.empty((src.count, src.height, src.width), dtype=np.float32)
+        else:
+            dst = rasterio.open(output, 'w', **_OutputProfile(src, src.count, compress))
+            gcps, gcp_crs = src.gcps
+            if(len(gcps)>0):
+                dst.gcps = (gcps, gcp_crs)
+            for band, description in enumerate(src.descriptions):
+                if(description):
+                    dst.set_band_description(band+1, description + '_db')
+
+        try:
+            for row, num in _Blocks(src.height, block_rows):
+                window = Window(0, row, src.width, num)
+                block = src.read(window=window).astype(np.float32)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    block = 10.0*np.log10(block)
+
+                if(dst is not None):
+                    dst.write(block, window=window)
+                else:
+                    result[:, row:row+num] = block
+        finally:
+            if(dst is not None):
+                dst.close()
+
+    return output if output is not None else result
+
+
+def _OpenSources(input_file):
+    """ Returns a list of the rasters holding the bands of a product.  For a
+        BEAM-DIMAP product (.dim), each band is stored in a separate ENVI file
+        in the .data folder.
+    """
+    if(input_file.endswith('.dim')):
+        files = sorted(glob.glob(input_file[:-len('.dim')] + '.data/*.img'))
+        if(len(files)==0):
+            raise RuntimeError('Could not find any bands in {}.'.format(input_file))
+    else:
+        files = [input_file]
+    return [rasterio.open(f) for f in files]
+
+
+def _TargetGrid(src, dst_crs, resolution=None, bounds=None):
+    """ Computes the output grid of a reprojection.  The edges of the grid are
+        aligned to multiples of the resolution, so that the grids of different
+        scenes with the same resolution line up.
+
+        RETURNS:
+            A tuple (transform, width, height).
+    """
+    gcps, gcp_crs = src.gcps
+    if(bounds is None or resolution is None):
+        if(len(gcps)>0):
+            transform, width, height = calculate_default_transform(gcp_crs, dst_crs, src.width, src.height, gcps=gcps, resolution=resolution)
+        else:
+            transform, width, height = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds, resolution=resolution)
+
+        if(resolution is None):
+            resolution = transform.a
+        if(bounds is None):
+            bounds = (transform.c, transform.f + height*transform.e, transform.c + width*transform.a, transform.f)
+
+    left = math.floor(bounds[0]/resolution)*resolution
+    bottom = math.floor(bounds[1]/resolution)*resolution
+    right = math.ceil(bounds[2]/resolution)*resolution
+    top = math.ceil(bounds[3]/resolution)*resolution
+
+    width = int(round((right-left)/resolution))
+    height = int(round((top-bottom)/resolution))
+    return Affine(resolution, 0.0, left, 0.0, -resolution, top), width, height
+
+
+def _StageSource(srcs, filename, block_rows=1024):
+    """ Copies all of the bands into a float32 .npy file that the reprojection
+        workers map into memory, so the input is only read and decoded once
+        and is shared between the workers.  No data values become NaN.
+    """
+    height, width = srcs[0].height, srcs[0].width
+    count = sum([src.count for src in srcs])
+    staged = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(count, height, width))
+
+    band = 0
+    for src in srcs:
+        for row, num in _Blocks(height, block_rows):
+            block = src.read(window=Window(0, row, width, num)).astype(np.float32)
+            if(src.nodata is not None and not np.isnan(src.nodata)):
+                block[block==src.nodata] = np.nan
+            staged[band:band+src.count, row:row+num] = block
+        band += src.count
+
+    staged.flush()
+    del staged
+
+
+def _WarpTile(staged_file, georef, dst_crs, dst_transform, window, resampling):
+    """ Reprojects the part of the staged input that falls in one tile of the
+        output grid.  This is the function executed by each worker.
+
+        RETURNS:
+            A tuple (window, data) where data is None if the tile is empty.
+    """
+    source = np.load(staged_file, mmap_mode='r')
+    col_off, row_off, width, height = window
+
+    out = np.full((source.shape[0], height, width), np.nan, dtype=np.float32)
+    kwargs = {'src_crs':georef['crs']}
+    if(georef['gcps'] is not None):
+        kwargs['gcps'] = [GroundControlPoint(row=g[0], col=g[1], x=g[2], y=g[3], z=g[4]) for g in georef['gcps']]
+    else:
+        kwargs['src_transform'] = Affine(*georef['transform'])
+
+    reproject(source, out,
+              src_nodata=np.nan,
+              dst_transform=window_transform(Window(col_off, row_off, width, height), Affine(*dst_transform)),
+              dst_crs=dst_crs,
+              dst_nodata=np.nan,
+              resampling=Resampling[resampling],
+              num_threads=1,
+              **kwargs)
+
+    if(np.all(np.isnan(out))):
+        return window, None
+    return window, out
+
+
+def ReprojectTiled(input_file, output, epsg='3413', resolution=None, bounds=None, tile_size=2048,
+                   max_workers=None, resampling='bilinear', compress='deflate'):
+    """ Reprojects a geocoded product to another coordinate system with GDAL
+        warp, processing tiles of the output grid in parallel.
+
+        The input bands are first copied to a temporary memory mapped file next
+        to the output.  The output grid is then split into square tiles that
+        are warped by a pool of processes, which all read the shared input.
+        Tiles without any data are not written.
+
+        ARGUMENTS:
+            input_file (str) : A GeoTIFF (e.g., from `CalibrateGRD`), which may
+                be georeferenced with GCPs, or a BEAM-DIMAP product (.dim).
+            output (str) : Name of the tiled GeoTIFF to write.
+            epsg (str) : EPSG code of the output coordinate system.
+            resolution (float) : Pixel size of the output in the units of the
+                output coordinate system (e.g., 40 for 40m).  Defaults to the
+                resolution of the input.
+            bounds (tuple) : (left, bottom, right, top) of the output grid in the
+                output coordinate system.  Defaults to the extent of the input.
+            tile_size (int) : Width and height of the tiles in pixels.
+            max_workers (int) : Number of processes.  Defaults to the number of cores.
+            resampling (str) : A GDAL resampling method, e.g., 'nearest' or 'bilinear'.
+            compress (str) : GeoTIFF compression, or None.
+
+        RETURNS:
+            The name of the output file.
+    """
+    _CheckRasterio()
+
+    dst_crs = 'EPSG:{}'.format(epsg)
+    staged_file = output + '.src.npy'
+
+    srcs = _OpenSources(input_file)
+    try:
+        dst_transform, width, height = _TargetGrid(srcs[0], dst_crs, resolution, bounds)
+
+        gcps, gcp_crs = srcs[0].gcps
+        if(len(gcps)>0):
+            georef = {'crs':gcp_crs.to_wkt(), 'gcps':[(g.row, g.col, g.x, g.y, g.z) for g in gcps], 'transform':None}
+        else:
+            georef = {'crs':srcs[0].crs.to_wkt(), 'gcps':None, 'transform':tuple(srcs[0].transform)[:6]}
+
+        descriptions = []
+        for src in srcs:
+            names = [d or os.path.basename(src.name).split('.')[0] for d in src.descriptions]
+            descriptions += names if len(names)==src.count else [None]*src.count
+
+        _StageSource(srcs, staged_file)
+        count = len(descriptions)
+    finally:
+        for src in srcs:
+            src.close()
+
+    profile = {'driver':'GTiff',
+               'width':width,
+               'height':height,
+               'count':count,
+               'dtype':'float32',
+               'crs':dst_crs,
+               'transform':dst_transform,
+               'nodata':np.nan,
+               'tiled':True,
+               'blockxsize':512,
+               'blockysize':512,
+               'sparse_ok':True,
+               'BIGTIFF':'IF_SAFER'}
+    if(compress is not None):
+        profile['compress'] = compress
+        profile['predictor'] = 3
+
+    windows = [(col, row, min(tile_size, width-col), min(tile_size, height-row))
+               for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
+
+    print('Reprojecting {} bands to a {}x{} grid in {} tiles'.format(count, width, height, len(windows)))
+
+    try:
+        with rasterio.open(output, 'w', **profile) as dst:
+            for band, description in enumerate(descriptions):
+                if(description):
+                    dst.set_band_description(band+1, description)
+
+            # Tiles are written by this process as the workers finish them
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+                futures = [pool.submit(_WarpTile, staged_file, georef, dst_crs, tuple(dst_transform)[:6], window, resampling) for window in windows]
+                for future in concurrent.futures.as_completed(futures):
+                    window, data = future.result()
+                    if(data is not None):
+                        dst.write(data, window=Window(*window))
+    finally:
+        os.remove(staged_file)
+
+    return output
+
+
+def _Integral(x):
+    """ Returns the integral image of x, with a row and column of zeros
+        prepended, so that box sums can be computed with four lookups.
+    """
+    out = np.zeros((x.shape[0]+1, x.shape[1]+1), dtype=np.float64)
+    np.cumsum(np.cumsum(x, axis=0, dtype=np.float64), axis=1, out=out[1:,1:])
+    return out
+
+
+def _BoxSum(integral, halo, shape, size, oy=0, ox=0):
+    """ Sums of the size x size boxes centred `oy` rows and `ox` columns away
+        from each pixel of an image that was padded by `halo` pixels.
+    """
+    height, width = shape
+    r0 = halo + oy - size//2
+    c0 = halo + ox - size//2
+    return (integral[r0+size:r0+size+height, c0+size:c0+size+width] - integral[r0:r0+height, c0+size:c0+size+width]
+            - integral[r0+size:r0+size+height, c0:c0+width] + integral[r0:r0+height, c0:c0+width])
+
+
+def _RowPrefix(x):
+    """ Returns the cumulative sums along the rows of x with a column of zeros
+        prepended.
+    """
+    out = np.zeros((x.shape[0], x.shape[1]+1), dtype=np.float64)
+    np.cumsum(x, axis=1, dtype=np.float64, out=out[:,1:])
+    return out
+
+
+def _DiagonalPrefix(x, anti=False):
+    """ Returns the cumulative sums of x along its diagonals (down and to the
+        right), or its anti-diagonals (down and to the left) if `anti` is True,
+        with a row of zeros prepended and a column of zeros on the left (the
+        right for anti-diagonals).  The sum of n elements of a diagonal starting
+        at (i,j) is out[i+n,j+n] - out[i,j], and of an anti-diagonal starting at
+        (i,j) is out[i+n,j-n+1] - out[i,j+1].
+    """
+    out = np.zeros((x.shape[0]+1, x.shape[1]+1), dtype=np.float64)
+    for i in range(x.shape[0]):
+        if(anti):
+            np.add(x[i], out[i,1:], out=out[i+1,:-1])
+        else:
+            np.add(x[i], out[i,:-1], out=out[i+1,1:])
+    return out
+
+
+def _DirectionalTerms(h):
+    """ Returns the terms (table, sign, row, column) of the sum over each edge
+        aligned window of the Refined Lee filter (see `_DirectionalSums`) for a
+        window of 2h+1 pixels.  The row and column are offsets from the pixel
+        in the tables of the padded image.  'I' is the integral image, and 'D'
+        and 'A' are the diagonal and anti-diagonal prefix sums of the row prefix
+        sums.  Each row of a window is a difference of two row prefix sums, and
+        those are summed over the rows of the window along a column (with the
+        integral image) or along a diagonal.
+    """
+    n = 2*h+1
+    return [[('I',1,n,h+1), ('I',-1,0,h+1), ('I',-1,n,0), ('I',1,0,0)],   # left
+            [('I',1,n,n), ('I',-1,0,n), ('I',-1,n,h), ('I',1,0,h)],       # right
+            [('I',1,h+1,n), ('I',-1,0,n), ('I',-1,h+1,0), ('I',1,0,0)],   # up
+            [('I',1,n,n), ('I',-1,h,n), ('I',-1,n,0), ('I',1,h,0)],       # down
+            [('D',1,n,n+1), ('D',-1,0,1), ('I',-1,n,0), ('I',1,0,0)],     # lower left
+            [('I',1,n,n), ('I',-1,0,n), ('D',-1,n,n), ('D',1,0,0)],       # upper right
+            [('A',1,n,1), ('A',-1,0,n+1), ('I',-1,n,0), ('I',1,0,0)],     # upper left
+            [('I',1,n,n), ('I',-1,0,n), ('A',-1,n,0), ('A',1,0,n)]]       # lower right
+
+
+def _DirectionalSums(x, h, shape, selected):
+    """ Sums x over the edge aligned window selected for each pixel of an
+        image that was padded by `h` pixels.  The windows are the halves of the
+        square window on either side of a vertical, horizontal, diagonal or
+        anti-diagonal edge through the centre pixel, numbered left, right, up,
+        down, lower left, upper right, upper left and lower right (0 to 7).
+        Each sum is computed with 8 lookups, so the cost does not depend on the
+        window size.
+    """
+    height, width = shape
+    prefix = _RowPrefix(x)
+    tables = {'I':_Integral(x), 'D':_DiagonalPrefix(prefix), 'A':_DiagonalPrefix(prefix, anti=True)}
+    del prefix
+
+    total = np.zeros(shape, dtype=np.float64)
+    for k, terms in enumerate(_DirectionalTerms(h)):
+        mask = (selected==k)
+        if(not np.any(mask)):
+            continue
+        rows, cols = np.nonzero(mask)
+        for name, sign, row, col in terms:
+            total[rows, cols] += sign*tables[name][rows+row, cols+col]
+    return total
+
+
+def _LeeFilter(x, mean, var, cu2):
+    """ Applies the Lee filter given the local mean and variance of each pixel.
+        `cu2` is the squared coefficient of variation of the speckle (1/looks).
+    """
+    var_x = (var - mean*mean*cu2) / (1.0 + cu2)
+    weight = np.divide(var_x, var, out=np.zeros_like(var), where=var>0)
+    weight = np.clip(weight, 0.0, 1.0)
+    return mean + weight*(x - mean)
+
+
+def _FilterBand(band, method, window, looks):
+    """ Filters a block of one band that was padded by window//2 pixels on
+        every side (with NaN outside of the image).  Returns the filtered
+        interior of the block.
+    """
+    h = window//2
+    shape = (band.shape[0]-2*h, band.shape[1]-2*h)
+
+    valid = ~np.isnan(band)
+    x = np.where(valid, band, 0.0).astype(np.float64)
+    centre = band[h:h+shape[0], h:h+shape[1]].astype(np.float64)
+
+    ix = _Integral(x)
+    ixx = _Integral(x*x)
+    icount = _Integral(valid)
+
+    if(method in ['boxcar', 'lee']):
+        count = _BoxSum(icount, h, shape, window)
+        mean = np.divide(_BoxSum(ix, h, shape, window), count, out=np.full(shape, np.nan), where=count>0)
+        if(method=='boxcar'):
+            out = mean
+        else:
+            var = np.divide(_BoxSum(ixx, h, shape, window), count, out=np.zeros(shape), where=count>0) - mean*mean
+            out = _LeeFilter(centre, mean, np.maximum(var, 0.0), 1.0/looks)
+
+    else:
+        # Means of a 3x3 grid of subwindows are used to find the direction of
+        # the strongest edge through each pixel
+        sub = window//2 if (window//2)%2==1 else window//2+1
+        d = (window-sub)//2
+        M = [[None]*3 for _ in range(3)]
+        for i, oy in enumerate([-d, 0, d]):
+            for j, ox in enumerate([-d, 0, d]):
+                count = _BoxSum(icount, h, shape, sub, oy, ox)
+                M[i][j] = np.divide(_BoxSum(ix, h, shape, sub, oy, ox), count, out=np.zeros(shape), where=count>0)
+
+        sides = [(M[0][0]+M[1][0]+M[2][0], M[0][2]+M[1][2]+M[2][2]),   # left, right
+                 (M[0][0]+M[0][1]+M[0][2], M[2][0]+M[2][1]+M[2][2]),   # up, down
+                 (M[1][0]+M[2][0]+M[2][1], M[0][1]+M[0][2]+M[1][2]),   # lower left, upper right
+                 (M[0][0]+M[0][1]+M[1][0], M[1][2]+M[2][1]+M[2][2])]   # upper left, lower right
+
+        direction = np.argmax(np.stack([np.abs(a-b) for a, b in sides]), axis=0)
+
+        # Use the half of the window on the same side of the edge as the pixel
+        selected = np.zeros(shape, dtype=np.int8)
+        for k, (a, b) in enumerate(sides):
+            closer = np.abs(3*M[1][1]-a) <= np.abs(3*M[1][1]-b)
+            selected[direction==k] = np.where(closer, 2*k, 2*k+1)[direction==k]
+        del M, sides, direction
+
+        count = _DirectionalSums(valid, h, shape, selected)
+        mean = np.divide(_DirectionalSums(x, h, shape, selected), count, out=np.full(shape, np.nan), where=count>0)
+        var = np.divide(_DirectionalSums(x*x, h, shape, selected), count, out=np.zeros(shape), where=count>0) - mean*mean
+        var = np.maximum(np.nan_to_num(var), 0.0)
+
+        out = _LeeFilter(centre, mean, var, 1.0/looks)
+
+    out[np.isnan(centre)] = np.nan
+    return out.astype(np.float32)
+
+
+def _FilterBlock(input_file, row, num, method, window, looks):
+    """ Reads a block of rows (plus the overlap needed by the filter window)
+        from every band of a product and filters it.  This is the function
+        executed by each worker.
+
+        RETURNS:
+            A tuple (row, data) with the filtered block.
+    """
+    h = window//2
+    srcs = _OpenSources(input_file)
+    try:
+        height, width = srcs[0].height, srcs[0].width
+        first = max(0, row-h)
+        last = min(height, row+num+h)
+
+        bands = []
+        for src in srcs:
+            block = src.read(window=Window(0, first, width, last-first)).astype(np.float32)
+            if(src.nodata is not None and not np.isnan(src.nodata)):
+                block[block==src.nodata] = np.nan
+            bands += list(block)
+    finally:
+        for src in srcs:
+            src.close()
+
+    # Pad with NaN so that every pixel of the block has a full window
+    pad = ((h-(row-first), h-(last-row-num)), (h, h))
+    out = np.empty((len(bands), num, width), dtype=np.float32)
+    for i, band in enumerate(bands):
+        out[i] = _FilterBand(np.pad(band, pad, constant_values=np.nan), method, window, looks)
+    return row, out
+
+
+def FilterSpeckle(input_file, output, method='refined_lee', window=7, looks=1.0, block_rows=512, max_workers=None, compress='deflate'):
+    """ Reduces speckle in calibrated SAR imagery.  The image is split into
+        blocks of rows that overlap by half of the window, which are filtered
+        in parallel by a pool of processes.
+
+        Local means and variances are computed from integral images, so the
+        cost of the boxcar and Lee filters does not depend on the window size.
+        The Refined Lee filter chooses, for each pixel, the half of the window
+        on its side of the strongest edge.  The sums over those halves, which
+        are triangles for diagonal edges, are computed from prefix sums along
+        the rows, columns and diagonals, so their cost does not depend on the
+        window size either.
+
+        ARGUMENTS:
+            input_file (str) : A GeoTIFF (e.g., from `CalibrateGRD`) or a
+                BEAM-DIMAP product (.dim) with intensities in linear scale.
+            output (str) : Name of the GeoTIFF to write.
+            method (str) : 'boxcar', 'lee' or 'refined_lee'.
+            window (int) : Size of the (square, odd) filter window in pixels.
+            looks (float) : Equivalent number of looks of the input, which sets
+                the expected speckle variance of the Lee filters.  It is about
+                4.4 for IW GRDH and 10.7 for EW GRDM products.
+            block_rows (int) : Number of rows filtered by each worker at a time.
+            max_workers (int) : Number of processes.  Defaults to the number of cores.
+            compress (str) : GeoTIFF compression, or None.
+
+        RETURNS:
+            The name of the output file.
+    """
+    _CheckRasterio()
+    if(method not in ['boxcar', 'lee', 'refined_lee']):
+        raise ValueError('Unknown speckle filter "{}".  Use "boxcar", "lee" or "refined_lee".'.format(method))
+    if(window<3 or window%2==0):
+        raise ValueError('The speckle filter window must be an odd number of pixels larger than 1.')
+
+    srcs = _OpenSources(input_file)
+    try:
+        height = srcs[0].height
+        count = sum([src.count for src in srcs])
+        profile = _OutputProfile(srcs[0], count, compress)
+        gcps, gcp_crs = srcs[0].gcps
+        descriptions = []
+        for src in srcs:
+            descriptions += [d or os.path.basename(src.name).split('.')[0] for d in src.descriptions]
+    finally:
+        for src in srcs:
+            src.close()
+
+    with rasterio.open(output, 'w', **profile) as dst:
+        if(len(gcps)>0):
+            dst.gcps = (gcps, gcp_crs)
+        for band, description in enumerate(descriptions):
+            dst.set_band_description(band+1, description)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(_FilterBlock, input_file, row, num, method, window, looks) for row, num in _Blocks(height, block_rows)]
+            for future in concurrent.futures.as_completed(futures):
+                row, data = future.result()
+                dst.write(data, window=Window(0, row, data.shape[2], data.shape[1]))
+
+    return output
+
+
+def _ConvertBlock(block, dtype, scale, offset, nodata):
+    """ Converts a float32 block to the output type.  Integer types store
+        round((value - offset) / scale), and NaN is stored as `nodata`.
+    """
+    if(not np.issubdtype(dtype, np.integer)):
+        return block.astype(dtype)
+
+    info = np.iinfo(dtype)
+    valid = ~np.isnan(block)
+    scaled = np.zeros(block.shape, dtype=np.float64)
+    scaled[valid] = np.rint((block[valid] - offset) / scale)
+
+    # Keep valid pixels away from the no-data value
+    low, high = info.min, info.max
+    if(nodata==info.min):
+        low += 1
+    elif(nodata==info.max):
+        high -= 1
+    out = np.clip(scaled, low, high).astype(dtype)
+    out[~valid] = nodata
+    return out
+
+
+def WriteCOG(input_file, output, compress='deflate', level=None, dtype='float32', scale=None, offset=0.0, db=False,
+             block_size=512, overviews=True, resampling='average', block_rows=1024):
+    """ Writes a product as a Cloud Optimized GeoTIFF (COG) with internal
+        tiles, compression with a predictor and internal overviews, so that
+        reading a window or a zoomed out view of the file only reads a few
+        tiles.
+
+        The bands are first converted to the output type block by block into
+        an uncompressed staging file, which is then written with the GDAL COG
+        driver (GDAL>=3.1).  The driver computes the overviews while it writes
+        the tiles.
+
+        ARGUMENTS:
+            input_file (str) : A GeoTIFF written by a native step or a
+                BEAM-DIMAP product (.dim).  It should be map projected (e.g.,
+                after `Reproject`) for the overviews to be useful.
+            output (str) : Name of the COG to write.
+            compress (str) : 'deflate', 'zstd', 'lzw', or None.
+            level (int) : Compression level.  Defaults to the GDAL default.
+            dtype (str) : Data type of the output, e.g., 'float32' or 'int16'.
+            scale, offset (float) : For integer types, values are stored as
+                round((value - offset) / scale) and the scale and offset are
+                written to the file, so readers that apply them get the
+                original values back.  For example, dB values with
+                dtype='int16' and scale=0.01 keep a precision of 0.01 dB.
+            db (bool) : Whether to convert linear values to dB before storing them.
+            block_size (int) : Size of the internal tiles in pixels.
+            overviews (bool) : Whether to build internal overviews.
+            resampling (str) : Resampling used for the overviews, e.g.,
+                'average', 'nearest' or 'bilinear'.
+            block_rows (int) : Number of rows converted at a time.
+
+        RETURNS:
+            The name of the output file.
+    """
+    _CheckRasterio()
+    dtype = np.dtype(dtype)
+    integer = np.issubdtype(dtype, np.integer)
+    if(integer):
+        scale = 1.0 if scale is None else scale
+        info = np.iinfo(dtype)
+        nodata = info.min if info.min<0 else info.max
+    else:
+        nodata = np.nan
+
+    staged = output + '.stage.tif'
+    srcs = _OpenSources(input_file)
+    try:
+        height, width = srcs[0].height, srcs[0].width
+        count = sum([src.count for src in srcs])
+
+        profile = _OutputProfile(srcs[0], count, None)
+        profile.update({'dtype':dtype.name, 'nodata':nodata})
+        gcps, gcp_crs = srcs[0].gcps
+
+        with rasterio.open(staged, 'w', **profile) as dst:
+            if(len(gcps)>0):
+                dst.gcps = (gcps, gcp_crs)
+            if(integer):
+                dst.scales = [scale]*count
+                dst.offsets = [offset]*count
+
+            first = 1
+            for src in srcs:
+                indexes = list(range(first, first+src.count))
+                for band, description in zip(indexes, src.descriptions):
+                    description = description or os.path.basename(src.name).split('.')[0]
+                    dst.set_band_description(band, description + ('_db' if db else ''))
+
+                for row, num in _Blocks(height, block_rows):
+                    window = Window(0, row, width, num)
+                    block = src.read(window=window).astype(np.float32)
+                    if(src.nodata is not None and not np.isnan(src.nodata)):
+                        block[block==src.nodata] = np.nan
+                    if(db):
+                        with np.errstate(divide='ignore', invalid='ignore'):
+                            block = 10.0*np.log10(block)
+                    dst.write(_ConvertBlock(block, dtype, scale, offset, nodata), indexes=indexes, window=window)
+                first += src.count
+    finally:
+        for src in srcs:
+            src.close()
+
+    options = {'COMPRESS':compress.upper() if compress is not None else 'NONE',
+               'BLOCKSIZE':block_size,
+               'OVERVIEWS':'AUTO' if overviews else 'NONE',
+               'OVERVIEW_RESAMPLING':resampling.upper(),
+               'NUM_THREADS':'ALL_CPUS',
+               'BIGTIFF':'IF_SAFER'}
+    if(compress is not None):
+        # Horizontal differencing for integers, floating point predictor otherwise
+        options['PREDICTOR'] = 'YES'
+    if(level is not None):
+        options['LEVEL'] = level
+
+    try:
+        copy_raster(staged, output, driver='COG', **options)
+    finally:
+        if(os.path.exists(staged)):
+            os.remove(staged)
+
+    return output
+
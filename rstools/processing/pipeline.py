@@ -0,0 +1,187 @@
+"""
+Overlaps downloading and processing of Sentinel-1 scenes, so that each scene
+is processed as soon as it has been downloaded.
+
+"""
+
+import os
+import time
+import shutil
+import traceback
+import concurrent.futures
+
+from .batch import _ProcessScene
+
+
+class DownloadPipeline:
+    """ Downloads products with a `CopernicusHub` and processes each one with
+        the workers of a `BatchProcessor` as soon as its download finishes.
+        While scenes are processed, the next products are downloaded.
+
+        The number of raw products on disk (being downloaded, waiting for a
+        worker, or being processed) is limited by `max_raw`, and no new
+        download is started while the free space on the download disk is
+        below `min_free_space`.  Downloads therefore wait for processing to
+        catch up instead of filling the disk.
+
+        ARGUMENTS:
+            hub (CopernicusHub) : The hub used to download the products.
+            batch (BatchProcessor) : Defines the gpt settings and the number of
+                scenes processed at the same time.
+            download_dir (str) : Folder where the raw products are downloaded.
+            max_raw (int) : Maximum number of raw products on disk at the same
+                time.  Defaults to the number of processing workers plus the
+                number of download workers.
+            min_free_space (float) : Free space in GB that must be left on the
+                download disk before another download is started.
+            delete_inputs (bool) : Whether to delete each raw product after it
+                has been processed successfully.
+            download_workers (int) : Number of products downloaded at the same
+                time.  This is limited by the number of concurrent downloads
+                allowed by the hub.
+            **download_options : Additional arguments for the downloads, e.g.,
+                `segments` or `members`.  See `CopernicusHub.Download`.
+
+        EXAMPLE:
+            hub = CopernicusHub(username, password)
+            matches = hub.Search(rows=None, type='GRD', region=region, start_date=start)
+
+            batch = BatchProcessor(gpt_path, out_dir='processed', scene_memory=6.0)
+            pipeline = DownloadPipeline(hub, batch, 'sentinel-data', delete_inputs=True)
+            outputs, failures = pipeline.Run(matches, recipe)
+    """
+
+    def __init__(self,
+                 hub,
+                 batch,
+                 download_dir,
+                 max_raw=None,
+                 min_free_space=20.0,
+                 delete_inputs=False,
+                 download_workers=1,
+                 **download_options):
+
+        self.hub = hub
+        self.batch = batch
+        self.download_dir = download_dir
+        self.max_raw = max_raw
+        self.min_free_space = min_free_space
+        self.delete_inputs = delete_inputs
+        self.download_workers = max(1, min(download_workers, hub.max_downloads))
+        self.download_options = download_options
+        if('segments' in download_options):
+            self.download_options['segments'] = hub.LimitSegments(download_options['segments'], self.download_workers)
+
+        # Time in seconds spent downloading and processing each scene, indexed by url
+        self.timings = dict()
+
+        os.makedirs(download_dir, exist_ok=True)
+
+    def _FreeSpace(self):
+        """ Returns the free space on the download disk in GB. """
+        return shutil.disk_usage(self.download_dir).free / 1024.0**3
+
+    def _DeleteInput(self, filename):
+        """ Removes a raw product, which is either a zip file or a SAFE folder. """
+        path = os.path.join(self.download_dir, filename)
+        print('Removing ', path)
+        if(os.path.isdir(path)):
+            shutil.rmtree(path, ignore_errors=True)
+        elif(os.path.exists(path)):
+            os.remove(path)
+
+    def Run(self, search_result, recipe):
+        """ Downloads and processes all of the products.
+
+            ARGUMENTS:
+                search_result (string, dict, list, SearchResults) : The products
+                    to download.  See `CopernicusHub.Download`.
+                recipe (list) : The processing steps applied to every scene.  See
+                    `BatchProcessor.Process`.
+
+            RETURNS:
+                A tuple (outputs, failures).  `outputs` is a dictionary mapping
+                the url of each successfully processed product to the name of
+                its final output.  `failures` is a dictionary mapping the url of
+                each product that could not be downloaded or processed to the
+                error message.  Both are in the same order as the input, and
+                products that are listed more than once are only handled once.
+        """
+        # A product that is listed twice is only downloaded and processed once
+        urls = list(dict.fromkeys(self.hub.GetUrls(search_result)))
+        if(len(urls)==0):
+            return dict(), dict()
+
+        start = time.time()
+        num_workers, gpt_threads, gpt_cache = self.batch.GetWorkerSettings(len(urls))
+        max_raw = self.max_raw if self.max_raw is not None else num_workers + self.download_workers
+        max_raw = max(1, max_raw)
+
+        print('Processing {} scenes with {} workers ({} gpt threads, {} tile cache each) and at most {} raw products on disk'.format(
+              len(urls), num_workers, gpt_threads, gpt_cache, max_raw))
+
+        processor_args = self.batch.GetProcessorArgs(gpt_threads, gpt_cache)
+
+        results = dict()
+        failures = dict()
+
+        waiting = list(range(len(urls)))  # Products that have not been downloaded yet
+        downloads = dict()                # future -> index
+        processing = dict()               # future -> (index, raw filename)
+        start_times = dict()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.download_workers) as download_pool, \
+             concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as process_pool:
+
+            while(len(waiting)>0 or len(downloads)>0 or len(processing)>0):
+
+                # Start new downloads while there is room on disk
+                while(len(waiting)>0 and len(downloads)<self.download_workers and len(downloads)+len(processing)<max_raw):
+                    if(self._FreeSpace()<self.min_free_space):
+                        if(len(downloads)+len(processing)>0):
+                            break
+                        print('WARNING: Less than {:0.1f}GB free in {}.  Downloading anyway because nothing else is running.'.format(self.min_free_space, self.download_dir))
+
+                    i = waiting.pop(0)
+                    start_times[i] = time.time()
+                    future = download_pool.submit(self.hub.DownloadProduct, self.download_dir, urls[i], **self.download_options)
+                    downloads[future] = i
+
+                done, _ = concurrent.futures.wait(list(downloads) + list(processing), return_when=concurrent.futures.FIRST_COMPLETED)
+
+                # Send finished downloads to the processing workers
+                for future in [f for f in done if f in downloads]:
+                    i = downloads.pop(future)
+                    self.timings[urls[i]] = {'download':time.time()-start_times[i], 'process':None}
+                    try:
+                        filename = future.result()
+                    except Exception as e:
+                        failures[urls[i]] = str(e)
+                        print('FAILED to download ', urls[i])
+                        continue
+
+                    start_times[i] = time.time()
+                    input_file = os.path.join(self.download_dir, filename)
+                    processing[process_pool.submit(_ProcessScene, input_file, recipe, processor_args)] = (i, filename)
+
+                # Collect the processed scenes
+                for future in [f for f in done if f in processing]:
+                    i, filename = processing.pop(future)
+                    self.timings[urls[i]]['process'] = time.time()-start_times[i]
+                    try:
+                        results[urls[i]] = future.result()
+                    except Exception:
+                        failures[urls[i]] = traceback.format_exc()
+                        print('FAILED ', filename)
+                        continue
+
+                    print('Finished {} (download {:0.0f}s, processing {:0.0f}s)'.format(filename, self.timings[urls[i]]['download'], self.timings[urls[i]]['process']))
+                    if(self.delete_inputs):
+                        self._DeleteInput(filename)
+
+        self.batch.PrintSummary(start)
+
+        # Return the outputs in the same order as the inputs
+        outputs = {url:results[url] for url in urls if url in results}
+        failures = {url:failures[url] for url in urls if url in failures}
+        return outputs, failures
@@ -1,24 +1,72 @@
 import os
+import shlex
+import time
 import shutil
+import xml.etree.ElementTree as ET
+
+from .cache import StepCache
+from .trace import _RunCommand, _MakeRecord, WriteTrace, SummarizeTrace
+from .native import CalibrateGRD, LinearToDB, ReprojectTiled, FilterSpeckle, WriteCOG
+from .dimap import DimapProduct
+
+
+# Operators that use annotation vectors covering the whole product (e.g.,
+# noise and calibration vectors) and should run before the product is subset.
+_FULL_SCENE_OPERATORS = ['Apply-Orbit-File', 'ThermalNoiseRemoval', 'Calibration']
+
 
 class SentinelProcessor:
     """ Uses the `gpt` tool distributed with SNAP to process Sentinel-1 data.
+
+        By default, every processing method (e.g., `ApplyOrbit`) runs
+        immediately with its own call to `gpt` and writes a BEAM-DIMAP
+        intermediate to the temporary directory.  If `lazy=True`, the methods
+        only record the steps and their parameters, and `Run()` executes the
+        whole chain as a single SNAP graph with one call to `gpt`.
+
+        ARGUMENTS:
+            input_file (str) : The Sentinel-1 product (e.g., zip file or SAFE folder) to process.
+            gpt_path (str) : Path to the `gpt` executable distributed with SNAP.
+            out_dir (str) : Folder where the processed outputs are written.
+            lazy (bool) : Whether to record steps and run them together with `Run()`.
+            gpt_threads (int) : Number of threads used by gpt (the `-q` option).
+                If None, gpt uses all available cores.
+            gpt_cache (str) : Tile cache size used by gpt (the `-c` option),
+                e.g., '2048M'.  If None, the SNAP default is used.
+            step_cache_dir (str) : Folder of a persistent `StepCache`.  If
+                given, the output of every step is stored there and reused the
+                next time the same step is applied to the same input, so only
+                the steps after a change have to be run again.  In lazy mode,
+                `Run()` starts from the latest cached step and caches the
+                product of the steps that need the whole scene (see `Run()`)
+                as well as its result.
+            step_cache_size (float) : Maximum size of the step cache in GB.
+            trace_file (str) : JSON-lines file to which a record with the wall
+                time, CPU time, peak memory and input/output sizes of every gpt
+                call is appended.  The records are also kept in `trace`.  See
+                `Summary()`.
     """
 
     def __init__(self,
                  input_file,
                  gpt_path='/Applications/snap/bin/gpt',
-                 out_dir=None):
+                 out_dir=None,
+                 lazy=False,
+                 gpt_threads=None,
+                 gpt_cache=None,
+                 step_cache_dir=None,
+                 step_cache_size=50.0,
+                 trace_file=None):
 
         self.input_file = input_file
-        self.base_name = input_file.split('/')[-1].split('.')[0]
+        self.base_name = input_file.rstrip('/').split('/')[-1].split('.')[0]
 
         if(out_dir==None):
             out_dir = './processed/'
 
-        # Create the output  directory if it doesn't exist
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
+        # Create the output  directory if it doesn't exist.  Several processors
+        # may share the same directory when scenes are processed in parallel.
+        os.makedirs(out_dir, exist_ok=True)
         self.out_dir = out_dir
 
         if(self.out_dir[-1]!='/'):
@@ -26,24 +74,55 @@ class SentinelProcessor:
 
         # Create a temporary working directory in the output directory
         self.tmp_dir = out_dir + "temp/"
-        if not os.path.exists(self.tmp_dir):
-            os.makedirs(self.tmp_dir)
+        os.makedirs(self.tmp_dir, exist_ok=True)
 
         # Set the GPT path and test to make sure it works
         self.gpt_exe = gpt_path
 
+        # Options controlling the parallelism and memory use of gpt
+        self.gpt_opts = ''
+        if(gpt_threads is not None):
+            self.gpt_opts += ' -q {}'.format(int(gpt_threads))
+        if(gpt_cache is not None):
+            self.gpt_opts += ' -c {}'.format(gpt_cache)
+
         # Keep a list of all previous output files that haven't been removed
         self.previous_outputs=[]
 
         # This is the most recent output produced by SNAP
         self.newest_output=None
 
+        # In lazy mode, steps are recorded here until Run() is called
+        self.lazy = lazy
+        self.pending_steps = []
+
+        # Products in the step cache are never removed by CleanTemp.  The key
+        # of the newest product identifies the chain of steps that made it.
+        self.step_cache = None
+        self.cached_outputs = set()
+        if(step_cache_dir is not None):
+            self.step_cache = StepCache(step_cache_dir, step_cache_size)
+            self.product_key = StepCache.InputKey(input_file)
+
+        # Resource use of each gpt call
+        self.trace_file = trace_file
+        self.trace = []
+
+        # Outputs of the native backend are GeoTIFFs instead of BEAM-DIMAP.  In
+        # lazy mode, a native calibration is held back so that a following
+        # native dB conversion can be done in the same pass.
+        self.native_outputs = set()
+        self.pending_native = None
+
     def CleanTemp(self):
         """ Removes previously generated intermediate files that are not necessary
             for subsequent operations.
         """
         for base_name in self.previous_outputs:
             print('Cleaning up "', base_name, '"')
+            if(base_name in self.native_outputs):
+                os.remove(base_name+'.tif')
+                continue
             shutil.rmtree(base_name+'.data',ignore_errors=True)
             os.remove(base_name+'.dim')
 
@@ -58,15 +137,45 @@ class SentinelProcessor:
         print('---------------------------------\n\n')
 
 
-    def _UpdateHistory(self, output_name):
+    def _UpdateHistory(self, output_name, key=None, cached=False):
         """ Updates the list of intermediate results so that we can clean them
-            up later.
+            up later.  `key` is the step cache key of the new output, and
+            `cached` indicates whether it is stored in the step cache.
         """
 
-        if(self.newest_output is not None):
+        if(self.newest_output is not None and self.newest_output not in self.cached_outputs):
             self.previous_outputs.append(self.newest_output)
         self.newest_output = output_name
 
+        if(key is not None):
+            self.product_key = key
+        if(cached):
+            self.cached_outputs.add(output_name)
+
+    def _RunGpt(self, args, step, operators, input_name, output_name):
+        """ Runs gpt with a list of arguments, records its resource use in the
+            trace, and raises an exception if it fails.
+        """
+        start = time.time()
+        result = _RunCommand([self.gpt_exe] + args)
+        self._AddTrace(_MakeRecord(self.base_name, step, operators, start, result, input_name, output_name))
+
+        if(result['returncode']!=0):
+            output = result['stderr'] if len(result['stderr'])>0 else result['stdout']
+            raise RuntimeError('gpt failed with exit code {} ({}, {}):\n'.format(result['returncode'], step, self.base_name) + '\n'.join(output[-10:]))
+
+    def _AddTrace(self, record):
+        """ Stores a trace record and appends it to the trace file. """
+        self.trace.append(record)
+        if(self.trace_file is not None):
+            WriteTrace(self.trace_file, record)
+
+    def Summary(self, by='step'):
+        """ Prints a table with the time and resources used by each step of
+            this scene.  See `SummarizeTrace` for the options of `by`.
+        """
+        print(SummarizeTrace(self.trace, by))
+
     def _GetOutputName(self, type_str, temp=True):
         """
         Constructs the name of the next output from GPT using the current name
@@ -79,56 +188,315 @@ class SentinelProcessor:
 
     def _GetInputName(self):
 
+        # Mark a cached input as used, so that other processes sharing the
+        # cache do not remove it while it is being read
+        if(self.newest_output in self.cached_outputs):
+            self.step_cache.Get(self.product_key)
+
         # If this is the first step...
         if(self.newest_output is None):
             return self.input_file
+        elif(self.newest_output in self.native_outputs):
+            return self.newest_output+'.tif'
         else:
             return self.newest_output+'.dim'
 
-    def ApplyOrbit(self):
-        """ Uses SNAP to apply the precise orbit file to a Sentinel-1 SAR file. """
+    def _RunStep(self, header, operator, parameters, output_name):
+        """ Runs a single SNAP operator on the newest product.  If the processor
+            is lazy, the step is only recorded and will be run by `Run()`.
+
+            ARGUMENTS:
+                header (str) : Description of the step printed before it runs.
+                operator (str) : Name of the gpt operator (e.g., Calibration).
+                parameters (dict) : Operator parameters, passed to gpt as -P<key>=<value>.
+                output_name (str) : Name of the output product (without extension).
+
+            Native steps write GCP-georeferenced GeoTIFFs instead of BEAM-DIMAP
+            products, so they can only be followed by other native steps and
+            `Write`.  Other SNAP operators raise a ValueError.
+        """
+        if(operator!='Write' and (self.pending_native is not None or self.newest_output in self.native_outputs)):
+            raise ValueError('"{}" cannot be applied to the output of a native step.  Native steps can only be followed by other native steps and Write.'.format(header))
 
-        self._PrintHeader('Applying Orbit File')
+        self._RunPendingNative()
 
-        input_name = self._GetInputName()
-        output_name = self._GetOutputName('OB')
+        if(self.lazy):
+            self.pending_steps.append({'header':header,
+                                       'operator':operator,
+                                       'parameters':parameters,
+                                       'output':output_name})
+            return
 
-        cmd = self.gpt_exe + ' Apply-Orbit-File -t ' + output_name
-        cmd += ' -PcontinueOnFail=\"true\" -PorbitType=\'Sentinel Precise (Auto Download)\' '
-        cmd += input_name
-        os.system(cmd)
+        self._PrintHeader(header)
 
-        self._UpdateHistory(output_name)
+        input_name = self._GetInputName()
 
-    def ApplyCalibration(self):
-        """ Uses SNAP to apply radiometric calibration. """
+        # Reuse the output of the same step on the same input if it is cached.
+        # The final Write is not cached since it goes to the output directory.
+        step_key = None
+        if(self.step_cache is not None and operator!='Write'):
+            step_key = StepCache.Key(self.product_key, operator, parameters)
+            cached = self.step_cache.Get(step_key)
+            if(cached is not None):
+                print('Using cached output ', cached)
+                self._AddTrace(_MakeRecord(self.base_name, header, [operator], time.time(), None, input_name, cached, cached=True))
+                self._UpdateHistory(cached, step_key, cached=True)
+                return
+
+        args = [operator] + shlex.split(self.gpt_opts)
+        for key, value in parameters.items():
+            args.append('-P{}={}'.format(key, value))
+
+        # The Write operator gets its output name from the "file" parameter
+        if(operator!='Write'):
+            args += ['-t', output_name]
+        args.append(input_name)
+        self._RunGpt(args, header, [operator], input_name, output_name)
+
+        if(step_key is not None and os.path.exists(output_name+'.dim')):
+            output_name = self.step_cache.Put(step_key, output_name)
+            self._UpdateHistory(output_name, step_key, cached=True)
+        else:
+            self._UpdateHistory(output_name, step_key)
 
-        self._PrintHeader('Performing Radiometric Calibration')
+    def _WriteGraph(self, graph_file, input_name, steps):
+        """ Writes a SNAP graph XML file that reads `input_name` and applies
+            each of the steps in order.  The last step must be a Write.
+        """
+        graph = ET.Element('graph', id='Graph')
+        ET.SubElement(graph, 'version').text = '1.0'
+
+        node = ET.SubElement(graph, 'node', id='Read')
+        ET.SubElement(node, 'operator').text = 'Read'
+        ET.SubElement(node, 'sources')
+        params = ET.SubElement(node, 'parameters')
+        ET.SubElement(params, 'file').text = input_name
+
+        prev_id = 'Read'
+        for i, step in enumerate(steps):
+            node_id = '{}({})'.format(step['operator'], i+1)
+
+            node = ET.SubElement(graph, 'node', id=node_id)
+            ET.SubElement(node, 'operator').text = step['operator']
+            sources = ET.SubElement(node, 'sources')
+            ET.SubElement(sources, 'sourceProduct', refid=prev_id)
+            params = ET.SubElement(node, 'parameters')
+            for key, value in step['parameters'].items():
+                ET.SubElement(params, key).text = str(value)
+
+            prev_id = node_id
+
+        ET.ElementTree(graph).write(graph_file, encoding='utf-8', xml_declaration=True)
+
+    def Run(self):
+        """ Runs all of the steps recorded in lazy mode with a single call to
+            `gpt`.  The steps are written to a graph (Read -> ... -> Write) in
+            the temporary directory, so no intermediate products are written to
+            disk.  If the last recorded step is not `Write`, the result is
+            written to a BEAM-DIMAP product in the temporary directory so that
+            further steps can be applied to it.
+
+            With a step cache, the graph starts from the product of the latest
+            step that is already cached, and the BEAM-DIMAP result is cached.
+            The graph is also split after the last step that needs the whole
+            scene (orbit, thermal noise removal and calibration).  The product
+            of those steps is written to the cache, so that chains that only
+            differ in later steps (e.g., another subset or projection) do not
+            run them again.
+
+            In eager mode (the default) this does nothing, since every step has
+            already been run.
+        """
+        self._RunPendingNative()
+
+        if(len(self.pending_steps)==0):
+            return
+
+        steps = self._MoveSubsetsEarly(self.pending_steps)
+        self.pending_steps = []
+
+        # Compute the step cache key of each step's output and skip the steps
+        # up to the latest one whose output is already cached
+        keys = [None]*len(steps)
+        if(self.step_cache is not None):
+            key = self.product_key
+            for i, step in enumerate(steps):
+                if(step['operator']!='Write'):
+                    key = StepCache.Key(key, step['operator'], step['parameters'])
+                keys[i] = key
+
+            for i in reversed(range(len(steps))):
+                if(steps[i]['operator']=='Write'):
+                    continue
+                cached = self.step_cache.Get(keys[i])
+                if(cached is not None):
+                    print('Using cached output of "{}": {}'.format(steps[i]['header'], cached))
+                    self._UpdateHistory(cached, keys[i], cached=True)
+                    steps = steps[i+1:]
+                    keys = keys[i+1:]
+                    break
+
+            if(len(steps)==0):
+                return
+
+            # Run the steps that need the whole scene as a separate graph
+            split = 0
+            for i, step in enumerate(steps):
+                if(step['operator'] in _FULL_SCENE_OPERATORS):
+                    split = i+1
+
+            if(0<split<len(steps)):
+                self._RunGraph(steps[:split], keys[split-1])
+                steps = steps[split:]
+                keys = keys[split:]
+
+        self._RunGraph(steps, keys[-1])
+
+    def _RunGraph(self, steps, key=None):
+        """ Runs a list of recorded steps on the newest product as one graph.
+            If the last step is not `Write`, the result is written to a
+            BEAM-DIMAP product, which is stored in the step cache under `key`.
+        """
+        cache_output = False
+        if(steps[-1]['operator']!='Write'):
+            cache_output = (self.step_cache is not None and key is not None)
+            output_name = steps[-1]['output']
+            steps = steps + [{'header':'Writing output to BEAM-DIMAP file',
+                              'operator':'Write',
+                              'parameters':{'formatName':'BEAM-DIMAP', 'file':output_name},
+                              'output':output_name}]
 
         input_name = self._GetInputName()
-        output_name = self._GetOutputName('CAL')
+        graph_file = self._GetOutputName('Graph') + '.xml'
+        self._WriteGraph(graph_file, input_name, steps)
 
-        cmd = self.gpt_exe + ' Calibration -PoutputBetaBand=false -PoutputSigmaBand=true '
-        cmd += '-t ' + output_name
-        cmd += ' -Ssource=' + input_name
-        os.system(cmd)
+        self._PrintHeader('Running graph:\n    ' + '\n    '.join([step['header'] for step in steps]))
 
-        self._UpdateHistory(output_name)
+        output_name = steps[-1]['output']
+        operators = [step['operator'] for step in steps]
+        self._RunGpt(shlex.split(self.gpt_opts) + [graph_file], 'Running graph', operators, input_name, output_name)
+        if(cache_output and os.path.exists(output_name+'.dim')):
+            output_name = self.step_cache.Put(key, output_name)
+            self._UpdateHistory(output_name, key, cached=True)
+        else:
+            self._UpdateHistory(output_name, key)
+
+    def _MoveSubsetsEarly(self, steps):
+        """ Moves the recorded `Subset` steps with early=True to the earliest
+            valid position in a list of steps, which is right after the last
+            step that needs the whole scene (orbit, thermal noise removal and
+            calibration).  Steps that are already run are not affected.
+        """
+        subsets = [step for step in steps if step.get('early', False)]
+        others = [step for step in steps if not step.get('early', False)]
 
-    def ConvertToDB(self):
-        """ Converts to/from decibel scale. """
+        pos = 0
+        for i, step in enumerate(others):
+            if(step['operator'] in _FULL_SCENE_OPERATORS):
+                pos = i+1
 
-        self._PrintHeader('Converting to Decibel Scale')
+        return others[:pos] + subsets + others[pos:]
+
+    def _RunNative(self, header, name, parameters, output_name, func):
+        """ Runs a step of the native backend.  `func` is called with the
+            input and output file names and writes a GeoTIFF.
+        """
+        self._PrintHeader(header)
 
         input_name = self._GetInputName()
-        output_name = self._GetOutputName('DB')
+        start = time.time()
+        before = os.times()
+        func(input_name, output_name+'.tif')
+        after = os.times()
+
+        result = {'returncode':0,
+                  'wall':time.time()-start,
+                  'user':after.user-before.user,
+                  'system':after.system-before.system,
+                  'max_rss_mb':None}
+        self._AddTrace(_MakeRecord(self.base_name, header, [name], start, result, input_name, output_name+'.tif'))
+
+        key = None
+        if(self.step_cache is not None):
+            key = StepCache.Key(self.product_key, name, parameters)
+        self.native_outputs.add(output_name)
+        self._UpdateHistory(output_name, key)
+
+    def _RunPendingNative(self):
+        """ Runs the native calibration held back in lazy mode, if any. """
+        if(self.pending_native is None):
+            return
+
+        params = self.pending_native
+        self.pending_native = None
+
+        header = 'Performing Radiometric Calibration (native{})'.format(', dB' if params['db'] else '')
+        output_name = self._GetOutputName('CAL_DB' if params['db'] else 'CAL')
+        self._RunNative(header, 'NativeCalibration', params, output_name,
+                        lambda input_name, output: CalibrateGRD(input_name, output, params['polarization'], db=params['db']))
+
+    def ApplyOrbit(self):
+        """ Uses SNAP to apply the precise orbit file to a Sentinel-1 SAR file. """
+
+        params = {'continueOnFail':'true',
+                  'orbitType':'Sentinel Precise (Auto Download)'}
+        self._RunStep('Applying Orbit File', 'Apply-Orbit-File', params, self._GetOutputName('OB'))
+
+    def ApplyCalibration(self, backend='snap', polarization=None):
+        """ Applies radiometric calibration to compute sigma0.
+
+            ARGUMENTS:
+                backend (str) : 'snap' to use the gpt Calibration operator, or
+                    'native' to interpolate the calibration LUTs of a GRD product
+                    with NumPy (see `CalibrateGRD`), which avoids starting SNAP.
+                    The native backend must be the first step and writes a
+                    GeoTIFF, so it can only be followed by native steps and
+                    `Write`.
+                polarization (str) : Polarization calibrated by the native
+                    backend, e.g., 'HH'.  Defaults to all polarizations.
+        """
+        if(backend=='native'):
+            if(self.newest_output is not None or len(self.pending_steps)>0 or self.pending_native is not None):
+                raise ValueError('Native calibration must be the first step applied to the product.')
+
+            self.pending_native = {'polarization':polarization, 'db':False}
+            if(not self.lazy):
+                self._RunPendingNative()
+            return
+
+        elif(backend!='snap'):
+            raise ValueError('Unknown backend "{}".  Use "snap" or "native".'.format(backend))
+
+        params = {'outputBetaBand':'false', 'outputSigmaBand':'true'}
+        self._RunStep('Performing Radiometric Calibration', 'Calibration', params, self._GetOutputName('CAL'))
+
+    def ConvertToDB(self, backend='snap'):
+        """ Converts to/from decibel scale.
+
+            ARGUMENTS:
+                backend (str) : 'snap' to use the gpt LinearToFromdB operator, or
+                    'native' to convert the output of a native step with
+                    NumPy.  In lazy mode, a native conversion that directly
+                    follows a native calibration is computed in the same pass.
+        """
+        if(backend=='native'):
+            if(self.pending_native is not None):
+                self.pending_native['db'] = True
+                return
+
+            # Run the recorded steps first, so that the conversion is applied
+            # to their result
+            self.Run()
+            if(self.newest_output not in self.native_outputs):
+                raise ValueError('The native dB conversion can only be applied to the output of a native step.')
+
+            self._RunNative('Converting to Decibel Scale (native)', 'NativeLinearToDB', {}, self._GetOutputName('DB'), LinearToDB)
+            return
 
-        cmd = self.gpt_exe + ' LinearToFromdB'
-        cmd += ' -t ' + output_name
-        cmd += ' -Ssource=' + input_name
-        os.system(cmd)
+        elif(backend!='snap'):
+            raise ValueError('Unknown backend "{}".  Use "snap" or "native".'.format(backend))
 
-        self._UpdateHistory(output_name)
+        self._RunStep('Converting to Decibel Scale', 'LinearToFromdB', {}, self._GetOutputName('DB'))
 
     def RemoveThermalNoise(self,polarization=None):
         """ Removes thermal noise.  If polarization is None, all polarizations
@@ -139,68 +507,202 @@ class SentinelProcessor:
             command.
         """
 
-        self._PrintHeader('Removing Thermal Noise')
+        params = {}
+        if(polarization is not None):
+            params['selectedPolarisations'] = polarization
+        self._RunStep('Removing Thermal Noise', 'ThermalNoiseRemoval', params, self._GetOutputName('TN'))
 
-        input_name = self._GetInputName()
-        output_name = self._GetOutputName('TN')
 
-        cmd = self.gpt_exe + ' ThermalNoiseRemoval'
-        if(polarization is not None):
-            cmd += ' -PselectedPolarisations=' + polarization
-        cmd += ' -t ' + output_name
-        cmd += ' -SsourceProduct=' + input_name
-        os.system(cmd)
+    def Subset(self, region, early=True):
+        """ Crops the product to a region of interest, so that subsequent
+            steps only process the pixels that are kept.
 
-        self._UpdateHistory(output_name)
+            ARGUMENTS:
+                region (list of tuples) : A list of (lon,lat) pairs defining a
+                    polygonal region of interest, in the same format as the
+                    `region` argument of `CopernicusHub.Search`.
+                early (bool) : In lazy mode, move the subset to the earliest
+                    valid point of the chain when `Run()` is called, i.e., right
+                    after orbit correction, thermal noise removal and
+                    calibration, which need the whole scene.  Other steps (e.g.,
+                    terrain correction and reprojection) then run on the subset.
+                    In eager mode, the subset is applied immediately.
+        """
+        if(len(region)<3):
+            raise ValueError('The region must be a polygon defined by at least 3 (lon,lat) points.')
 
+        # Make sure the last point is the same as the first
+        pts = list(region)
+        if((pts[-1][0] != pts[0][0]) or (pts[-1][1] != pts[0][1])):
+            pts.append(pts[0])
+        polygon = 'POLYGON((' + ','.join(['%0.6f %0.6f'%(pt[0],pt[1]) for pt in pts]) + '))'
 
-    def ApplyEllipsoidalCorrection(self):
-        """ Uses SNAP to orthorectify the image. """
+        params = {'geoRegion':polygon, 'copyMetadata':'true'}
+        self._RunStep('Subsetting to region of interest', 'Subset', params, self._GetOutputName('SUB'))
 
-        self._PrintHeader('Applying Ellipsoidal Correction (Orthorectifying)')
+        if(self.lazy and early):
+            self.pending_steps[-1]['early'] = True
 
-        input_name = self._GetInputName()
-        output_name = self._GetOutputName('GEO')
+    def SpeckleFilter(self, method='refined_lee', window=7, backend='snap', looks=1.0, max_workers=None):
+        """ Reduces speckle with a boxcar, Lee or Refined Lee filter.  The
+            filter should be applied to intensities in linear scale, i.e.,
+            before `ConvertToDB`.
+
+            ARGUMENTS:
+                method (str) : 'boxcar', 'lee' or 'refined_lee'.
+                window (int) : Size of the (square, odd) filter window in pixels.
+                    The Refined Lee filter of SNAP always uses a 7x7 window, so
+                    other sizes are only supported by the native backend.
+                backend (str) : 'snap' to use the gpt Speckle-Filter operator, or
+                    'native' to filter blocks of the image in parallel with
+                    NumPy (see `FilterSpeckle`) and write a GeoTIFF, which can
+                    only be followed by native steps and `Write`.  In lazy
+                    mode, the recorded steps are run first to create the input
+                    of the native filter.
+                looks (float) : Equivalent number of looks of the input, used by
+                    the native Lee filters.
+                max_workers (int) : Number of native workers.  Defaults to the
+                    number of cores.
+        """
+        filters = {'boxcar':'Boxcar', 'lee':'Lee', 'refined_lee':'Refined Lee'}
+        if(method not in filters):
+            raise ValueError('Unknown speckle filter "{}".  Use "boxcar", "lee" or "refined_lee".'.format(method))
+
+        if(backend=='native'):
+            self.Run()
+            if(self.newest_output is None):
+                raise ValueError('The native speckle filter needs a calibrated input.  Apply a calibration first.')
+
+            params = {'method':method, 'window':window, 'looks':looks}
+            self._RunNative('Filtering Speckle ({}, native)'.format(method), 'NativeSpeckleFilter', params, self._GetOutputName('SPK'),
+                            lambda input_name, output: FilterSpeckle(input_name, output, method, window, looks, max_workers=max_workers))
+            return
+
+        elif(backend!='snap'):
+            raise ValueError('Unknown backend "{}".  Use "snap" or "native".'.format(backend))
+
+        params = {'filter':filters[method]}
+        if(method=='refined_lee'):
+            if(window!=7):
+                raise ValueError('The Refined Lee filter of SNAP uses a 7x7 window.  Use window=7 or backend="native".')
+        else:
+            params['filterSizeX'] = window
+            params['filterSizeY'] = window
+        self._RunStep('Filtering Speckle ({})'.format(method), 'Speckle-Filter', params, self._GetOutputName('SPK'))
 
-        cmd = self.gpt_exe + ' Ellipsoid-Correction-GG'
-        cmd += ' -t ' + output_name
-        cmd += ' -Ssource=' + input_name
-        os.system(cmd)
+    def ApplyEllipsoidalCorrection(self):
+        """ Uses SNAP to orthorectify the image. """
 
-        self._UpdateHistory(output_name)
+        self._RunStep('Applying Ellipsoidal Correction (Orthorectifying)', 'Ellipsoid-Correction-GG', {}, self._GetOutputName('GEO'))
 
-    def Reproject(self,epsg='3413'):
+    def Reproject(self,epsg='3413', backend='snap', resolution=None, bounds=None, tile_size=2048, max_workers=None):
         """ Reprojects to a CRS defined by an epsg.
+
+            ARGUMENTS:
+                epsg (str) : EPSG code of the output coordinate system.
+                backend (str) : 'snap' to use the gpt Reproject operator, or
+                    'native' to warp tiles of the output grid in parallel with
+                    GDAL (see `ReprojectTiled`) and write a tiled GeoTIFF, which
+                    can only be followed by native steps and `Write`.  The
+                    native backend needs a geocoded input, e.g., the output of a
+                    native calibration or of a terrain correction.  In lazy mode,
+                    the recorded steps are run first to create that input.
+                resolution (float) : Pixel size of the native output, e.g., 40
+                    for a 40m grid.  Defaults to the input resolution.
+                bounds (tuple) : (left, bottom, right, top) of the native output
+                    grid.  Defaults to the extent of the input.
+                tile_size (int) : Size of the tiles warped by each native worker.
+                max_workers (int) : Number of native workers.  Defaults to the
+                    number of cores.
         """
-        self._PrintHeader('Reprojecting to EPSG:{}'.format(epsg))
+        if(backend=='native'):
+            self.Run()
+            if(self.newest_output is None):
+                raise ValueError('The native reprojection needs a geocoded input.  Apply a calibration or terrain correction first.')
 
-        input_name = self._GetInputName()
-        output_name = self._GetOutputName('PROJ')
+            params = {'epsg':epsg, 'resolution':resolution, 'bounds':bounds}
+            self._RunNative('Reprojecting to EPSG:{} (native)'.format(epsg), 'NativeReproject', params, self._GetOutputName('PROJ'),
+                            lambda input_name, output: ReprojectTiled(input_name, output, epsg, resolution, bounds, tile_size, max_workers))
+            return
 
-        cmd = self.gpt_exe + ' Reproject -Pcrs=EPSG:%s'%epsg
-        cmd += ' -t ' + output_name
-        cmd += ' -Ssource=' + input_name
-        os.system(cmd)
+        elif(backend!='snap'):
+            raise ValueError('Unknown backend "{}".  Use "snap" or "native".'.format(backend))
 
-        self._UpdateHistory(output_name)
+        params = {'crs':'EPSG:%s'%epsg}
+        self._RunStep('Reprojecting to EPSG:{}'.format(epsg), 'Reproject', params, self._GetOutputName('PROJ'))
 
 
-    def Write(self,file_format='GeoTiff'):
-        """ Writes an output file using the most recent BEAM-DIMAP file created
-            by `gpt`.
+    def OpenOutput(self, mode='r'):
+        """ Gives access to the bands of the newest BEAM-DIMAP product as memory
+            mapped arrays, without writing another file with `gpt`.  In lazy
+            mode, the recorded steps are run first.  The arrays read the files
+            in the temporary directory, so they should be used before
+            `CleanTemp`.
 
             ARGUMENTS:
-                file_format (str) : The file format to output.  Examples include GeoTiff or BEAM-DIMAP.
+                mode (str) : 'r' for read only access or 'r+' to modify the bands.
+
+            RETURNS:
+                A `DimapProduct`.
+
+            EXAMPLE:
+                proc = SentinelProcessor(input_file, gpt_path)
+                proc.ApplyOrbit()
+                proc.ApplyCalibration()
+                sigma0 = proc.OpenOutput()['Sigma0_HH']
         """
-        self._PrintHeader('Writing output to {} file'.format(file_format))
+        self.Run()
+        if(self.newest_output is None):
+            raise ValueError('No product has been created yet.  Apply a processing step first.')
+        if(self.newest_output in self.native_outputs):
+            raise ValueError('The newest output ({}.tif) was written by a native step and is not a BEAM-DIMAP product.'.format(self.newest_output))
 
-        input_name = self._GetInputName()
-        output_name = self._GetOutputName('Processed',False)
+        return DimapProduct(self.newest_output, mode)
 
-        cmd = self.gpt_exe + ' Write -PformatName={}'.format(file_format)
-        cmd += ' -Pfile=' + output_name
-        cmd += ' -Ssource=' + input_name
+    def Write(self,file_format='GeoTiff', compress='deflate', dtype='float32', scale=None, db=False, overviews=True):
+        """ Writes an output file using the most recent BEAM-DIMAP file created
+            by `gpt`.  In lazy mode, this is the final node of the graph built
+            by `Run()`.
 
-        os.system(cmd)
+            With file_format='COG', the newest product is written as a Cloud
+            Optimized GeoTIFF with internal tiles, compression and overviews
+            (see `WriteCOG`).  This does not use `gpt`, so in lazy mode the
+            recorded steps are run first.
+
+            ARGUMENTS:
+                file_format (str) : The file format to output.  Examples include GeoTiff, BEAM-DIMAP or COG.
+                compress (str) : COG compression, e.g., 'deflate' or 'zstd'.
+                dtype (str) : COG data type, e.g., 'float32' or 'int16'.
+                scale (float) : For integer COGs, the value of one count, e.g.,
+                    0.01 to store dB values as int16 with a precision of 0.01 dB.
+                db (bool) : Whether to convert linear values to dB in the COG.
+                overviews (bool) : Whether to build internal COG overviews.
+
+            EXAMPLE:
+                proc.Reproject('3413')
+                proc.Write('COG', dtype='int16', scale=0.01, db=True)
+        """
+        output_name = self._GetOutputName('Processed',False)
 
-        self._UpdateHistory(output_name)
+        if(file_format.lower()=='cog'):
+            self.Run()
+            if(self.newest_output is None):
+                raise ValueError('No product has been created yet.  Apply a processing step first.')
+
+            params = {'compress':compress, 'dtype':dtype, 'scale':scale, 'db':db, 'overviews':overviews}
+            self._RunNative('Writing output to COG file', 'WriteCOG', params, output_name,
+                            lambda input_name, output: WriteCOG(input_name, output, compress, dtype=dtype, scale=scale, db=db, overviews=overviews))
+            return
+
+        # The native backend already wrote a GeoTIFF, which only has to be
+        # copied if no recorded steps still have to be applied to it
+        self._RunPendingNative()
+        if(len(self.pending_steps)==0 and self.newest_output in self.native_outputs
+           and file_format.lower() in ['geotiff', 'geotiff-bigtiff']):
+            self._PrintHeader('Writing output to {} file'.format(file_format))
+            shutil.copyfile(self.newest_output+'.tif', output_name+'.tif')
+            self._UpdateHistory(output_name)
+            return
+
+        params = {'formatName':file_format, 'file':output_name}
+        self._RunStep('Writing output to {} file'.format(file_format), 'Write', params, output_name)
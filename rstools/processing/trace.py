@@ -0,0 +1,194 @@
+"""
+Runs gpt as a managed subprocess and records how long each processing step
+takes and how much CPU time, memory and disk space it uses.  The records can
+be written to a JSON-lines trace file and summarized per scene, per operator
+or for a whole batch.
+
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import datetime
+import threading
+import subprocess
+import collections
+
+
+# Number of lines of gpt output kept to report errors
+_OUTPUT_LINES = 50
+
+
+def _ProductSize(name):
+    """ Returns the size in bytes of a product, which is a file, a folder
+        (e.g., SAFE), or a BEAM-DIMAP product given with or without the .dim
+        extension.  Outputs of the gpt Write operator are given without the
+        extension of their format (e.g., .tif), so the files starting with
+        `name` are used if it does not exist.  Returns 0 if the product does
+        not exist.
+    """
+    if(name.endswith('.dim')):
+        name = name[:-len('.dim')]
+
+    paths = [name]
+    if(os.path.exists(name+'.dim')):
+        paths = [name+'.dim', name+'.data']
+    elif(not os.path.exists(name)):
+        paths = glob.glob(glob.escape(name) + '.*')
+
+    size = 0
+    for path in paths:
+        if(os.path.isfile(path)):
+            size += os.path.getsize(path)
+        elif(os.path.isdir(path)):
+            for root, dirs, files in os.walk(path):
+                for f in files:
+                    size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+def _RunCommand(args):
+    """ Runs a command and waits for it to finish.  The output of the command
+        is printed as it arrives and the last lines are kept.
+
+        RETURNS:
+            A dictionary with the return code, the wall time, user and system
+            CPU time in seconds, the peak resident memory of the process in MB
+            (None if it cannot be measured on this platform), and the last
+            lines of stdout and stderr.
+    """
+    start = time.time()
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    stdout = collections.deque(maxlen=_OUTPUT_LINES)
+    stderr = collections.deque(maxlen=_OUTPUT_LINES)
+
+    def drain(pipe, lines, echo):
+        for line in iter(pipe.readline, b''):
+            line = line.decode(errors='replace')
+            lines.append(line.rstrip('\n'))
+            echo.write(line)
+            echo.flush()
+        pipe.close()
+
+    readers = [threading.Thread(target=drain, args=(proc.stdout, stdout, sys.stdout)),
+               threading.Thread(target=drain, args=(proc.stderr, stderr, sys.stderr))]
+    for reader in readers:
+        reader.start()
+
+    # wait4 reports the resources used by gpt and the JVM it starts
+    max_rss = None
+    if(hasattr(os, 'wait4')):
+        _, status, usage = os.wait4(proc.pid, 0)
+        if(os.WIFEXITED(status)):
+            proc.returncode = os.WEXITSTATUS(status)
+        else:
+            proc.returncode = -os.WTERMSIG(status)
+
+        user, system = usage.ru_utime, usage.ru_stime
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        max_rss = usage.ru_maxrss / (1024.0**2 if sys.platform=='darwin' else 1024.0)
+    else:
+        before = os.times()
+        proc.wait()
+        after = os.times()
+        user = after.children_user - before.children_user
+        system = after.children_system - before.children_system
+
+    for reader in readers:
+        reader.join()
+
+    return {'returncode':proc.returncode,
+            'wall':time.time()-start,
+            'user':user,
+            'system':system,
+            'max_rss_mb':max_rss,
+            'stdout':list(stdout),
+            'stderr':list(stderr)}
+
+
+def WriteTrace(trace_file, record):
+    """ Appends a record to a JSON-lines trace file.  Each record is written
+        with a single call so that several processes can share the file.
+    """
+    with open(trace_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def ReadTrace(trace_file):
+    """ Returns the list of records stored in a JSON-lines trace file. """
+    with open(trace_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _MakeRecord(scene, step, operators, start, result, input_name, output_name, cached=False):
+    """ Creates a trace record for one step (or graph) of a scene. """
+    record = {'scene':scene,
+              'step':step,
+              'operators':operators,
+              'start':datetime.datetime.fromtimestamp(start, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S'),
+              'cached':cached,
+              'returncode':0,
+              'wall':0.0,
+              'user':0.0,
+              'system':0.0,
+              'max_rss_mb':None,
+              'input_bytes':_ProductSize(input_name),
+              'output_bytes':_ProductSize(output_name)}
+
+    if(result is not None):
+        for key in ['returncode', 'wall', 'user', 'system', 'max_rss_mb']:
+            record[key] = result[key]
+    return record
+
+
+def SummarizeTrace(records, by='operators', since=None):
+    """ Creates a table that summarizes trace records.
+
+        ARGUMENTS:
+            records (list of dict or str) : Records from `SentinelProcessor.trace`
+                or the name of a JSON-lines trace file.
+            by (str) : Field used to group the records.  'operators' shows which
+                operator (or chain of operators in a graph) dominates, 'scene'
+                shows the total for each scene, and 'step' lists every record.
+            since (float) : Only use the records of steps that started at or
+                after this time (e.g., from `time.time()`), such as those of one
+                run in a trace file that is appended to by several runs.
+
+        RETURNS:
+            The table as a string.
+    """
+    if(isinstance(records, str)):
+        records = ReadTrace(records)
+
+    if(since is not None):
+        since = datetime.datetime.fromtimestamp(int(since), datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+        records = [r for r in records if r['start']>=since]
+
+    groups = collections.OrderedDict()
+    for record in records:
+        if(by=='step'):
+            name = '{} {}'.format(record['scene'], record['step'])
+        elif(by=='operators'):
+            name = '+'.join(record['operators'])
+        else:
+            name = str(record[by])
+        groups.setdefault(name, []).append(record)
+
+    total_wall = sum([r['wall'] for r in records]) or 1.0
+
+    lines = ['{:<50s} {:>5s} {:>10s} {:>6s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+             by.upper(), 'RUNS', 'WALL (s)', '%', 'CPU (s)', 'RSS (MB)', 'IN (MB)', 'OUT (MB)')]
+    for name, group in groups.items():
+        wall = sum([r['wall'] for r in group])
+        cpu = sum([r['user']+r['system'] for r in group])
+        rss = [r['max_rss_mb'] for r in group if r['max_rss_mb'] is not None]
+        rss = '{:10.0f}'.format(max(rss)) if len(rss)>0 else '{:>10s}'.format('n/a')
+        lines.append('{:<50s} {:5d} {:10.1f} {:6.1f} {:10.1f} {} {:10.1f} {:10.1f}'.format(
+                     name[-50:], len(group), wall, 100*wall/total_wall, cpu, rss,
+                     sum([r['input_bytes'] for r in group])/1e6,
+                     sum([r['output_bytes'] for r in group])/1e6))
+
+    return '\n'.join(lines)
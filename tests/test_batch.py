@@ -0,0 +1,24 @@
+import concurrent.futures
+
+from rstools.processing import batch
+from rstools.processing.batch import BatchProcessor
+
+
+def test_duplicate_inputs(monkeypatch):
+    calls = []
+    def process_scene(input_file, recipe, processor_args):
+        calls.append(input_file)
+        if(input_file=='bad.zip'):
+            raise RuntimeError('gpt failed')
+        return input_file[:-4] + '_Processed'
+
+    # Run the scenes in threads so that the fake is used by the workers
+    monkeypatch.setattr(batch, '_ProcessScene', process_scene)
+    monkeypatch.setattr(batch.concurrent.futures, 'ProcessPoolExecutor', concurrent.futures.ThreadPoolExecutor)
+
+    processor = BatchProcessor(gpt_path='gpt', ram_budget=12.0, scene_memory=6.0)
+    outputs, failures = processor.Process(['b.zip', 'a.zip', 'bad.zip', 'b.zip'], ['ApplyOrbit'])
+
+    assert sorted(calls) == ['a.zip', 'b.zip', 'bad.zip']
+    assert list(outputs.items()) == [('b.zip', 'b_Processed'), ('a.zip', 'a_Processed')]
+    assert list(failures) == ['bad.zip']
@@ -0,0 +1,91 @@
+import os
+import time
+
+from rstools.processing.cache import StepCache
+
+
+def _MakeProduct(folder, name, size=1000):
+    """ Writes a fake BEAM-DIMAP product and returns its name without the .dim extension. """
+    product = os.path.join(folder, name)
+    with open(product + '.dim', 'w') as f:
+        f.write('<Dimap_Document/>')
+    os.makedirs(product + '.data')
+    with open(os.path.join(product + '.data', 'band.img'), 'wb') as f:
+        f.write(b'\0'*size)
+    return product
+
+
+def _SetLastUse(cache, key, when):
+    entry = os.path.join(cache.cache_dir, key)
+    os.utime(entry, (when, when))
+
+
+def test_key_depends_on_chain():
+    input_key = StepCache.Key('input', 'Apply-Orbit-File', {'continueOnFail':'true'})
+
+    # The order of the parameters does not matter
+    a = StepCache.Key(input_key, 'Calibration', {'outputBetaBand':'false', 'outputSigmaBand':'true'})
+    b = StepCache.Key(input_key, 'Calibration', {'outputSigmaBand':'true', 'outputBetaBand':'false'})
+    assert a == b
+
+    # The operator, its parameters and the previous steps do
+    assert a != StepCache.Key(input_key, 'Calibration', {'outputBetaBand':'true', 'outputSigmaBand':'true'})
+    assert a != StepCache.Key(input_key, 'ThermalNoiseRemoval', {'outputBetaBand':'false', 'outputSigmaBand':'true'})
+    assert a != StepCache.Key('input', 'Calibration', {'outputBetaBand':'false', 'outputSigmaBand':'true'})
+
+
+def test_input_key_uses_file_sizes(tmp_path):
+    safe = tmp_path / 'S1A_TEST.SAFE'
+    (safe / 'measurement').mkdir(parents=True)
+    (safe / 'manifest.safe').write_text('manifest')
+    (safe / 'measurement' / 'hh.tiff').write_bytes(b'\0'*10)
+
+    key = StepCache.InputKey(str(safe))
+    assert key == StepCache.InputKey(str(safe) + '/')
+
+    (safe / 'measurement' / 'hv.tiff').write_bytes(b'\0'*10)
+    assert key != StepCache.InputKey(str(safe))
+
+
+def test_put_and_get(tmp_path):
+    cache = StepCache(str(tmp_path / 'cache'))
+    assert cache.Get('abc') is None
+
+    product = _MakeProduct(str(tmp_path), 'S1A_TEST_CAL')
+    cached = cache.Put('abc', product)
+
+    assert cached == os.path.join(cache.cache_dir, 'abc', 'S1A_TEST_CAL')
+    assert cache.Get('abc') == cached
+    assert os.path.exists(cached + '.data')
+    assert not os.path.exists(product + '.dim')
+
+
+def test_trim_removes_least_recently_used(tmp_path):
+    cache = StepCache(str(tmp_path / 'cache'), max_size=None, min_age=0)
+    now = time.time()
+    for i, key in enumerate(['old', 'middle', 'new']):
+        cache.Put(key, _MakeProduct(str(tmp_path), key, size=1024**2))
+        _SetLastUse(cache, key, now - 100 + i)
+
+    # Room for two of the three products
+    cache.max_size = 2.5 / 1024
+    cache.Trim()
+
+    assert cache.Get('old') is None
+    assert cache.Get('middle') is not None
+    assert cache.Get('new') is not None
+
+
+def test_trim_keeps_recently_used(tmp_path):
+    cache = StepCache(str(tmp_path / 'cache'), max_size=None, min_age=600)
+    cache.Put('in_use', _MakeProduct(str(tmp_path), 'in_use', size=1024**2))
+    cache.Put('stale', _MakeProduct(str(tmp_path), 'stale', size=1024**2))
+    _SetLastUse(cache, 'stale', time.time() - 3600)
+
+    cache.max_size = 0.0
+    cache.Trim(keep=['kept'])
+
+    # Another process may still be reading the product used a moment ago
+    assert cache.Get('in_use') is not None
+    assert cache.Get('stale') is None
+    assert os.listdir(cache.cache_dir) == ['in_use']
@@ -0,0 +1,75 @@
+import pytest
+
+from rstools.download.catalog import ProductCatalog, _FootprintBounds
+from rstools.download.sentinel import CopernicusHub
+
+
+def _Entry(uuid, title, begin, end, footprint):
+    return {'id':uuid,
+            'title':title,
+            'date':[{'name':'beginposition', 'content':begin},
+                    {'name':'endposition', 'content':end}],
+            'str':[{'name':'footprint', 'content':footprint},
+                   {'name':'size', 'content':'1 GB'}]}
+
+
+def _Square(lon, lat, size=1.0):
+    pts = [(lon, lat), (lon+size, lat), (lon+size, lat+size), (lon, lat+size), (lon, lat)]
+    return 'POLYGON ((' + ','.join(['{} {}'.format(*pt) for pt in pts]) + '))'
+
+
+@pytest.fixture
+def catalog():
+    catalog = ProductCatalog(':memory:')
+    yield catalog
+    catalog.Close()
+
+
+def test_footprint_bounds():
+    assert _FootprintBounds(_Square(-50.5, 70.0, 2.0)) == (-50.5, -48.5, 70.0, 72.0)
+    assert _FootprintBounds('') is None
+
+
+def test_query_by_time_and_bbox(catalog):
+    entries = [_Entry('a', 'S1A_EW_GRDM_1SDH_20200101T100000_20200101T100100_030000_036E00_AAAA',
+                      '2020-01-01T10:00:00.000Z', '2020-01-01T10:01:00.000Z', _Square(-50, 70)),
+               _Entry('b', 'S1B_EW_GRDM_1SDH_20200102T100000_20200102T100100_019000_023E00_BBBB',
+                      '2020-01-02T10:00:00.000Z', '2020-01-02T10:01:00.000Z', _Square(-40, 70)),
+               _Entry('c', 'S1A_EW_GRDM_1SDH_20200103T100000_20200103T100100_030030_036F00_CCCC',
+                      '2020-01-03T10:00:00.000Z', '2020-01-03T10:01:00.000Z', _Square(-49.5, 70.5))]
+    catalog.AddEntries(entries, 'query', CopernicusHub.ParseName)
+
+    # Adding an entry again updates it instead of duplicating it
+    catalog.AddEntries(entries[:1], 'query', CopernicusHub.ParseName)
+
+    assert [e['id'] for e in catalog.Query('query')] == ['c', 'b', 'a']
+    assert [e['id'] for e in catalog.Query('query', sort_dir='asc', rows=2)] == ['a', 'b']
+    assert [e['id'] for e in catalog.Query('other')] == []
+
+    # Footprints intersecting a box around the first product
+    assert [e['id'] for e in catalog.Query(bbox=(-49.8, -49.2, 69.5, 70.6))] == ['c', 'a']
+    assert [e['id'] for e in catalog.Query(bbox=(-45, -44, 70, 71))] == []
+
+    assert [e['id'] for e in catalog.Query(start='2020-01-02T00:00:00.000Z', end='2020-01-02T23:59:59.999Z')] == ['b']
+
+    fields = catalog._db.execute('SELECT mission, beam_mode, product, rel_orbit FROM products WHERE uuid=?', ('a',)).fetchone()
+    assert fields == ('S1A', 'EW', 'GRD', CopernicusHub.ParseName(entries[0]['title'])['RelOrbit'])
+
+
+def test_missing_ranges(catalog):
+    assert catalog.GetMissing('query', '2020-01-01', '2020-01-31') == [('2020-01-01', '2020-01-31')]
+
+    catalog.AddSynced('query', '2020-01-05', '2020-01-10')
+    catalog.AddSynced('query', '2020-01-20', '2020-01-25')
+    catalog.AddSynced('other', '2020-01-01', '2020-01-31')
+
+    assert catalog.GetMissing('query', '2020-01-01', '2020-01-31') == [('2020-01-01', '2020-01-05'),
+                                                                         ('2020-01-10', '2020-01-20'),
+                                                                         ('2020-01-25', '2020-01-31')]
+    assert catalog.GetMissing('query', '2020-01-06', '2020-01-09') == []
+    assert catalog.GetMissing('query', '2020-01-08', '2020-01-22') == [('2020-01-10', '2020-01-20')]
+
+    # Overlapping and adjacent ranges are merged
+    catalog.AddSynced('query', '2020-01-09', '2020-01-20')
+    assert catalog._db.execute('SELECT start, end FROM synced WHERE query=? ORDER BY start', ('query',)).fetchall() == [('2020-01-05', '2020-01-25')]
+    assert catalog.GetMissing('query', '2020-01-01', '2020-01-31') == [('2020-01-01', '2020-01-05'), ('2020-01-25', '2020-01-31')]
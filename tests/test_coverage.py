@@ -0,0 +1,89 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from rstools.download.coverage import CoverageMatrix, CoverageFraction, SelectCovering, _InsideRings, _ParseRings, _SampleRegion
+
+
+REGION = [(0, 0), (4, 0), (4, 2), (0, 2), (0, 0)]
+
+
+def _Entry(uuid, footprint, begin='2020-01-01T10:00:00.000Z'):
+    return {'id':uuid,
+            'title':uuid,
+            'date':[{'name':'beginposition', 'content':begin}],
+            'str':[{'name':'footprint', 'content':footprint}]}
+
+
+def _Box(lon0, lat0, lon1, lat1):
+    return 'POLYGON (({0} {1},{2} {1},{2} {3},{0} {3},{0} {1}))'.format(lon0, lat0, lon1, lat1)
+
+
+def test_matrix_matches_point_in_polygon():
+    rng = np.random.default_rng(0)
+    footprints = []
+    for i in range(40):
+        lon, lat = rng.uniform([-1, -1], [4, 2])
+        angles = np.sort(rng.uniform(0, 2*np.pi, 7))
+        radii = rng.uniform(0.3, 1.5, 7)
+        pts = [(lon+r*np.cos(a), lat+r*np.sin(a)) for a, r in zip(angles, radii)]
+        wkt = ','.join(['{} {}'.format(*pt) for pt in pts + pts[:1]])
+        if(i%5==0):
+            footprints.append('MULTIPOLYGON ((({})), (({})))'.format(wkt, _Box(lon+2, lat, lon+3, lat+0.5)[10:-2]))
+        else:
+            footprints.append('POLYGON (({}))'.format(wkt))
+    entries = [_Entry(str(i), f) for i, f in enumerate(footprints)] + [_Entry('empty', '')]
+
+    covered, weight = CoverageMatrix(entries, REGION, resolution=40)
+    lon, lat, expected_weight = _SampleRegion(REGION, 40)
+
+    assert covered.shape == (len(entries), len(lon))
+    np.testing.assert_allclose(weight, expected_weight)
+    for i, footprint in enumerate(footprints):
+        assert np.array_equal(covered[i], _InsideRings(_ParseRings(footprint), lon, lat))
+    assert not np.any(covered[-1])
+
+
+def test_fraction():
+    entries = [_Entry('all', _Box(-1, -1, 5, 3)),
+               _Entry('west', _Box(-1, -1, 2, 3)),
+               _Entry('none', _Box(10, 10, 11, 11))]
+    fractions = CoverageFraction(entries, REGION, resolution=101)
+
+    assert fractions[0] == pytest.approx(1.0)
+    assert fractions[1] == pytest.approx(0.5, abs=0.02)
+    assert fractions[2] == 0.0
+
+
+def test_select_covering():
+    entries = [_Entry('west', _Box(-1, -1, 2.1, 3)),
+               _Entry('middle', _Box(1, -1, 3, 3)),
+               _Entry('east', _Box(1.9, -1, 5, 3)),
+               _Entry('small', _Box(0, 0, 1, 1)),
+               _Entry('next_day', _Box(-1, -1, 5, 3), '2020-01-02T10:00:00.000Z')]
+
+    selected = SelectCovering(entries, REGION, target=0.99)
+    assert sorted([e['id'] for e in selected]) == ['east', 'next_day', 'west']
+
+    # A single window chooses the product that covers everything
+    selected = SelectCovering(entries, REGION, target=0.99, window=None)
+    assert [e['id'] for e in selected] == ['next_day']
+
+    # Windows start at multiples of their length since 1970-01-01, so both
+    # days are in the same two day window
+    selected = SelectCovering(entries, REGION, target=0.99, window=datetime.timedelta(days=2))
+    assert [e['id'] for e in selected] == ['next_day']
+
+    assert SelectCovering([], REGION) == []
+
+
+def test_small_region():
+    # No grid point falls inside a very thin region, so its vertices are used
+    region = [(0, 0), (1, 1e-9), (2, 0)]
+    lon, lat, weight = _SampleRegion(region, 10)
+    assert len(lon) > 0
+    assert weight.sum() == pytest.approx(1.0)
+
+    with pytest.raises(RuntimeError):
+        _SampleRegion([(0, 0), (1, 1)], 10)
@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+
+from rstools.processing.dimap import DimapProduct, ReadEnviBand, ReadEnviHeader
+
+
+DIM = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<Dimap_Document name="TEST.dim">
+    <Coordinate_Reference_System>
+        <WKT>PROJCS["NSIDC Sea Ice Polar Stereographic North"]</WKT>
+    </Coordinate_Reference_System>
+    <Geoposition>
+        <IMAGE_TO_MODEL_TRANSFORM>40.0,1.0,2.0,-40.0,-1000.0,5000.0</IMAGE_TO_MODEL_TRANSFORM>
+    </Geoposition>
+    <Raster_Dimensions>
+        <NCOLS>4</NCOLS>
+        <NROWS>3</NROWS>
+        <NBANDS>3</NBANDS>
+    </Raster_Dimensions>
+    <Data_Access>
+        <Data_File>
+            <DATA_FILE_PATH href="TEST.data/Sigma0_HH.hdr" />
+            <BAND_INDEX>0</BAND_INDEX>
+        </Data_File>
+        <Data_File>
+            <DATA_FILE_PATH href="TEST.data/mask.hdr" />
+            <BAND_INDEX>1</BAND_INDEX>
+        </Data_File>
+        <Tie_Point_Grid_File>
+            <TIE_POINT_GRID_FILE_PATH href="TEST.data/tie_point_grids/latitude.hdr" />
+            <TIE_POINT_GRID_INDEX>0</TIE_POINT_GRID_INDEX>
+        </Tie_Point_Grid_File>
+    </Data_Access>
+    <Tie_Point_Grids>
+        <Tie_Point_Grid_Info>
+            <TIE_POINT_GRID_INDEX>0</TIE_POINT_GRID_INDEX>
+            <TIE_POINT_GRID_NAME>latitude</TIE_POINT_GRID_NAME>
+            <OFFSET_X>0.5</OFFSET_X>
+            <OFFSET_Y>0.5</OFFSET_Y>
+            <STEP_X>3.0</STEP_X>
+            <STEP_Y>2.0</STEP_Y>
+        </Tie_Point_Grid_Info>
+    </Tie_Point_Grids>
+    <Image_Interpretation>
+        <Spectral_Band_Info>
+            <BAND_INDEX>0</BAND_INDEX>
+            <BAND_NAME>Sigma0_HH</BAND_NAME>
+            <PHYSICAL_UNIT>intensity</PHYSICAL_UNIT>
+            <NO_DATA_VALUE_USED>true</NO_DATA_VALUE_USED>
+            <NO_DATA_VALUE>0.0</NO_DATA_VALUE>
+        </Spectral_Band_Info>
+        <Spectral_Band_Info>
+            <BAND_INDEX>1</BAND_INDEX>
+            <BAND_NAME>mask</BAND_NAME>
+            <SCALING_FACTOR>0.5</SCALING_FACTOR>
+            <SCALING_OFFSET>1.0</SCALING_OFFSET>
+        </Spectral_Band_Info>
+        <Spectral_Band_Info>
+            <BAND_INDEX>2</BAND_INDEX>
+            <BAND_NAME>virtual</BAND_NAME>
+            <EXPRESSION>Sigma0_HH * 2</EXPRESSION>
+        </Spectral_Band_Info>
+    </Image_Interpretation>
+</Dimap_Document>
+"""
+
+
+def _WriteBand(filename, data, data_type, byte_order):
+    """ Writes an ENVI .hdr/.img pair in the way SNAP does. """
+    with open(filename + '.hdr', 'w') as f:
+        f.write('ENVI\n')
+        f.write('description = {Sentinel-1 IW Level-1 GRD Product\n    - Unknown}\n')
+        f.write('samples = {}\nlines = {}\nbands = 1\nheader offset = 0\n'.format(data.shape[1], data.shape[0]))
+        f.write('file type = ENVI Standard\ndata type = {}\ninterleave = bsq\n'.format(data_type))
+        f.write('byte order = {}\nband names = {{ {} }}\n'.format(byte_order, filename.split('/')[-1]))
+    data.tofile(filename + '.img')
+
+
+@pytest.fixture
+def product(tmp_path):
+    folder = tmp_path / 'TEST.data'
+    (folder / 'tie_point_grids').mkdir(parents=True)
+    (tmp_path / 'TEST.dim').write_text(DIM)
+
+    # SNAP writes big endian data (byte order = 1)
+    _WriteBand(str(folder / 'Sigma0_HH'), np.arange(12, dtype='>f4').reshape(3, 4), 4, 1)
+    _WriteBand(str(folder / 'mask'), np.arange(12, dtype='<u2').reshape(3, 4), 12, 0)
+    _WriteBand(str(folder / 'tie_point_grids' / 'latitude'), np.array([[70.0, 71.0], [72.0, 73.0]], dtype='>f4'), 4, 1)
+    return str(tmp_path / 'TEST')
+
+
+def test_envi_header(product):
+    header = ReadEnviHeader(product + '.data/Sigma0_HH.hdr')
+    assert header['samples'] == '4'
+    assert header['data type'] == '4'
+    assert header['description'] == 'Sentinel-1 IW Level-1 GRD Product - Unknown'
+    assert header['band names'] == 'Sigma0_HH'
+
+    with pytest.raises(ValueError):
+        ReadEnviHeader(product + '.dim')
+
+
+def test_envi_band(product):
+    band = ReadEnviBand(product + '.data/Sigma0_HH.img')
+    assert band.dtype == np.dtype('>f4')
+    assert band.shape == (3, 4)
+    np.testing.assert_array_equal(band, np.arange(12).reshape(3, 4))
+
+    mask = ReadEnviBand(product + '.data/mask.img')
+    assert mask.dtype == np.dtype('<u2')
+    np.testing.assert_array_equal(mask[1:, 2:], [[6, 7], [10, 11]])
+
+
+def test_dimap_product(product):
+    dim = DimapProduct(product + '.dim')
+    assert (dim.width, dim.height) == (4, 3)
+    assert dim.BandNames() == ['Sigma0_HH', 'mask']
+    assert 'virtual' not in dim
+    assert dim.units['Sigma0_HH'] == 'intensity'
+    assert dim.nodata == {'Sigma0_HH':0.0, 'mask':None}
+    assert dim.scaling == {'Sigma0_HH':(1.0, 0.0), 'mask':(0.5, 1.0)}
+    np.testing.assert_array_equal(dim['Sigma0_HH'][2], [8, 9, 10, 11])
+
+    # IMAGE_TO_MODEL_TRANSFORM is stored as m00,m10,m01,m11,m02,m12
+    assert dim.crs.startswith('PROJCS')
+    assert dim.transform == (40.0, 2.0, -1000.0, 1.0, -40.0, 5000.0)
+
+
+def test_dimap_write(product):
+    dim = DimapProduct(product, mode='r+')
+    dim['Sigma0_HH'][0, 0] = 5.0
+    dim['Sigma0_HH'].flush()
+    del dim
+
+    assert DimapProduct(product)['Sigma0_HH'][0, 0] == 5.0
+
+
+def test_tie_point_grid(product):
+    dim = DimapProduct(product)
+    grid = dim.tie_point_grids['latitude']
+    assert (grid['step_x'], grid['step_y']) == (3.0, 2.0)
+
+    # The tie points are at the centres of pixels (0,0), (0,3), (2,0) and (2,3)
+    lat = dim.TiePointGrid('latitude', [0, 1, 2], [0, 3])
+    np.testing.assert_allclose(lat, [[70.0, 71.0], [71.0, 72.0], [72.0, 73.0]])
+
+    with pytest.raises(ValueError):
+        dim.LatLon([0], [0])
@@ -0,0 +1,259 @@
+import hashlib
+import os
+import threading
+
+import pytest
+import requests
+
+from rstools.download import sentinel
+from rstools.download.sentinel import CopernicusHub
+from rstools.download.retry import RetryPolicy
+
+
+URL = "https://scihub.copernicus.eu/dhus/odata/v1/Products('1234')/$value"
+NAME = 'S1A_EW_GRDM_1SDH_20200101T000000_20200101T000100_030000_037000_ABCD'
+DATA = bytes(range(256))*4
+
+
+class _Raw:
+    """ The body of a fake response, which can fail after `fail_after` bytes. """
+    def __init__(self, data, fail_after=None):
+        self.data = data
+        self.pos = 0
+        self.fail_after = fail_after
+        self.decode_content = False
+
+    def readinto(self, view):
+        if(self.fail_after is not None and self.pos>=self.fail_after):
+            raise OSError('Connection reset by peer')
+        end = len(self.data) if self.fail_after is None else self.fail_after
+        num = min(len(view), end-self.pos)
+        view[:num] = self.data[self.pos:self.pos+num]
+        self.pos += num
+        return num
+
+
+class _Response:
+    def __init__(self, status_code, headers=None, body=b'', json=None, fail_after=None):
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.raw = _Raw(body, fail_after)
+        self.content = body
+        self._json = json
+
+    def json(self):
+        if(self._json is None):
+            raise ValueError('No JSON')
+        return self._json
+
+    def close(self):
+        pass
+
+
+class _FakeSession:
+    """ Serves one product like the OData API.  Each entry of `failures` is
+        used for one download response, in order: an int breaks the body
+        after that many bytes, 'corrupt' sends altered data, 'range' sends
+        the wrong Content-Range and 'ignore' ignores the Range header.
+        `range_failures` does the same for range requests starting at a given
+        byte, since segments are requested in no particular order.
+    """
+    def __init__(self, data=DATA, etag='"v1"', checksum=None):
+        self.data = data
+        self.etag = etag
+        self.checksum = hashlib.md5(data).hexdigest() if checksum is None else checksum
+        self.failures = []
+        self.range_failures = dict()
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def get(self, url, headers=None, params=None, **kwargs):
+        if(not url.endswith('/$value')):
+            # Product properties, or a search by name from VerifyArchive
+            info = dict()
+            if(self.checksum is not False):
+                info['Checksum'] = {'Algorithm':'MD5', 'Value':self.checksum.upper()}
+            if(url.endswith('/Products')):
+                return _Response(200, json={'d':{'results':[info]}})
+            return _Response(200, json={'d':info})
+
+        rng = (headers or {}).get('Range')
+        with self.lock:
+            failure = self.failures.pop(0) if len(self.failures)>0 else None
+            if(rng is not None):
+                failure = self.range_failures.pop(int(rng.split('=')[1].split('-')[0]), failure)
+
+        data = self.data
+        if(failure=='corrupt'):
+            data = data[::-1]
+
+        out = {'content-disposition':'attachment; filename="{}.zip"'.format(NAME), 'accept-ranges':'bytes'}
+        if(self.etag is not None):
+            out['etag'] = self.etag
+
+        if(rng is None or failure=='ignore' or (headers.get('If-Range') not in [None, self.etag])):
+            out['content-length'] = str(len(data))
+            return _Response(200, out, data, fail_after=failure if isinstance(failure, int) else None)
+
+        first, last = [int(x) for x in rng.split('=')[1].split('-')]
+        with self.lock:
+            self.ranges.append((first, last))
+        out['content-length'] = str(last+1-first)
+        out['content-range'] = 'bytes {}-{}/{}'.format(first, last, len(data))
+        if(failure=='range'):
+            out['content-range'] = 'bytes 0-{}/{}'.format(last-first, len(data))
+        return _Response(206, out, data[first:last+1], fail_after=failure if isinstance(failure, int) else None)
+
+
+def _Hub(session, buffer_size=100):
+    hub = CopernicusHub('user', 'password', max_downloads=4, buffer_size=buffer_size,
+                        retry_policy=RetryPolicy(max_retries=3, backoff_factor=0.0, jitter=0.0))
+    hub._session = session
+    return hub
+
+
+def _Download(hub, folder, **kwargs):
+    filename = hub.DownloadProduct(str(folder), URL, **kwargs)
+    with open(os.path.join(str(folder), filename), 'rb') as f:
+        return f.read()
+
+
+def test_resume_after_partial_write(tmp_path):
+    session = _FakeSession()
+    session.failures = [350]
+    hub = _Hub(session)
+
+    assert _Download(hub, tmp_path) == DATA
+    assert session.ranges == [(350, len(DATA)-1)]
+    assert hub.download_stats[URL].attempts == 2
+    assert os.listdir(str(tmp_path)) == [NAME + '.zip']
+
+
+def test_etag_change_restarts(tmp_path):
+    session = _FakeSession()
+    session.failures = [350]
+    hub = _Hub(session)
+    hub.retry_policy.max_retries = 0
+    with pytest.raises(RuntimeError):
+        hub.DownloadProduct(str(tmp_path), URL)
+    assert os.path.getsize(str(tmp_path/(NAME+'.zip.part'))) == 350
+
+    # The product was replaced on the server
+    session.data = DATA[::-1]
+    session.etag = '"v2"'
+    session.checksum = hashlib.md5(session.data).hexdigest()
+    assert _Download(hub, tmp_path) == DATA[::-1]
+    assert session.ranges == []
+
+
+def test_no_etag_restarts(tmp_path):
+    session = _FakeSession(etag=None)
+    session.failures = [350]
+    hub = _Hub(session)
+
+    assert _Download(hub, tmp_path) == DATA
+    assert session.ranges == []
+    assert hub.download_stats[URL].attempts == 2
+
+
+@pytest.mark.parametrize('failure', ['range', 'ignore'])
+def test_bad_range_response_restarts(tmp_path, failure):
+    session = _FakeSession()
+    session.failures = [350, None, failure]
+    hub = _Hub(session)
+
+    assert _Download(hub, tmp_path) == DATA
+    assert hub.download_stats[URL].attempts == 3
+    assert os.listdir(str(tmp_path)) == [NAME + '.zip']
+
+
+def test_split_range():
+    hub = CopernicusHub('user', 'password')
+    assert hub._SplitRange(10, 100, 4) == [[10, 31], [32, 54], [55, 76], [77, 99]]
+    assert hub._SplitRange(0, 100, 1) == [[0, 99]]
+    assert hub._SplitRange(97, 100, 5) == [[97, 97], [98, 98], [99, 99]]
+
+    for start, total, num in [(0, 1000, 3), (5, 7, 2), (0, 1, 8)]:
+        ranges = hub._SplitRange(start, total, num)
+        assert ranges[0][0] == start and ranges[-1][1] == total-1
+        assert all(a[1]+1==b[0] for a, b in zip(ranges[:-1], ranges[1:]))
+
+
+def test_segmented_download(tmp_path):
+    session = _FakeSession()
+    hub = _Hub(session)
+
+    assert _Download(hub, tmp_path, segments=3) == DATA
+    assert sorted(session.ranges) == [(0, 340), (341, 681), (682, 1023)]
+
+
+def test_segmented_resume(tmp_path):
+    session = _FakeSession()
+    session.range_failures = {341:100}
+    hub = _Hub(session)
+
+    assert _Download(hub, tmp_path, segments=3) == DATA
+    assert hub.download_stats[URL].attempts == 2
+    assert len(session.ranges) == 4 and session.ranges[-1] == (441, 681)
+    assert os.listdir(str(tmp_path)) == [NAME + '.zip']
+
+
+def test_segmented_remote_change(tmp_path):
+    session = _FakeSession()
+    session.range_failures = {341:'range'}
+    hub = _Hub(session)
+
+    assert _Download(hub, tmp_path, segments=3) == DATA
+    assert hub.download_stats[URL].attempts == 2
+    assert len(session.ranges) == 6
+
+
+def test_limit_segments():
+    hub = CopernicusHub('user', 'password', max_downloads=4)
+    assert hub.LimitSegments(4, 1) == 4
+    assert hub.LimitSegments(4, 2) == 2
+    assert hub.LimitSegments(4, 3) == 1
+    assert hub.LimitSegments(1, 4) == 1
+    assert hub.LimitSegments(0, 1) == 1
+
+
+def test_checksum_mismatch_retries(tmp_path):
+    session = _FakeSession()
+    session.failures = ['corrupt']
+    hub = _Hub(session)
+
+    assert _Download(hub, tmp_path) == DATA
+    assert hub.download_stats[URL].attempts == 2
+
+
+@pytest.mark.parametrize('segments', [1, 3])
+def test_checksum_mismatch_fails(tmp_path, segments):
+    session = _FakeSession(checksum=hashlib.md5(b'other').hexdigest())
+    hub = _Hub(session)
+
+    with pytest.raises(RuntimeError, match='checksum'):
+        hub.DownloadProduct(str(tmp_path), URL, segments=segments)
+    assert hub.download_stats[URL].attempts == 4
+    assert os.listdir(str(tmp_path)) == []
+
+    # Without verification the file is kept
+    assert _Download(hub, tmp_path, segments=segments, verify=False) == DATA
+
+
+def test_hash_file(tmp_path):
+    filename = str(tmp_path/'data.bin')
+    with open(filename, 'wb') as f:
+        f.write(DATA)
+
+    assert sentinel._HashFile(filename, block_size=100).hexdigest() == hashlib.md5(DATA).hexdigest()
+    assert sentinel._HashFile(filename, 'sha256', 350, 100).hexdigest() == hashlib.sha256(DATA[:350]).hexdigest()
+
+
+@pytest.mark.parametrize('checksum, status', [(None, True), ('0'*32, False), (False, None)])
+def test_verify_archive(tmp_path, checksum, status):
+    with open(str(tmp_path/(NAME+'.zip')), 'wb') as f:
+        f.write(DATA)
+
+    session = _FakeSession(checksum=checksum)
+    hub = _Hub(session)
+    assert hub.VerifyArchive(str(tmp_path)) == {NAME+'.zip':status}
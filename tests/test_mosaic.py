@@ -0,0 +1,139 @@
+import datetime
+import json
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from rstools.processing import mosaic as m
+from rstools.processing.mosaic import DailyMosaic
+
+
+DAY = datetime.date(2020, 1, 1)
+
+
+class _Scene:
+    """ A fake single band scene with a constant value over a range of
+        columns of the mosaic.
+    """
+    def __init__(self, value, first_col, last_col):
+        self.value = value
+        self.cols = (first_col, last_col)
+        self.count = 1
+        self.nodata = None
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def scenes(monkeypatch):
+    """ Replaces rasterio in the mosaic module.  The transform of a tile is
+        its window, so the fake reprojection knows which columns it covers.
+    """
+    files = dict()
+    calls = []
+    def reproject(src, dst, dst_transform=None, **kwargs):
+        calls.append(src)
+        col_off, row_off, width, height = dst_transform
+        cols = np.arange(col_off, col_off+width)
+        covered = (cols>=src.cols[0]) & (cols<=src.cols[1])
+        dst[:, :, covered] = src.value
+
+    monkeypatch.setattr(m, 'rasterio', SimpleNamespace(band=lambda src, idx: src))
+    monkeypatch.setattr(m, '_OpenSources', lambda filename: [files[filename]])
+    monkeypatch.setattr(m, 'reproject', reproject, raising=False)
+    monkeypatch.setattr(m, 'Window', lambda *window: window, raising=False)
+    monkeypatch.setattr(m, 'window_transform', lambda window, transform: window, raising=False)
+    monkeypatch.setattr(m, 'Affine', lambda *transform: transform, raising=False)
+    monkeypatch.setattr(m, 'Resampling', {'bilinear':'bilinear'}, raising=False)
+    return files, calls
+
+
+def _Mosaic(tmp_path, method):
+    """ A mosaic of 4 rows and 6 columns split into two tiles. """
+    return DailyMosaic(str(tmp_path), bounds=(0, 0, 600, 400), resolution=100, method=method, tile_size=3)
+
+
+def _Composite(mosaic, scenes):
+    """ Adds (filename, start) scenes to every tile, like `DailyMosaic.Add`. """
+    mosaic._Open(DAY, 1)
+    name = mosaic._Name(DAY)
+    for col in [0, 3]:
+        m._CompositeTile(name + '.npy', name + '_state.npy', os.path.join(name + '_tiles', '0_{}.json'.format(col)),
+                         mosaic.method, scenes, mosaic.crs, mosaic.transform, (col, 0, 3, 4), mosaic.resampling)
+    return np.array(mosaic.Read(DAY))[0]
+
+
+def test_recent(tmp_path, scenes):
+    files, calls = scenes
+    files['old.tif'] = _Scene(1.0, 0, 3)
+    files['new.tif'] = _Scene(2.0, 2, 4)
+    mosaic = _Mosaic(tmp_path, 'recent')
+
+    # The newest scene is kept even if it is added first
+    result = _Composite(mosaic, [('new.tif', 200), ('old.tif', 100)])
+    np.testing.assert_array_equal(result, np.tile([1, 1, 2, 2, 2, np.nan], (4, 1)))
+
+    # Scenes that were already added are skipped
+    num_calls = len(calls)
+    files['new.tif'].value = 5.0
+    np.testing.assert_array_equal(_Composite(mosaic, [('new.tif', 200)]), result)
+    assert len(calls) == num_calls
+
+    with open(os.path.join(mosaic._Name(DAY) + '_tiles', '0_0.json')) as f:
+        assert json.load(f) == ['new.tif', 'old.tif']
+
+
+def test_mean(tmp_path, scenes):
+    files, calls = scenes
+    files['a.tif'] = _Scene(1.0, 0, 5)
+    files['b.tif'] = _Scene(3.0, 2, 5)
+    files['c.tif'] = _Scene(8.0, 5, 5)
+    mosaic = _Mosaic(tmp_path, 'mean')
+
+    _Composite(mosaic, [('a.tif', 100), ('b.tif', 200)])
+    result = _Composite(mosaic, [('a.tif', 100), ('c.tif', 300)])
+    np.testing.assert_allclose(result[0], [1, 1, 2, 2, 2, 4])
+    np.testing.assert_array_equal(np.load(mosaic._Name(DAY) + '_state.npy')[0], [1, 1, 2, 2, 2, 3])
+
+
+def test_journal_replay(tmp_path, scenes, monkeypatch):
+    files, calls = scenes
+    files['a.tif'] = _Scene(1.0, 0, 5)
+    files['b.tif'] = _Scene(3.0, 0, 5)
+    mosaic = _Mosaic(tmp_path, 'mean')
+    _Composite(mosaic, [('a.tif', 100)])
+
+    # Interrupt the update after the journal and the mosaic were written, but
+    # before the scenes of the tile were recorded
+    def interrupt(filename, value):
+        raise KeyboardInterrupt()
+    with monkeypatch.context() as patch:
+        patch.setattr(m, '_WriteJson', interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            _Composite(mosaic, [('a.tif', 100), ('b.tif', 200)])
+
+    tiles = mosaic._Name(DAY) + '_tiles'
+    assert os.path.exists(os.path.join(tiles, '0_0.npz'))
+
+    # Repeating the update finishes it without averaging b.tif twice
+    num_calls = len(calls)
+    result = _Composite(mosaic, [('a.tif', 100), ('b.tif', 200)])
+    np.testing.assert_allclose(result, 2.0)
+    assert len(calls) == num_calls + 1
+    assert sorted(os.listdir(tiles)) == ['0_0.json', '0_3.json']
+
+
+def test_open(tmp_path):
+    mosaic = _Mosaic(tmp_path, 'recent')
+    info = mosaic._Open(DAY, 2)
+    assert (info['width'], info['height'], info['count']) == (6, 4, 2)
+    assert mosaic.Read(DAY).shape == (2, 4, 6)
+    assert np.isnan(mosaic.Read(DAY)).all()
+    assert mosaic.Days() == [DAY]
+
+    other = DailyMosaic(str(tmp_path), bounds=(0, 0, 600, 400), resolution=100, method='recent', tile_size=2)
+    with pytest.raises(ValueError):
+        other._Open(DAY, 2)
@@ -0,0 +1,136 @@
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from rstools.processing import sentinel
+from rstools.processing.sentinel import SentinelProcessor
+
+
+@pytest.fixture
+def native_calls(monkeypatch):
+    """ Replaces the native functions by ones that record their calls and
+        write empty outputs.
+    """
+    calls = []
+    def calibrate(input_name, output, polarization, db=False):
+        calls.append(('CalibrateGRD', input_name, output, db))
+        open(output, 'w').close()
+    def to_db(input_name, output):
+        calls.append(('LinearToDB', input_name, output))
+        open(output, 'w').close()
+
+    monkeypatch.setattr(sentinel, 'CalibrateGRD', calibrate)
+    monkeypatch.setattr(sentinel, 'LinearToDB', to_db)
+    return calls
+
+
+def _Processor(tmp_path, lazy):
+    return SentinelProcessor(str(tmp_path / 'S1A_TEST.zip'), gpt_path='gpt', out_dir=str(tmp_path / 'out'), lazy=lazy)
+
+
+@pytest.mark.parametrize('lazy', [True, False])
+def test_snap_step_after_native_step(tmp_path, native_calls, lazy):
+    proc = _Processor(tmp_path, lazy)
+    proc.ApplyCalibration(backend='native')
+    with pytest.raises(ValueError):
+        proc.Subset([(0, 0), (1, 0), (1, 1)])
+    with pytest.raises(ValueError):
+        proc.Reproject('3413')
+    assert proc.pending_steps == []
+
+
+@pytest.mark.parametrize('lazy', [True, False])
+def test_native_db_and_write(tmp_path, native_calls, lazy):
+    proc = _Processor(tmp_path, lazy)
+    proc.ApplyCalibration(backend='native')
+    proc.ConvertToDB(backend='native')
+    proc.Write('GeoTiff')
+
+    if(lazy):
+        # The conversion is done in the same pass as the calibration
+        assert [call[0] for call in native_calls] == ['CalibrateGRD']
+        assert native_calls[0][3]
+    else:
+        assert [call[0] for call in native_calls] == ['CalibrateGRD', 'LinearToDB']
+    assert proc.newest_output == str(tmp_path / 'out' / 'S1A_TEST_Processed')
+    assert (tmp_path / 'out' / 'S1A_TEST_Processed.tif').exists()
+
+
+def test_native_db_needs_native_input(tmp_path):
+    proc = _Processor(tmp_path, True)
+    with pytest.raises(ValueError):
+        proc.ConvertToDB(backend='native')
+
+
+def _RunLazy(proc):
+    """ Runs the recorded steps with a fake gpt and returns the nodes of each
+        graph as lists of (id, operator, source, parameters).
+    """
+    graphs = []
+    def run_gpt(args, step, operators, input_name, output_name):
+        root = ET.parse(args[-1]).getroot()
+        nodes = []
+        for node in root.findall('node'):
+            source = node.find('sources/sourceProduct')
+            params = {p.tag:p.text for p in node.find('parameters')}
+            nodes.append((node.get('id'), node.find('operator').text, None if source is None else source.get('refid'), params))
+        graphs.append(nodes)
+    proc._RunGpt = run_gpt
+    proc.Run()
+    return graphs
+
+
+def test_graph_wiring(tmp_path):
+    proc = _Processor(tmp_path, True)
+    proc.ApplyOrbit()
+    proc.ApplyCalibration()
+    proc.Write('GeoTiff')
+    graphs = _RunLazy(proc)
+
+    assert len(graphs) == 1
+    nodes = graphs[0]
+    assert [node[:3] for node in nodes] == [('Read', 'Read', None),
+                                           ('Apply-Orbit-File(1)', 'Apply-Orbit-File', 'Read'),
+                                           ('Calibration(2)', 'Calibration', 'Apply-Orbit-File(1)'),
+                                           ('Write(3)', 'Write', 'Calibration(2)')]
+    assert nodes[0][3] == {'file':str(tmp_path / 'S1A_TEST.zip')}
+    assert nodes[-1][3] == {'formatName':'GeoTiff', 'file':str(tmp_path / 'out' / 'S1A_TEST_Processed')}
+    assert proc.pending_steps == []
+
+
+def test_graph_without_write(tmp_path):
+    proc = _Processor(tmp_path, True)
+    proc.ApplyCalibration()
+    nodes = _RunLazy(proc)[0]
+
+    # The result is written to a BEAM-DIMAP product for later steps
+    assert [node[1] for node in nodes] == ['Read', 'Calibration', 'Write']
+    assert nodes[-1][3]['formatName'] == 'BEAM-DIMAP'
+    assert proc.newest_output == nodes[-1][3]['file']
+
+
+def test_subsets_moved_early(tmp_path):
+    proc = _Processor(tmp_path, True)
+    proc.ApplyOrbit()
+    proc.ApplyCalibration()
+    proc.Reproject('3413')
+    proc.Subset([(0, 0), (2, 0), (2, 2)], early=False)
+    proc.Subset([(0, 0), (1, 0), (1, 1)])
+    proc.Write('GeoTiff')
+
+    nodes = _RunLazy(proc)[0]
+    assert [node[1] for node in nodes] == ['Read', 'Apply-Orbit-File', 'Calibration', 'Subset', 'Reproject', 'Subset', 'Write']
+    assert '1.0' in nodes[3][3]['geoRegion'] and '2.0' in nodes[5][3]['geoRegion']
+    assert all(node[2]==prev[0] for prev, node in zip(nodes[:-1], nodes[1:]))
+
+
+def test_move_subsets_early(tmp_path):
+    proc = _Processor(tmp_path, True)
+    steps = [{'operator':'Subset', 'early':True},
+             {'operator':'Apply-Orbit-File'},
+             {'operator':'Reproject'},
+             {'operator':'ThermalNoiseRemoval'},
+             {'operator':'Write'}]
+    moved = proc._MoveSubsetsEarly(steps)
+    assert [step['operator'] for step in moved] == ['Apply-Orbit-File', 'Reproject', 'ThermalNoiseRemoval', 'Subset', 'Write']
+    assert proc._MoveSubsetsEarly(steps[1:]) == steps[1:]
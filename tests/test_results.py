@@ -0,0 +1,56 @@
+import numpy as np
+
+from rstools.download.results import SearchResults
+from rstools.download.sentinel import CopernicusHub
+
+
+TITLES = ['S1A_IW_GRDH_1SDV_20200629T174145_20200629T174210_033235_03D9B9_D763',
+          'S1B_EW_GRDM_1SDH_20191231T235959_20200101T000103_019283_02468A_0F1E.SAFE',
+          'S1A_IW_SLC__1SSH_20210314T061502_20210314T061529_036983_045A2F_9C1B',
+          'S1B_EW_OCN__2SDH_20180701T120000_20180701T120100_011612_015541_ABCD',
+          'S1A_EW_GRDM_1SDH_20150101T010203_20150101T010303_000074_000001_0001']
+
+
+def _Entries(titles):
+    return [{'id':str(i), 'title':title} for i, title in enumerate(titles)]
+
+
+def test_matches_parse_name():
+    results = SearchResults(_Entries(TITLES))
+    for i, title in enumerate(TITLES):
+        assert results.GetInfo(i) == CopernicusHub.ParseName(title)
+
+
+def test_columns():
+    results = SearchResults(_Entries(TITLES))
+
+    assert list(results.mission) == ['S1A', 'S1B', 'S1A', 'S1B', 'S1A']
+    assert list(results.product) == ['GRD', 'GRD', 'SLC', 'OCN', 'GRD']
+    assert list(results.level) == [1, 1, 1, 2, 1]
+    assert list(results.rel_orbit) == [CopernicusHub.ParseName(t)['RelOrbit'] for t in TITLES]
+    assert results.start_time[1] == np.datetime64('2019-12-31T23:59:59')
+
+
+def test_other_names():
+    results = SearchResults(_Entries(['S2A_MSIL1C_20200101T000000_N0208_R001_T01ABC_20200101T000000', TITLES[0]]))
+
+    assert list(results.mission) == ['', 'S1A']
+    assert results.abs_orbit[0] == -1
+    assert np.isnat(results.start_time[0])
+    assert results.GetInfo(1) == CopernicusHub.ParseName(TITLES[0])
+
+
+def test_filter_and_sort():
+    results = SearchResults(_Entries(TITLES))
+
+    ew = results.Filter(beam_mode='EW', product=['GRD', 'OCN'])
+    assert [entry['id'] for entry in ew] == ['1', '3', '4']
+    assert list(ew.polarization) == ['DH', 'DH', 'DH']
+
+    ordered = results.Sort('start_time', descending=True)
+    assert [entry['title'] for entry in ordered][0] == TITLES[2]
+    assert ordered[0] is results[2]
+    assert ordered.GetInfo(0) == CopernicusHub.ParseName(TITLES[2])
+
+    assert len(results[results.rel_orbit<0]) == 0
+    assert len(SearchResults([])) == 0
@@ -0,0 +1,94 @@
+import datetime
+import re
+
+import pytest
+
+from rstools.download.sentinel import CopernicusHub
+
+
+START = datetime.datetime(2020, 1, 1)
+
+
+def _Entry(name, begin, end):
+    """ A search result whose begin and end positions are given in minutes
+        after START.
+    """
+    dates = [('beginposition', begin), ('endposition', end)]
+    return {'id':name, 'title':name,
+            'date':[{'name':field, 'content':(START + datetime.timedelta(minutes=m)).strftime('%Y-%m-%dT%H:%M:%S.000Z')} for field, m in dates]}
+
+
+class _Response:
+    def __init__(self, value):
+        self.status_code = 200
+        self.value = value
+
+    def json(self):
+        return self.value
+
+
+class _FakeSession:
+    """ Answers search requests like the API, which returns at most 100
+        entries per page.
+    """
+    def __init__(self, entries):
+        self.entries = entries
+        self.requests = []
+
+    def get(self, url, params=None, **kwargs):
+        self.requests.append(params)
+        first, last = '', 'NOW'
+        if('endposition' in params['q']):
+            first, last = re.search(r'endposition:\[(\S+) TO (\S+)\]', params['q']).groups()
+
+        def date(entry, field):
+            return [d['content'] for d in entry['date'] if d['name']==field][0]
+
+        field, direction = params['orderby'].split()
+        matches = [e for e in self.entries if first<=date(e, 'endposition')<=last]
+        matches.sort(key=lambda e: date(e, field), reverse=(direction=='desc'))
+
+        page = matches[params['start']:params['start']+min(params['rows'], 100)]
+        return _Response({'feed':{'opensearch:totalResults':str(len(matches)), 'entry':page}})
+
+
+def _Hub(entries):
+    hub = CopernicusHub('user', 'password')
+    hub._session = _FakeSession(entries)
+    return hub
+
+
+# The first product starts before the second one, but ends after it
+ENTRIES = [_Entry('long', 50, 90), _Entry('short', 55, 56), _Entry('next', 70, 71), _Entry('last', 100, 101)]
+
+
+@pytest.mark.parametrize('sort_dir', ['asc', 'desc'])
+@pytest.mark.parametrize('rows', [None, 1, 2, 3])
+def test_sharded_search(sort_dir, rows):
+    hub = _Hub(ENTRIES)
+    results = hub.Search(rows=rows, sort_dir=sort_dir, shard_width=datetime.timedelta(minutes=20), max_workers=1,
+                         start_date=START + datetime.timedelta(minutes=40), end_date=START + datetime.timedelta(minutes=120))
+
+    expected = ['short', 'next', 'long', 'last']
+    if(sort_dir=='desc'):
+        expected = expected[::-1]
+    assert [e['id'] for e in results] == expected[:rows]
+    assert all(params['orderby']=='endposition '+sort_dir for params in hub._session.requests)
+
+    # Later intervals are not searched once the first ones hold `rows` products
+    if(rows==1):
+        assert len(hub._session.requests) == 1
+
+
+def test_page_size():
+    hub = _Hub([_Entry(str(i), i, i+1) for i in range(250)])
+
+    results = hub.Search(rows=220, sort_dir='asc')
+    assert [e['id'] for e in results] == [str(i) for i in range(220)]
+    assert [params['rows'] for params in hub._session.requests] == [100, 100, 100]
+
+    hub._session.requests = []
+    results = hub.SearchIter(page_size=500, sort_dir='desc')
+    assert results.total == 250
+    assert [e['id'] for e in results] == [str(i) for i in reversed(range(250))]
+    assert [(params['start'], params['rows']) for params in hub._session.requests] == [(0, 100), (100, 100), (200, 100)]
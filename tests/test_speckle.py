@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from rstools.processing.native import _FilterBand
+
+
+def _Lee(x, values, looks):
+    """ The Lee filter of one pixel given the values of its window. """
+    mean = values.mean()
+    var = values.var()
+    cu2 = 1.0/looks
+    weight = 0.0 if var<=0 else np.clip((var - mean*mean*cu2) / (1.0 + cu2) / var, 0.0, 1.0)
+    return mean + weight*(x - mean)
+
+
+def _HalfWindows(h):
+    """ Masks of the 8 edge aligned windows of the Refined Lee filter: left,
+        right, up, down, lower left, upper right, upper left and lower right.
+    """
+    dr, dc = np.mgrid[-h:h+1, -h:h+1]
+    return [dc<=0, dc>=0, dr<=0, dr>=0, dc<=dr, dc>=dr, dc<=-dr, dc>=-dr]
+
+
+def _ReferenceFilter(image, method, window, looks):
+    """ Filters an image one pixel at a time, ignoring NaN pixels. """
+    h = window//2
+    padded = np.pad(image.astype(np.float64), h, constant_values=np.nan)
+    out = np.full(image.shape, np.nan)
+
+    sub = window//2 if (window//2)%2==1 else window//2+1
+    d = (window-sub)//2
+    halves = _HalfWindows(h)
+
+    for r in range(image.shape[0]):
+        for c in range(image.shape[1]):
+            x = image[r,c]
+            if(np.isnan(x)):
+                continue
+            values = padded[r:r+window, c:c+window]
+            if(method=='boxcar'):
+                out[r,c] = np.nanmean(values)
+            elif(method=='lee'):
+                out[r,c] = _Lee(x, values[~np.isnan(values)], looks)
+            else:
+                # Means of the 3x3 subwindows
+                M = np.zeros((3,3))
+                for i, oy in enumerate([-d, 0, d]):
+                    for j, ox in enumerate([-d, 0, d]):
+                        block = padded[r+h+oy-sub//2:r+h+oy+sub//2+1, c+h+ox-sub//2:c+h+ox+sub//2+1]
+                        M[i,j] = np.nanmean(block) if np.any(~np.isnan(block)) else 0.0
+
+                sides = [(M[:,0].sum(), M[:,2].sum()),
+                         (M[0,:].sum(), M[2,:].sum()),
+                         (M[1,0]+M[2,0]+M[2,1], M[0,1]+M[0,2]+M[1,2]),
+                         (M[0,0]+M[0,1]+M[1,0], M[1,2]+M[2,1]+M[2,2])]
+                k = np.argmax([abs(a-b) for a, b in sides])
+                a, b = sides[k]
+                half = halves[2*k] if abs(3*M[1,1]-a)<=abs(3*M[1,1]-b) else halves[2*k+1]
+
+                selected = values[half]
+                out[r,c] = _Lee(x, selected[~np.isnan(selected)], looks)
+    return out
+
+
+@pytest.mark.parametrize('method', ['boxcar', 'lee', 'refined_lee'])
+@pytest.mark.parametrize('window', [3, 7, 9])
+def test_matches_reference(method, window):
+    rng = np.random.default_rng(window)
+    image = rng.gamma(4.4, 0.05/4.4, (24, 31))
+
+    # Edges in every direction and a hole of missing pixels
+    image[:, 15:] *= 8
+    image[np.add.outer(np.arange(24), np.arange(31)) > 30] *= 3
+    image[5:8, 3:6] = np.nan
+
+    h = window//2
+    band = np.pad(image, h, constant_values=np.nan).astype(np.float32)
+    result = _FilterBand(band, method, window, 4.4)
+    expected = _ReferenceFilter(image.astype(np.float32), method, window, 4.4)
+
+    assert np.array_equal(np.isnan(result), np.isnan(expected))
+    np.testing.assert_allclose(result, expected, rtol=1e-4, equal_nan=True)
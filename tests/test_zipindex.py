@@ -0,0 +1,89 @@
+import io
+import struct
+import zipfile
+
+import pytest
+
+from rstools.download.zipindex import _ParseZipDirectory, _SafeRoot, _MatchMember
+
+
+MEMBERS = {'S1A_TEST.SAFE/manifest.safe':b'<manifest/>'*50,
+           'S1A_TEST.SAFE/measurement/s1a-ew-grd-hh-001.tiff':bytes(range(256))*40,
+           'S1A_TEST.SAFE/annotation/calibration/calibration-s1a-ew-grd-hh-001.xml':b'<calibration/>'*20}
+
+
+def _MakeZip(zip64=False, monkeypatch=None):
+    """ Returns the bytes of a zip file with the test members.  With zip64,
+        the limits of the zipfile module are lowered so that the sizes and
+        offsets are stored in Zip64 records, as in archives larger than 4 GB.
+    """
+    if(zip64):
+        monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 100)
+        monkeypatch.setattr(zipfile, 'ZIP_FILECOUNT_LIMIT', 2)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, data in MEMBERS.items():
+            archive.writestr(name, data)
+    data = buffer.getvalue()
+
+    # zipfile still stores the (small) values in the end of central directory
+    # record, while large archives only store them in the Zip64 record
+    if(zip64):
+        eocd = data.rfind(b'PK\x05\x06')
+        data = data[:eocd+8] + struct.pack('<HHII', 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF) + data[eocd+20:]
+    return data
+
+
+def _Parse(data, tail_size):
+    """ Parses the central directory from the last `tail_size` bytes of the
+        file, reading the rest with (counted) range requests.
+    """
+    reads = []
+    def read_range(first, last):
+        reads.append((first, last))
+        return data[first:last+1]
+
+    tail_start = max(0, len(data)-tail_size)
+    return _ParseZipDirectory(data[tail_start:], tail_start, read_range), reads
+
+
+@pytest.mark.parametrize('zip64', [False, True])
+@pytest.mark.parametrize('tail_size', [64, 1024*1024])
+def test_matches_zipfile(zip64, tail_size, monkeypatch):
+    data = _MakeZip(zip64, monkeypatch)
+    if(zip64):
+        assert b'PK\x06\x06' in data
+
+    members, reads = _Parse(data, tail_size)
+    if(tail_size>len(data)):
+        assert reads == []
+
+    infos = sorted(zipfile.ZipFile(io.BytesIO(data)).infolist(), key=lambda info: info.header_offset)
+    assert [m['name'] for m in members] == [info.filename for info in infos]
+    for member, info in zip(members, infos):
+        assert member['offset'] == info.header_offset
+        assert member['size'] == info.file_size
+        assert member['comp_size'] == info.compress_size
+        assert member['crc'] == info.CRC
+        assert member['method'] == zipfile.ZIP_DEFLATED
+
+    # Each member ends where the next begins
+    assert [m['end'] for m in members[:-1]] == [m['offset'] for m in members[1:]]
+    assert members[-1]['end'] > members[-1]['offset'] + members[-1]['comp_size']
+
+
+def test_not_a_zip():
+    with pytest.raises(RuntimeError):
+        _ParseZipDirectory(b'not a zip file', 0, None)
+
+
+def test_member_selection():
+    members = [{'name':name} for name in MEMBERS]
+    root = _SafeRoot(members)
+    assert root == 'S1A_TEST.SAFE/'
+
+    names = [m['name'][len(root):] for m in members]
+    assert [n for n in names if _MatchMember(n, ['measurement/*-hh-*.tiff'])] == ['measurement/s1a-ew-grd-hh-001.tiff']
+    assert [n for n in names if _MatchMember(n, ['annotation/'])] == ['annotation/calibration/calibration-s1a-ew-grd-hh-001.xml']
+    assert _SafeRoot([{'name':'a.txt'}, {'name':'b/c.txt'}]) == ''